@@ -0,0 +1,443 @@
+"""StopWatch - library for adding timers and tags in your code for performance monitoring
+https://github.com/dropbox/stopwatch
+
+Benchmarks for the overhead StopWatch instrumentation adds per span.
+
+Each benchmark reports, per span:
+- ns/span: the wall time.
+- allocs/span: the memory blocks one iteration allocates, including the ones it frees
+  again (see count_allocations()).
+- peak bytes/span: the most memory traced by tracemalloc at once while one iteration
+  ran.
+
+Usage:
+```
+python benchmark_stopwatch.py                        # run everything, print a table
+python benchmark_stopwatch.py --save baseline.json   # also save machine readable results
+python benchmark_stopwatch.py --compare baseline.json --threshold 0.1
+```
+With --compare, benchmarks more than threshold slower than the baseline, or allocating
+more than threshold more blocks or peak bytes per span, are flagged and the exit status is 1.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import collections
+import gc
+import inspect
+import json
+import platform
+import sys
+import time
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+import stopwatch_global
+from stopwatch import (
+    format_report,
+    set_enabled,
+    StopWatch,
+)
+
+perf_counter = getattr(time, 'perf_counter', time.time)
+
+BenchmarkResult = collections.namedtuple('BenchmarkResult', [
+    'name', 'ns_per_span', 'allocs_per_span', 'peak_bytes_per_span'])
+
+# BenchmarkResult fields compared by compare(), with their unit
+COMPARED_METRICS = (
+    ('ns_per_span', 'ns/span'),
+    ('allocs_per_span', 'allocs/span'),
+    ('peak_bytes_per_span', 'peak bytes/span'),
+)
+
+# Allocation differences below this (per span) are noise rather than regressions, e.g. a
+# baseline of 0 allocs/span and a free list growing by one block
+_MIN_ALLOCATION_DELTA = 0.01
+
+# Code flags of functions whose frame outlives a single call
+_GENERATOR_FLAGS = (inspect.CO_GENERATOR
+                    | getattr(inspect, 'CO_COROUTINE', 0)
+                    | getattr(inspect, 'CO_ASYNC_GENERATOR', 0))
+
+# name -> (setup function, spans per iteration). A setup function returns the function
+# running one iteration, optionally with a teardown function as (run, teardown).
+BENCHMARKS = collections.OrderedDict()
+
+def benchmark(name, spans):
+    """Register a benchmark setup function"""
+    def decorator(setup_func):
+        BENCHMARKS[name] = (setup_func, spans)
+        return setup_func
+    return decorator
+
+def _noop():
+    pass
+
+@benchmark('uninstrumented_call', spans=1000)
+def bench_uninstrumented_call():
+    """Reference point: the loop and a function call, without any instrumentation"""
+    def run():
+        for _ in range(1000):
+            _noop()
+    return run
+
+@benchmark('start_end', spans=1001)
+def bench_start_end():
+    sw = StopWatch()
+
+    def run():
+        sw.start('root')
+        for _ in range(1000):
+            sw.start('child')
+            _noop()
+            sw.end('child')
+        sw.end('root')
+    return run
+
+@benchmark('timer', spans=1001)
+def bench_timer():
+    sw = StopWatch()
+
+    def run():
+        with sw.timer('root'):
+            for _ in range(1000):
+                with sw.timer('child'):
+                    _noop()
+    return run
+
+@benchmark('timer_reused', spans=1001)
+def bench_timer_reused():
+    sw = StopWatch()
+    root_timer = sw.timer('root')
+    child_timer = sw.timer('child')
+
+    def run():
+        with root_timer:
+            for _ in range(1000):
+                with child_timer:
+                    _noop()
+    return run
+
+@benchmark('timer_disabled', spans=1001)
+def bench_timer_disabled():
+    """timer() of a disabled StopWatch, to compare with uninstrumented_call"""
+    sw = StopWatch(enabled=False)
+
+    def run():
+        with sw.timer('root'):
+            for _ in range(1000):
+                with sw.timer('child'):
+                    _noop()
+    return run
+
+@benchmark('timer_reused_disabled', spans=1001)
+def bench_timer_reused_disabled():
+    sw = StopWatch()
+    root_timer = sw.timer('root')
+    child_timer = sw.timer('child')
+    sw.enabled = False
+
+    def run():
+        with root_timer:
+            for _ in range(1000):
+                with child_timer:
+                    _noop()
+    return run
+
+@benchmark('nested_depth_50', spans=50 * 20)
+def bench_nested():
+    sw = StopWatch()
+
+    def nest(depth):
+        with sw.timer('level'):
+            if depth > 1:
+                nest(depth - 1)
+
+    def run():
+        for _ in range(20):
+            nest(50)
+    return run
+
+@benchmark('loop_50k_traced', spans=50001)
+def bench_loop_traced():
+    """Every span is long enough to trace, so the loop runs into
+    MAX_REQUEST_TRACING_SPANS_FOR_PATH"""
+    sw = StopWatch(min_tracing_milliseconds=0)
+
+    def run():
+        with sw.timer('root'):
+            for _ in range(50000):
+                with sw.timer('child'):
+                    pass
+    return run
+
+def _traced_root(sw):
+    def run():
+        with sw.timer('root'):
+            for _ in range(1000):
+                with sw.timer('child'):
+                    sw.add_span_annotation('key')
+    return run
+
+@benchmark('traced_1k', spans=1001)
+def bench_traced():
+    return _traced_root(StopWatch(min_tracing_milliseconds=0))
+
+@benchmark('traced_1k_columnar', spans=1001)
+def bench_traced_columnar():
+    return _traced_root(StopWatch(min_tracing_milliseconds=0, columnar_traces=True))
+
+@benchmark('sampling_timer', spans=1001)
+def bench_sampling_timer():
+    sw = StopWatch()
+
+    def run():
+        with sw.timer('root'):
+            for _ in range(1000):
+                with sw.sampling_timer('child', p=0.1):
+                    _noop()
+    return run
+
+@benchmark('annotations', spans=1001)
+def bench_annotations():
+    sw = StopWatch()
+
+    def run():
+        with sw.timer('root'):
+            for i in range(1000):
+                with sw.timer('child'):
+                    sw.add_span_annotation('key', i)
+                    sw.add_annotation('root_key')
+    return run
+
+@benchmark('format_report', spans=1)
+def bench_format_report():
+    sw = StopWatch()
+    with sw.timer('root'):
+        for i in range(20):
+            with sw.timer('child%d' % i):
+                for j in range(5):
+                    with sw.timer('grandchild%d' % j):
+                        pass
+    report = sw.get_last_aggregated_report()
+
+    def run():
+        format_report(report)
+    return run
+
+@benchmark('global_sw_lookup', spans=1000)
+def bench_global_sw_lookup():
+    """Cost of global_sw() alone (spans here are lookups)"""
+    stopwatch_global.global_sw_init()
+    global_sw = stopwatch_global.global_sw
+
+    def run():
+        for _ in range(1000):
+            global_sw()
+    return run, stopwatch_global.global_sw_del
+
+@benchmark('global_sw_disabled', spans=1001)
+def bench_global_sw_disabled():
+    """global_sw().timer() with stopwatches disabled process-wide"""
+    stopwatch_global.global_sw_init()
+    global_sw = stopwatch_global.global_sw
+    set_enabled(False)
+
+    def run():
+        with global_sw().timer('root'):
+            for _ in range(1000):
+                with global_sw().timer('child'):
+                    _noop()
+
+    def teardown():
+        set_enabled(True)
+        stopwatch_global.global_sw_del()
+    return run, teardown
+
+def count_allocations(run):
+    """Run `run` once and return how many memory blocks it allocates, including the ones it
+    frees again before returning. A trace function samples sys.getallocatedblocks() after
+    every bytecode that changed the memory traced by tracemalloc (the block count walks all
+    arenas, so sampling it unconditionally is slow), so only blocks allocated and freed
+    within one bytecode (e.g. temporaries inside a C function) are missed. Returns None
+    where this isn't supported."""
+    if (tracemalloc is None or not hasattr(sys, 'getallocatedblocks')
+            or sys.version_info < (3, 7)):
+        return None
+    get_allocated_blocks = sys.getallocatedblocks
+    get_traced_memory = tracemalloc.get_traced_memory
+    # Blocks allocated at the last sample, bytes traced at the last sample, blocks
+    # allocated so far
+    state = [0, 0, 0]
+
+    def trace(frame, event, arg):
+        traced = get_traced_memory()[0]
+        if event == 'call':
+            frame.f_trace_opcodes = True
+            if not frame.f_code.co_flags & _GENERATOR_FLAGS:
+                # Don't count the frame object tracing creates for every call
+                state[0] += 1
+        if traced != state[1]:
+            blocks = get_allocated_blocks()
+            if blocks > state[0]:
+                state[2] += blocks - state[0]
+            state[0] = blocks
+            state[1] = traced
+        return trace
+
+    was_tracing = tracemalloc.is_tracing()
+    if not was_tracing:
+        tracemalloc.start()
+    previous_trace = sys.gettrace()
+    state[0] = get_allocated_blocks()
+    state[1] = get_traced_memory()[0]
+    sys.settrace(trace)
+    try:
+        run()
+    finally:
+        sys.settrace(previous_trace)
+        if not was_tracing:
+            tracemalloc.stop()
+    return state[2]
+
+def measure(name, min_time=0.2, repeat=5):
+    """Run a registered benchmark and return a BenchmarkResult. The time per span is the
+    best of `repeat` rounds, each of which runs for at least `min_time` seconds."""
+    setup_func, spans = BENCHMARKS[name]
+    run = setup_func()
+    teardown = None
+    if isinstance(run, tuple):
+        run, teardown = run
+    try:
+        # Warm up and find how many iterations fill min_time
+        iterations = 1
+        while True:
+            start = perf_counter()
+            for _ in range(iterations):
+                run()
+            elapsed = perf_counter() - start
+            if elapsed >= min_time:
+                break
+            iterations *= 2
+
+        best = elapsed
+        for _ in range(repeat - 1):
+            start = perf_counter()
+            for _ in range(iterations):
+                run()
+            best = min(best, perf_counter() - start)
+
+        gc.collect()
+        allocs = count_allocations(run)
+        allocs_per_span = None if allocs is None else allocs / spans
+
+        peak_bytes_per_span = None
+        if tracemalloc is not None:
+            tracemalloc.start()
+            try:
+                run()
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+            peak_bytes_per_span = peak / spans
+    finally:
+        if teardown is not None:
+            teardown()
+
+    return BenchmarkResult(name, best * 1e9 / (iterations * spans), allocs_per_span,
+                           peak_bytes_per_span)
+
+def compare(baseline, results, threshold):
+    """Compare results against a baseline (both name -> BenchmarkResult).
+    Returns a list of (name, metric, baseline value, current value, ratio) for each
+    metric of COMPARED_METRICS that got more than `threshold` (relative) worse.
+    Metrics missing (None) on either side are skipped."""
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        for metric, _ in COMPARED_METRICS:
+            old = getattr(baseline[name], metric)
+            new = getattr(result, metric)
+            if old is None or new is None:
+                continue
+            if metric != 'ns_per_span' and new - old < _MIN_ALLOCATION_DELTA:
+                continue
+            ratio = new / old if old > 0 else float('inf')
+            if ratio > 1.0 + threshold:
+                regressions.append((name, metric, old, new, ratio))
+    return regressions
+
+def save_results(results, path):
+    with open(path, 'w') as f:
+        json.dump({
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'results': {name: result._asdict() for name, result in results.items()},
+        }, f, indent=2, sort_keys=True)
+
+def load_results(path):
+    with open(path) as f:
+        data = json.load(f)
+    # Fields missing from older baselines are None, and fields no longer measured ignored
+    return collections.OrderedDict(
+        (name, BenchmarkResult(*[result.get(field) for field in BenchmarkResult._fields]))
+        for name, result in sorted(data['results'].items())
+    )
+
+def _format_value(value):
+    return '-' if value is None else '%.1f' % value
+
+def format_results(results):
+    buf = ['%s %12s %12s %16s' % ('benchmark'.ljust(24), 'ns/span', 'allocs/span',
+                                  'peak bytes/span')]
+    for result in results.values():
+        buf.append('%s %12.1f %12s %16s' % (
+            result.name.ljust(24),
+            result.ns_per_span,
+            _format_value(result.allocs_per_span),
+            _format_value(result.peak_bytes_per_span),
+        ))
+    return '\n'.join(buf)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark StopWatch instrumentation overhead')
+    parser.add_argument('--filter', default='', help='Only run benchmarks containing this')
+    parser.add_argument('--min-time', type=float, default=0.2,
+                        help='Minimum seconds per measurement round')
+    parser.add_argument('--repeat', type=int, default=5, help='Measurement rounds')
+    parser.add_argument('--save', help='Save results as JSON to this path')
+    parser.add_argument('--compare', help='Compare results against a JSON baseline')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='Relative slowdown (or allocation growth) flagged as a '
+                             'regression by --compare')
+    args = parser.parse_args(argv)
+
+    results = collections.OrderedDict()
+    for name in BENCHMARKS:
+        if args.filter in name:
+            results[name] = measure(name, min_time=args.min_time, repeat=args.repeat)
+    print(format_results(results))
+
+    if args.save:
+        save_results(results, args.save)
+
+    if args.compare:
+        regressions = compare(load_results(args.compare), results, args.threshold)
+        units = dict(COMPARED_METRICS)
+        for name, metric, old, new, ratio in regressions:
+            print('REGRESSION %s: %.1f -> %.1f %s (%+.0f%%)' % (
+                name, old, new, units[metric], (ratio - 1.0) * 100.0))
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,6 @@
+import sys
+
+collect_ignore = []
+if sys.version_info < (3, 7):
+    # Uses async/await syntax and contextvars
+    collect_ignore.append('test_stopwatch_global_asyncio.py')
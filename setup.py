@@ -8,7 +8,10 @@ setup(
     license='Apache License 2.0',
     author='Nipunn Koorapati',
     author_email='nipunn@dropbox.com',
-    py_modules=['stopwatch', 'stopwatch_global'],
+    py_modules=['stopwatch', 'stopwatch_aggregator', 'stopwatch_cli', 'stopwatch_export',
+                'stopwatch_global', 'stopwatch_profiler', 'stopwatch_prometheus',
+                'stopwatch_retention', 'stopwatch_shm', 'stopwatch_statsd',
+                'stopwatch_trace_export', 'stopwatch_tracelog'],
     url='https://github.com/dropbox/stopwatch',
     download_url='https://github.com/dropbox/stopwatch/tarball/1.6',
 
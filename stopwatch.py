@@ -31,14 +31,236 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import array
 import collections
-import contextlib
+import functools
+import itertools
+import math
 import random as insecure_random
+import threading
 import time
 
+try:
+    from threading import get_ident as _get_ident
+except ImportError:  # Python 2
+    from thread import get_ident as _get_ident
+
+# Integer nanosecond clocks, Python 3.7+
+_perf_counter_ns = getattr(time, 'perf_counter_ns', None)
+_time_ns = getattr(time, 'time_ns', None)
+
 TraceAnnotation = collections.namedtuple('TraceKeyValueAnnotation', ['key', 'value', 'time'])
-AggregatedReport = collections.namedtuple('AggregatedReport',
-                                          ['aggregated_values', 'root_timer_data'])
+# The namedtuple's own name, which pickle looks up
+TraceKeyValueAnnotation = TraceAnnotation
+class SlowTraceAnnotation(TraceAnnotation):
+    """TraceAnnotation added for an add_slow_annotation() tag whose time limit the root
+    scope exceeded. Compares equal to a plain TraceAnnotation with the same values."""
+    __slots__ = ()
+
+_AggregatedReportTuple = collections.namedtuple('AggregatedReport',
+                                                ['aggregated_values', 'root_timer_data'])
+class AggregatedReport(_AggregatedReportTuple):
+    """The aggregated values and root TimerData of a finished root scope.
+
+    It is still the 2-tuple (aggregated_values, root_timer_data), so existing code
+    unpacking it keeps working. The optional fields are attributes only:
+      histograms: log_name -> LatencyHistogram, only filled in when the StopWatch tracks
+        latency histograms.
+      self_values: log_name -> exclusive time in ms, the time not spent in child spans.
+      overhead_ms: Estimated instrumentation overhead of the root scope, only filled in
+        when the StopWatch has a span_overhead_ms (see calibrate_overhead).
+      bucket_totals: bucket -> total time in ms of the spans ended with it, not counting
+        spans nested under a span of the same bucket twice.
+    """
+
+    _optional_fields = ('histograms', 'self_values', 'overhead_ms', 'bucket_totals')
+
+    def __new__(cls, aggregated_values, root_timer_data, histograms=None, self_values=None,
+                overhead_ms=None, bucket_totals=None):
+        self = super(AggregatedReport, cls).__new__(cls, aggregated_values, root_timer_data)
+        self.histograms = histograms
+        self.self_values = self_values
+        self.overhead_ms = overhead_ms
+        self.bucket_totals = bucket_totals
+        return self
+
+    def __getnewargs__(self):
+        return tuple(self) + tuple(getattr(self, name) for name in self._optional_fields)
+
+    @classmethod
+    def _make(cls, iterable):
+        """Takes the 2 tuple fields, optionally followed by the optional ones"""
+        return cls(*iterable)
+
+    def _replace(self, **kwargs):
+        values = dict(zip(self._fields, self))
+        values.update((name, getattr(self, name)) for name in self._optional_fields)
+        values.update(kwargs)
+        return AggregatedReport(**values)
+
+    def __repr__(self):
+        return '%s, %s)' % (
+            super(AggregatedReport, self).__repr__()[:-1],
+            ', '.join('%s=%r' % (name, getattr(self, name)) for name in self._optional_fields),
+        )
+
+# Approximate memory used per root scope by a traced span, an annotation and the
+# aggregated values of a path, for StopWatch(max_bytes=...)
+_TRACE_BYTES = 150
+_ANNOTATION_BYTES = 100
+_PATH_BYTES = 200
+
+# Degradation levels of a root scope over its memory budget
+_DROP_TRACES = 1
+_DROP_ANNOTATIONS = 2
+_COLLAPSE_PATHS = 3
+
+def random_span_id():
+    """Returns a new random 128 bit span id as 32 hex characters"""
+    return '%032x' % insecure_random.getrandbits(128)
+
+class SpanPath(object):
+    """
+    Interned node in the tree of span paths, e.g. for 'root#child'. Spans are aggregated
+    by SpanPath, and the concatenated log_name string is only built once per path, on
+    first use at export time.
+    """
+
+    __slots__ = ('name', 'parent', 'id', '_log_name', '_children', '_tree')
+
+    def __init__(self, name, parent, path_id, tree):
+        self.name = name
+        self.parent = parent
+        self.id = path_id
+        self._log_name = None
+        self._children = {}
+        self._tree = tree
+
+    @property
+    def log_name(self):
+        """Full path of span names joined with '#'"""
+        if self._log_name is None:
+            if self.parent is None:
+                self._log_name = self.name
+            else:
+                self._log_name = self.parent.log_name + '#' + self.name
+        return self._log_name
+
+    def child(self, name):
+        """Returns the interned path for span `name` nested under this one"""
+        child = self._children.get(name)
+        if child is None:
+            child = self._tree._new_path(name, self, self._children)
+        return child
+
+    def __repr__(self):
+        return 'SpanPath(%r, id=%r)' % (self.log_name, self.id)
+
+    def __reduce__(self):
+        # Pickled as its span names, without the tree (and its lock). Unpickled paths
+        # are interned in their own tree.
+        names = []
+        path = self
+        while path is not None:
+            names.append(path.name)
+            path = path.parent
+        names.reverse()
+        return _unpickle_span_path, (tuple(names),)
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+class SpanPathTree(object):
+    """
+    Cache of interned SpanPaths, kept across root scopes so that steady state requests
+    don't build any new path strings. Lookups are lock free; only creating a new path
+    takes a lock, so a tree can be shared between threads.
+
+    To bound memory when span names are unbounded (e.g. contain ids), the cache starts
+    over once it holds max_paths paths. Paths handed out before that stay valid.
+    """
+
+    def __init__(self, max_paths=100000):
+        self.max_paths = max_paths
+        self.num_paths = 0
+        self._roots = {}
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+    def root(self, name):
+        """Returns the interned path for a root span named `name`"""
+        path = self._roots.get(name)
+        if path is None:
+            path = self._new_path(name, None, self._roots)
+        return path
+
+    def _new_path(self, name, parent, siblings):
+        with self._lock:
+            path = siblings.get(name)
+            if path is not None:
+                return path
+            if self.num_paths >= self.max_paths:
+                self.num_paths = 0
+                self._roots = {}
+                if parent is None:
+                    siblings = self._roots
+            path = SpanPath(name, parent, next(self._ids), self)
+            siblings[name] = path
+            self.num_paths += 1
+            return path
+
+# Interns the SpanPaths of unpickled reports and traces
+_UNPICKLED_PATHS = SpanPathTree()
+
+def _unpickle_span_path(names):
+    path = _UNPICKLED_PATHS.root(names[0])
+    for name in names[1:]:
+        path = path.child(name)
+    return path
+
+def _by_log_name(values_by_path, merge_func):
+    """Convert a dict keyed by SpanPath into one keyed by log_name. Distinct paths
+    only share a log_name if the SpanPathTree started over mid root scope, in which
+    case merge_func(existing, value) returns their combination."""
+    by_log_name = {}
+    for path, value in values_by_path.items():
+        log_name = path.log_name
+        if log_name in by_log_name:
+            by_log_name[log_name] = merge_func(by_log_name[log_name], value)
+        else:
+            by_log_name[log_name] = value
+    return by_log_name
+
+def _merge_values(values, other):
+    values[0] += other[0]
+    values[1] += other[1]
+    return values
+
+def _merge_histograms(histogram, other):
+    histogram.merge(other)
+    return histogram
+
+def _merge_sums(total, other):
+    return total + other
+
+def _add_bucket_times(tr_data, bucket_times):
+    """Add the bucket times of a finished span to its (still open) parent"""
+    parent_times = tr_data.bucket_times
+    if parent_times is None:
+        tr_data.bucket_times = dict(bucket_times)
+    else:
+        for bucket, delta in bucket_times.items():
+            parent_times[bucket] = parent_times.get(bucket, 0) + delta
+
+def _ns_to_ms(aggregated_values, self_values):
+    return (
+        {log_name: [delta_ns / 1e6, count, bucket]
+         for log_name, (delta_ns, count, bucket) in aggregated_values.items()},
+        {log_name: self_ns / 1e6 for log_name, self_ns in self_values.items()},
+    )
 
 class TimerData(object):
     """
@@ -47,28 +269,62 @@ class TimerData(object):
     """
 
     __slots__ = (
-        'span_id',
+        '_span_id',
         'name',
         'start_time',
         'end_time',
         'trace_annotations',
         'parent_span_id',
-        'log_name',
+        'path',
+        'child_time',
+        'num_descendants',
+        'bucket_times',
+        'trace_id',
     )
 
-    def __init__(self, name, start_time, parent_name):
-        # Generate new span id.
-        self.span_id = '%032x' % insecure_random.getrandbits(128)
-        self.name = name
+    def __init__(self, path, start_time):
+        # Span ids are allocated lazily - most spans are never traced.
+        self._span_id = None
+        self.name = path.name
+        self.path = path
         self.start_time = start_time
         self.end_time = None  # Gets filled in later
         self.trace_annotations = []
         self.parent_span_id = None  # Gets filled in at the end
-
-        if parent_name:
-            self.log_name = parent_name + '#' + name
-        else:
-            self.log_name = name
+        # Total duration of the finished child spans, in the StopWatch's duration unit
+        # (ms, or integer ns with monotonic_ns) - always ms once exported
+        self.child_time = 0
+        # Number of finished spans nested (at any depth) under this one
+        self.num_descendants = 0
+        # bucket -> time of the finished descendants (not nested under a span of the
+        # same bucket) in each bucket, None until there is any
+        self.bucket_times = None
+        # Span id of the root span of the trace, only set on the root spans of
+        # StopWatches with a parent_context (the trace of any other span is its root's)
+        self.trace_id = None
+
+    @property
+    def log_name(self):
+        """Full path of this span, e.g. 'root#child'"""
+        return self.path.log_name
+
+    @property
+    def self_ms(self):
+        """Exclusive time of this (finished) span in ms: its duration minus the time
+        spent in child spans"""
+        return max((self.end_time - self.start_time) * 1000.0 - self.child_time, 0.0)
+
+    @property
+    def span_id(self):
+        """Unique id of this span. Traced spans get theirs from the StopWatch when they
+        are traced; otherwise a random one is generated on first access."""
+        if self._span_id is None:
+            self._span_id = random_span_id()
+        return self._span_id
+
+    @span_id.setter
+    def span_id(self, span_id):
+        self._span_id = span_id
 
     def __repr__(self):
         return ('name=%r, span_id=%r start_time=%r end_time=%r annotations=%r, parent_span_id=%r,'
@@ -82,10 +338,624 @@ class TimerData(object):
             self.log_name,
         )
 
+try:
+    _UINT64 = array.array('Q').typecode
+except ValueError:  # Python 2, where 'L' is 64 bits on LP64 platforms
+    _UINT64 = 'L'
+_UINT64_MASK = (1 << 64) - 1
+
+class TraceBuffer(object):
+    """
+    Compact storage for the traced spans of a root scope, used instead of a list of
+    TimerData with StopWatch(columnar_traces=True). Span fields are kept in parallel
+    array columns (span ids as pairs of 64 bit integers) and annotations in a side
+    table, so a traced span doesn't keep any Python objects of its own alive.
+
+    Indexing and iteration return TraceView objects, which have the same attributes as
+    TimerData. Root spans (and spans with foreign span ids) are kept as TimerData.
+    """
+
+    def __init__(self, root_parent_path=None, monotonic_ns=False):
+        time_type = 'q' if monotonic_ns else 'd'
+        self._start_times = array.array(time_type)
+        self._end_times = array.array(time_type)
+        self._child_times = array.array(time_type)
+        # Two entries (high and low 64 bits) per span, parent ids are 0 for None
+        self._span_ids = array.array(_UINT64)
+        self._parent_span_ids = array.array(_UINT64)
+        self._paths = []
+        # index -> list of TraceAnnotation, for spans with annotations
+        self._annotations = {}
+        # index -> TimerData, for spans not stored in the columns
+        self._objects = {}
+        self._root_parent_path = root_parent_path
+
+    def __len__(self):
+        return len(self._paths)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self._paths)
+        if not 0 <= index < len(self._paths):
+            raise IndexError("TraceBuffer index out of range")
+        tr_data = self._objects.get(index)
+        return tr_data if tr_data is not None else TraceView(self, index)
+
+    def __iter__(self):
+        objects = self._objects
+        for index in range(len(self._paths)):
+            tr_data = objects.get(index)
+            yield tr_data if tr_data is not None else TraceView(self, index)
+
+    def __repr__(self):
+        return 'TraceBuffer(%r)' % (list(self),)
+
+    def append(self, tr_data):
+        span_id = tr_data.span_id
+        parent_span_id = tr_data.parent_span_id
+        index = len(self._paths)
+        if (tr_data.path.parent is self._root_parent_path or len(span_id) != 32
+                or (parent_span_id is not None and len(parent_span_id) != 32)):
+            # Root annotations are added to root spans after they are traced
+            self._objects[index] = tr_data
+            self._paths.append(tr_data.path)
+            self._start_times.append(0)
+            self._end_times.append(0)
+            self._child_times.append(0)
+            self._span_ids.extend((0, 0))
+            self._parent_span_ids.extend((0, 0))
+            return
+
+        self._paths.append(tr_data.path)
+        self._start_times.append(tr_data.start_time)
+        self._end_times.append(tr_data.end_time)
+        self._child_times.append(tr_data.child_time)
+        span_id = int(span_id, 16)
+        self._span_ids.extend((span_id >> 64, span_id & _UINT64_MASK))
+        if parent_span_id is None:
+            self._parent_span_ids.extend((0, 0))
+        else:
+            parent_span_id = int(parent_span_id, 16)
+            self._parent_span_ids.extend((parent_span_id >> 64, parent_span_id & _UINT64_MASK))
+        if tr_data.trace_annotations:
+            self._annotations[index] = tr_data.trace_annotations
+
+    def extend(self, traces):
+        if not isinstance(traces, TraceBuffer):
+            for tr_data in traces:
+                self.append(tr_data)
+            return
+        offset = len(self._paths)
+        self._paths.extend(traces._paths)
+        self._start_times.extend(traces._start_times)
+        self._end_times.extend(traces._end_times)
+        self._child_times.extend(traces._child_times)
+        self._span_ids.extend(traces._span_ids)
+        self._parent_span_ids.extend(traces._parent_span_ids)
+        for index, annotations in traces._annotations.items():
+            self._annotations[index + offset] = annotations
+        for index, tr_data in traces._objects.items():
+            self._objects[index + offset] = tr_data
+
+    def _to_wall_clock(self, offset_ns):
+        """Convert perf_counter_ns times to seconds since the epoch (and child times
+        to ms), see StopWatch._to_wall_clock"""
+        self._start_times = array.array('d', [(t + offset_ns) / 1e9 for t in self._start_times])
+        self._end_times = array.array('d', [(t + offset_ns) / 1e9 for t in self._end_times])
+        self._child_times = array.array('d', [t / 1e6 for t in self._child_times])
+
+def _format_span_id(span_ids, index):
+    high = span_ids[2 * index]
+    low = span_ids[2 * index + 1]
+    if not high and not low:
+        return None
+    return '%016x%016x' % (high, low)
+
+class TraceView(object):
+    """A traced span stored in a TraceBuffer, with the attributes of a TimerData"""
+
+    __slots__ = ('_buffer', '_index')
+
+    def __init__(self, trace_buffer, index):
+        self._buffer = trace_buffer
+        self._index = index
+
+    @property
+    def path(self):
+        return self._buffer._paths[self._index]
+
+    @property
+    def name(self):
+        return self.path.name
+
+    @property
+    def log_name(self):
+        return self.path.log_name
+
+    @property
+    def start_time(self):
+        return self._buffer._start_times[self._index]
+
+    @property
+    def end_time(self):
+        return self._buffer._end_times[self._index]
+
+    @property
+    def child_time(self):
+        return self._buffer._child_times[self._index]
+
+    @property
+    def span_id(self):
+        return _format_span_id(self._buffer._span_ids, self._index)
+
+    @property
+    def parent_span_id(self):
+        return _format_span_id(self._buffer._parent_span_ids, self._index)
+
+    @property
+    def trace_annotations(self):
+        return self._buffer._annotations.get(self._index, [])
+
+    self_ms = TimerData.self_ms
+    __repr__ = vars(TimerData)['__repr__']
+
+class LatencyHistogram(object):
+    """
+    Mergeable latency sketch with logarithmically sized buckets (as in DDSketch). Every
+    quantile estimate is within relative_accuracy of the true value, add() is constant
+    time and the number of buckets is bounded by the [min_ms, max_ms] range, so memory
+    per histogram is fixed no matter how many values are added.
+    """
+
+    __slots__ = (
+        'relative_accuracy',
+        'count',
+        'total_ms',
+        'min_ms',
+        'max_ms',
+        '_counts',
+        '_gamma',
+        '_inv_log_gamma',
+        '_min_index',
+        '_max_index',
+    )
+
+    def __init__(self, relative_accuracy=0.01, min_ms=0.001, max_ms=1e7):
+        """
+        Arguments:
+          relative_accuracy: Maximum relative error of the quantile estimates.
+          min_ms/max_ms:
+            Range of values tracked with full accuracy. Values outside of it are clamped
+            into the lowest / highest bucket (but are still reflected in min_ms / max_ms).
+        """
+        self.relative_accuracy = relative_accuracy
+        self.count = 0
+        self.total_ms = 0.0
+        self.min_ms = None
+        self.max_ms = None
+        self._counts = {}
+        self._gamma = (1.0 + relative_accuracy) / (1.0 - relative_accuracy)
+        self._inv_log_gamma = 1.0 / math.log(self._gamma)
+        self._min_index = self._index(min_ms)
+        self._max_index = self._index(max_ms)
+
+    def _index(self, value_ms):
+        return int(math.ceil(math.log(value_ms) * self._inv_log_gamma))
+
+    def add(self, value_ms, count=1):
+        """Add a value (in ms) to the histogram"""
+        if value_ms > 0.0:
+            index = int(math.ceil(math.log(value_ms) * self._inv_log_gamma))
+            if index < self._min_index:
+                index = self._min_index
+            elif index > self._max_index:
+                index = self._max_index
+        else:
+            index = self._min_index
+        counts = self._counts
+        counts[index] = counts.get(index, 0) + count
+
+        self.count += count
+        self.total_ms += value_ms * count
+        if self.min_ms is None or value_ms < self.min_ms:
+            self.min_ms = value_ms
+        if self.max_ms is None or value_ms > self.max_ms:
+            self.max_ms = value_ms
+
+    def merge(self, other):
+        """Merge another histogram with the same parameters into this one"""
+        assert (self._gamma, self._min_index, self._max_index) == \
+            (other._gamma, other._min_index, other._max_index), \
+            "Cannot merge LatencyHistograms with different parameters"
+        if not other.count:
+            return
+        counts = self._counts
+        for index, count in other._counts.items():
+            counts[index] = counts.get(index, 0) + count
+        self.count += other.count
+        self.total_ms += other.total_ms
+        if self.min_ms is None or other.min_ms < self.min_ms:
+            self.min_ms = other.min_ms
+        if self.max_ms is None or other.max_ms > self.max_ms:
+            self.max_ms = other.max_ms
+
+    def copy(self):
+        """Returns an independent copy of this histogram"""
+        other = LatencyHistogram.__new__(LatencyHistogram)
+        for attr in LatencyHistogram.__slots__:
+            setattr(other, attr, getattr(self, attr))
+        other._counts = dict(self._counts)
+        return other
+
+    def items(self):
+        """Returns a list of (estimated value in ms, count) for every non-empty bucket, in
+        increasing order"""
+        gamma = self._gamma
+        return [(2.0 * gamma ** index / (gamma + 1.0), self._counts[index])
+                for index in sorted(self._counts)]
+
+    def quantile(self, q):
+        """Returns the estimated value (in ms) at quantile q (0 <= q <= 1), or None if empty"""
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for index in sorted(self._counts):
+            seen += self._counts[index]
+            if seen > rank:
+                break
+        value = 2.0 * self._gamma ** index / (self._gamma + 1.0)
+        return min(max(value, self.min_ms), self.max_ms)
+
+    def __repr__(self):
+        return 'LatencyHistogram(count=%r, p50=%r, p99=%r, max_ms=%r)' % (
+            self.count, self.quantile(0.5), self.quantile(0.99), self.max_ms)
+
+class SpanTimer(object):
+    """
+    Context manager for a single stopwatch span, returned by StopWatch.timer().
+    It keeps no per-entry state (that lives on the StopWatch timer stack), so one
+    instance can be created per call site and re-entered, even recursively.
+    """
+
+    __slots__ = ('_sw', 'name', 'bucket', 'start_time', 'end_time')
+
+    def __init__(self, sw, name, bucket=None, start_time=None, end_time=None):
+        self._sw = sw
+        self.name = name
+        self.bucket = bucket
+        self.start_time = start_time
+        self.end_time = end_time
+
+    def __enter__(self):
+        sw = self._sw
+        sw.start(self.name, start_time=self.start_time)
+        sw.context_manager_depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        sw = self._sw
+        if exc_type is not None and issubclass(exc_type, Exception):
+            sw.add_annotation('Exception', exc_type.__name__, event_time=self.end_time)
+        sw.context_manager_depth -= 1
+        sw.end(self.name, end_time=self.end_time, bucket=self.bucket)
+        return False
+
+class SpanContext(object):
+    """
+    Handle on a span that is open in one StopWatch, used to attach the spans of another
+    StopWatch (e.g. of a child asyncio task, or running on a worker thread) underneath
+    it. See StopWatch.span_context().
+    """
+
+    __slots__ = ('stopwatch', 'timer_data', '_root_timer_data', '_root_scope',
+                 '_thread_ident', '_held')
+
+    def __init__(self, sw, timer_data, hold=False):
+        self.stopwatch = sw
+        self.timer_data = timer_data
+        self._root_timer_data = sw._timer_stack[0]
+        # The root scope the span belongs to, which child StopWatches are merged into
+        self._root_scope = sw._root_scope
+        self._thread_ident = _get_ident()
+        self._held = hold and self._root_scope.hold()
+
+    @property
+    def log_name(self):
+        return self.timer_data.log_name
+
+    @property
+    def span_id(self):
+        return self.stopwatch._get_span_id(self.timer_data)
+
+    @property
+    def trace_id(self):
+        """Span id of the root span of the trace the span belongs to, following the
+        parent_contexts of nested StopWatches"""
+        parent_context = self.stopwatch._parent_context
+        if parent_context is not None:
+            return parent_context.trace_id
+        return self.stopwatch._get_span_id(self._root_timer_data)
+
+    def is_open(self):
+        """Whether the span (and the root scope it belongs to) is still running"""
+        return (self.timer_data.end_time is None
+                and self.stopwatch._root_scope is self._root_scope)
+
+    def release(self):
+        """Let the root scope be exported, for a SpanContext created with hold=True"""
+        assert self._held, "SpanContext is not held"
+        self._held = False
+        self._root_scope.release()
+
+class _Collected(object):
+    """Everything a StopWatch collected during one root scope"""
+
+    __slots__ = ('values', 'self_values', 'histograms', 'traces', 'root_annotations',
+                 'slow_annotations', 'root_path', 'bucket_times')
+
+    def __init__(self, sw, root_path, bucket_times):
+        self.root_path = root_path
+        self.bucket_times = bucket_times if bucket_times is not None else {}
+        self.values = sw._reported_values
+        self.self_values = sw._reported_self_values
+        self.histograms = sw._reported_histograms
+        self.traces = sw._reported_traces
+        self.root_annotations = sw._root_annotations
+        self.slow_annotations = sw._slow_annotations
+
+    def merge(self, other):
+        """Merge the root scope of a child StopWatch into this one"""
+        values = self.values
+        for path, (delta, count, bucket) in other.values.items():
+            path_values = values.get(path)
+            if path_values is None:
+                values[path] = [delta, count, bucket]
+            else:
+                path_values[0] += delta
+                path_values[1] += count
+
+        self_values = self.self_values
+        for path, self_time in other.self_values.items():
+            self_values[path] = self_values.get(path, 0) + self_time
+
+        # The child ran on another thread, so its spans weren't seen by the enclosing
+        # spans: skip buckets already covered by one of them
+        for bucket, delta in other.bucket_times.items():
+            if not self._in_bucket(other.root_path.parent, bucket):
+                self.bucket_times[bucket] = self.bucket_times.get(bucket, 0) + delta
+
+        if self.histograms is not None and other.histograms:
+            for path, histogram in other.histograms.items():
+                if path in self.histograms:
+                    self.histograms[path].merge(histogram)
+                else:
+                    self.histograms[path] = histogram
+
+        self.traces.extend(other.traces)
+        self.root_annotations.extend(other.root_annotations)
+        self.slow_annotations.update(other.slow_annotations)
+
+    def _in_bucket(self, path, bucket):
+        """Whether path or any of its ancestors was ended with bucket"""
+        while path is not None:
+            values = self.values.get(path)
+            if values is not None and values[2] == bucket:
+                return True
+            path = path.parent
+        return False
+
+class _RootScope(object):
+    """
+    Collects the root scopes of child StopWatches (which may run on other threads) for
+    one root scope of a StopWatch, which is completed once it has ended and all its held
+    SpanContexts are released. Children only take the lock once, to hand over everything
+    they collected; merging happens when the root scope is completed.
+    """
+
+    __slots__ = ('_sw', '_lock', '_children', '_num_holds', '_finished', '_parent_held',
+                 'done', 'in_flight')
+
+    def __init__(self, sw):
+        self._sw = sw
+        self._lock = threading.Lock()
+        self._children = []
+        self._num_holds = 0
+        # (tr_data, tr_delta, _Collected) once the root scope has ended
+        self._finished = None
+        self._parent_held = False
+        # Set once completed, after which children can't be added anymore
+        self.done = False
+        # TimerData -> child StopWatches with an open root scope nested under that span
+        # on the span's thread. Only used from that thread, so it needs no lock.
+        self.in_flight = {}
+
+    def hold(self):
+        """Keep the root scope from completing until release(). Returns False if it
+        already completed."""
+        with self._lock:
+            if self.done:
+                return False
+            self._num_holds += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self._num_holds -= 1
+            if self._num_holds or self._finished is None:
+                return
+            self.done = True
+        self._complete()
+
+    def add_child(self, collected):
+        """Hand over the finished root scope of a child StopWatch. Returns False if this
+        root scope already completed."""
+        with self._lock:
+            if self.done:
+                return False
+            self._children.append(collected)
+            return True
+
+    def finish(self, tr_data, tr_delta, collected):
+        """Called when the root scope ends; completes it unless held"""
+        with self._lock:
+            self._finished = (tr_data, tr_delta, collected)
+            if self._num_holds:
+                # Also keep the parent_context's root scope open in the meantime
+                parent_context = self._sw._parent_context
+                if parent_context is not None:
+                    self._parent_held = parent_context._root_scope.hold()
+                return
+            self.done = True
+        self._complete()
+
+    def _complete(self):
+        tr_data, tr_delta, collected = self._finished
+        self._sw._complete_root(tr_data, tr_delta, collected, self._children, self._parent_held)
+
+class _NullTimer(object):
+    """Context manager which does nothing, used in place of a SpanTimer for spans
+    that are not timed"""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+NULL_TIMER = _NullTimer()
+
+# Process-wide kill switch, see set_enabled()
+_enabled = True
+
+def set_enabled(enabled):
+    """Turn all stopwatches on or off at runtime. While disabled, root scopes that
+    haven't started yet are skipped: start(), end() and the annotation methods only count
+    the nesting depth of the skipped scope and return right away, without reading the
+    clock. Spans within a skipped root scope are skipped too, even if stopwatches are
+    enabled before it ends, so the change takes effect at the next root scope. Root
+    scopes already running when the switch is flipped finish as usual. See also
+    StopWatch.enabled."""
+    global _enabled
+    _enabled = bool(enabled)
+
+def is_enabled():
+    """Returns whether stopwatches are enabled process-wide (see set_enabled)"""
+    return _enabled
+
+class _NullStopWatch(object):
+    """StopWatch which does nothing, with the whole public interface of a StopWatch, for
+    code which should not be instrumented at all"""
+
+    __slots__ = ()
+
+    enabled = False
+    context_manager_depth = 0
+    MAX_REQUEST_TRACING_SPANS_FOR_PATH = 0
+    TRACING_MIN_NUM_MILLISECONDS = 0
+    num_dropped_traces = 0
+    num_dropped_annotations = 0
+    num_collapsed_spans = 0
+
+    def timer(self, name, bucket=None, start_time=None, end_time=None):
+        return NULL_TIMER
+
+    def sampling_timer(self, name, p, *n, **kwargs):
+        return NULL_TIMER
+
+    def timed(self, name=None, bucket=None):
+        return lambda func: func
+
+    def start(self, name, start_time=None):
+        pass
+
+    def end(self, name, end_time=None, bucket=None):
+        pass
+
+    def cancel(self, name):
+        pass
+
+    def add_annotation(self, key, value='1', event_time=None):
+        pass
+
+    def add_span_annotation(self, key, value='1', event_time=None):
+        pass
+
+    def add_slow_annotation(self, tag, timelimit):
+        pass
+
+    def span_context(self, hold=False):
+        return None
+
+    def get_last_trace_report(self):
+        return None
+
+    def get_last_aggregated_report(self):
+        return None
+
+    def format_last_report(self):
+        return None
+
+NULL_STOPWATCH = _NullStopWatch()
+
+class ProbabilitySampler(object):
+    """trace_sampler which traces each root scope with probability p"""
+
+    def __init__(self, p):
+        self.p = p
+
+    def __call__(self, name):
+        return insecure_random.random() < self.p
+
+class AdaptiveSampler(object):
+    """
+    trace_sampler which aims for traces_per_second traced root scopes per second.
+
+    The sampling probability for each interval is derived from the root scope rate seen
+    in the previous one, so roots are sampled uniformly rather than first come first
+    served. Within an interval at most traces_per_second * interval roots are traced, so
+    trace volume stays flat during traffic spikes. Safe to share between threads.
+    """
+
+    def __init__(self, traces_per_second, interval=1.0, time_func=None):
+        self._max_traced = traces_per_second * interval
+        self._interval = interval
+        self._time_func = time_func or time.time
+        self._lock = threading.Lock()
+        self._interval_start = None
+        self._num_seen = 0
+        self._num_traced = 0
+        self.p = 1.0
+
+    def __call__(self, name):
+        with self._lock:
+            now = self._time_func()
+            if self._interval_start is None:
+                self._interval_start = now
+            elif now - self._interval_start >= self._interval:
+                # Scale the number of roots seen to one interval, in case of idle periods
+                expected = self._num_seen * self._interval / (now - self._interval_start)
+                self.p = min(1.0, self._max_traced / expected) if expected else 1.0
+                self._interval_start = now
+                self._num_seen = 0
+                self._num_traced = 0
+
+            self._num_seen += 1
+            if self._num_traced >= self._max_traced or insecure_random.random() >= self.p:
+                return False
+            self._num_traced += 1
+            return True
+
 def format_report(aggregated_report):
     """returns a pretty printed string of reported values"""
-    values = aggregated_report.aggregated_values
-    root_tr_data = aggregated_report.root_timer_data
+    # Any (aggregated_values, root_timer_data) tuple will do, the optional fields are
+    # only shown when present
+    values, root_tr_data = aggregated_report[:2]
+    self_values = getattr(aggregated_report, 'self_values', None)
+    overhead_ms = getattr(aggregated_report, 'overhead_ms', None)
+    bucket_totals = getattr(aggregated_report, 'bucket_totals', None)
 
     # fetch all values only for main stopwatch, ignore all the tags
     log_names = sorted(
@@ -97,7 +967,10 @@ def format_report(aggregated_report):
     root = log_names[0]
     root_time_ms, root_count, bucket = values[root]
     buf = [
-        "%s    %.3fms (%.f%%)" % (root.ljust(20), root_time_ms / root_count, 100),
+        "%s    %.3fms (%.f%%)%s" % (
+            root.ljust(20), root_time_ms / root_count, 100,
+            _format_self(self_values, root, root_time_ms, root_count),
+        ),
     ]
     for log_name in log_names[1:]:
         delta_ms, count, bucket = values[log_name]
@@ -105,12 +978,27 @@ def format_report(aggregated_report):
         short_name = log_name[log_name.rfind("#") + 1:]
         bucket_name = bucket.name if bucket else ""
 
-        buf.append("%s%s    %s %4d  %.3fms (%.f%%)" % (
+        buf.append("%s%s    %s %4d  %.3fms (%.f%%)%s" % (
             "    " * depth, bucket_name.ljust(12),
             short_name.ljust(20),
             count,
             delta_ms,
             delta_ms / root_time_ms * 100.0,
+            _format_self(self_values, log_name, root_time_ms),
+        ))
+
+    if overhead_ms is not None:
+        buf.append("Instrumentation overhead: %.3fms (%.f%%)" % (
+            overhead_ms / root_count,
+            overhead_ms / root_time_ms * 100.0,
+        ))
+
+    if bucket_totals:
+        buf.append("Buckets: %s" % ', '.join(
+            "%s %.3fms (%.f%%)" % (bucket.name, total_ms / root_count,
+                                   total_ms / root_time_ms * 100.0)
+            for bucket, total_ms in sorted(bucket_totals.items(),
+                                           key=lambda item: item[0].name)
         ))
 
     annotations = sorted(ann.key for ann in root_tr_data.trace_annotations)
@@ -118,6 +1006,48 @@ def format_report(aggregated_report):
         buf.append("Annotations: %s" % (', '.join(annotations)))
     return "\n".join(buf)
 
+def _format_self(self_values, log_name, root_time_ms, root_count=1):
+    """Self time column of format_report (empty for reports without self times)"""
+    if self_values is None or log_name not in self_values:
+        return ""
+    self_ms = self_values[log_name]
+    return "  self %.3fms (%.f%%)" % (self_ms / root_count, self_ms / root_time_ms * 100.0)
+
+def calibrate_overhead(time_func=None, num_spans=10000, repeat=5, monotonic_ns=False):
+    """Measures the instrumentation overhead of a start()/end() pair on the current
+    interpreter and time_func: the time in ms each span adds to its parent's duration
+    outside of its own. Pass the result as span_overhead_ms to StopWatch.
+    Arguments:
+        time_func: The time_func the StopWatch will use. Defaults to time.time
+            (or to time.perf_counter_ns with monotonic_ns)
+        num_spans: Number of spans to time per measurement
+        repeat: Number of measurements. The lowest one is used, as it has the least noise.
+        monotonic_ns: Calibrate for a StopWatch(monotonic_ns=True), whose time_func
+            returns integer nanoseconds
+    """
+    if monotonic_ns:
+        assert _perf_counter_ns is not None, "monotonic_ns requires Python 3.7+"
+        time_func = time_func or _perf_counter_ns
+    else:
+        time_func = time_func or time.time
+    best_ms = None
+    for _ in range(repeat):
+        sw = StopWatch(time_func=time_func, min_tracing_milliseconds=float('inf'),
+                       monotonic_ns=monotonic_ns)
+        sw.start('calibration')
+        root = sw._timer_stack[-1]
+        start_time = time_func()
+        for _ in range(num_spans):
+            sw.start('span')
+            sw.end('span')
+        # In the StopWatch's units: ms, or ns with monotonic_ns
+        elapsed = (time_func() - start_time) * sw._delta_scale
+        overhead_ms = max(elapsed - root.child_time, 0) * sw._ms_per_unit / num_spans
+        sw.end('calibration')
+        if best_ms is None or overhead_ms < best_ms:
+            best_ms = overhead_ms
+    return best_ms
+
 def default_export_tracing(reported_traces):
     """Default implementation of non-aggregated trace logging"""
     pass
@@ -141,7 +1071,18 @@ class StopWatch(object):
                  max_tracing_spans_for_path=1000,
                  min_tracing_milliseconds=3,
                  time_func=None,
-                 export_aggregated_timers_and_tracing_func=None):
+                 export_aggregated_timers_and_tracing_func=None,
+                 latency_histograms=False,
+                 counter_span_ids=False,
+                 parent_context=None,
+                 trace_sampler=None,
+                 span_overhead_ms=None,
+                 compensate_overhead=False,
+                 monotonic_ns=False,
+                 max_trace_spans=None,
+                 max_bytes=None,
+                 columnar_traces=False,
+                 enabled=True):
         """
         Arguments:
           strict_assert: If True, assert on callsite misuse
@@ -161,12 +1102,85 @@ class StopWatch(object):
 
           time_func:
             Function which returns the current time in seconds. Defaults to time.time
+            (or to time.perf_counter_ns with monotonic_ns)
 
           export_aggregated_timers_and_tracing_func:
             Function to export log timers and log tracing data when stack empties
+
+            The export functions are called with keyword arguments (reported_traces,
+            aggregated_report, or both), so any callable taking them will do, like the
+            exporters of the stopwatch_* modules. Unless its docs say otherwise, one
+            exporter may be shared by several stopwatches, on any threads.
+
+          latency_histograms:
+            If True, keep a LatencyHistogram of span durations for each unique path,
+            reported in AggregatedReport.histograms
+
+          counter_span_ids:
+            If True, span ids are a random 64 bit prefix (drawn once per root scope)
+            followed by a 64 bit counter, which is cheaper than 128 random bits per span.
+            Ids keep the same 32 hex character format either way.
+
+          parent_context:
+            Optional SpanContext of another StopWatch, which may be used on another
+            thread. Root scopes of this StopWatch are then nested under that span, and
+            if its root scope hasn't been exported yet when they complete, they are
+            merged into it instead of being exported. See span_context(hold=True).
+
+          trace_sampler:
+            Optional function called with the name of each root scope when it starts.
+            If it returns False, the whole root scope runs aggregate-only: no spans are
+            traced and add_span_annotation() does nothing. See ProbabilitySampler and
+            AdaptiveSampler. Stopwatches with a parent_context follow their parent's
+            decision instead.
+
+          span_overhead_ms:
+            Instrumentation overhead of one span, as measured by calibrate_overhead().
+            If set, every AggregatedReport includes the estimated total overhead of its
+            root scope in overhead_ms.
+
+          compensate_overhead:
+            If True (requires span_overhead_ms), subtract the estimated overhead of all
+            nested spans from each span's reported duration. Trace start and end times
+            (and so TimerData.self_ms) are left as measured.
+
+          monotonic_ns:
+            If True, spans are timed with time.perf_counter_ns: durations are exact
+            integer nanoseconds and immune to wall clock steps. Explicit start and end
+            times (and time_func) are then integer ns too. Reports are unaffected:
+            aggregated values are still exported in ms, and span times are converted
+            to seconds since the epoch once per root scope.
+
+          max_trace_spans:
+            Maximum number of traced spans kept per root scope (across all paths).
+
+          max_bytes:
+            Approximate memory budget for the traces, annotations and aggregated values
+            of a root scope. Once it is exceeded, the root scope degrades in order until
+            it fits again: all traces are dropped and no more are kept, then annotations,
+            and finally spans with paths not aggregated yet are collapsed into their
+            parent (their time only shows up in the parent's self time). See the
+            num_dropped_traces, num_dropped_annotations and num_collapsed_spans counters.
+
+          columnar_traces:
+            If True, the traces of each root scope are stored in a TraceBuffer instead of
+            a list of TimerData, which takes less memory and leaves fewer objects for the
+            garbage collector to track. Exporters receive the TraceBuffer.
+
+          enabled:
+            Initial value of the enabled attribute, which can be flipped at runtime. While
+            it is False (or stopwatches are disabled process-wide with set_enabled), new
+            root scopes are not timed, see set_enabled().
         """
 
         self._timer_stack = []
+        self.enabled = enabled
+        # Number of start() calls skipped while disabled whose end() is still to come
+        self._disabled_depth = 0
+        # With a parent_context on this thread: the in flight siblings of the current
+        # root scope (see _RootScope.in_flight), and whether any ran at the same time
+        self._siblings = None
+        self._overlapped = False
         self._strict_assert = strict_assert
         self._export_tracing_func = export_tracing_func or default_export_tracing
         self._export_aggregated_timers_func = (
@@ -176,11 +1190,56 @@ class StopWatch(object):
             export_aggregated_timers_and_tracing_func
             or default_export_aggregated_timers_and_tracing
         )
-        self._time_func = time_func or time.time
+        self._monotonic_ns = monotonic_ns
+        if monotonic_ns:
+            assert _perf_counter_ns is not None, "monotonic_ns requires Python 3.7+"
+            self._time_func = time_func or _perf_counter_ns
+            # Multiplier from a difference of time_func values to a duration, and from
+            # a duration to ms
+            self._delta_scale = 1
+            self._ms_per_unit = 1e-6
+            self._min_delta = 1
+        else:
+            self._time_func = time_func or time.time
+            self._delta_scale = 1000.0
+            self._ms_per_unit = 1.0
+            self._min_delta = 0.001
+        # Annotation times are always seconds since the epoch
+        self._annotation_time_func = time.time if monotonic_ns else self._time_func
+        self._columnar_traces = columnar_traces
+        self._max_trace_spans = float('inf') if max_trace_spans is None else max_trace_spans
+        self._max_bytes = float('inf') if max_bytes is None else max_bytes
+        # Counters of what was dropped to stay within max_trace_spans and max_bytes
+        self.num_dropped_traces = 0
+        self.num_dropped_annotations = 0
+        self.num_collapsed_spans = 0
         self.MAX_REQUEST_TRACING_SPANS_FOR_PATH = max_tracing_spans_for_path
         self.TRACING_MIN_NUM_MILLISECONDS = min_tracing_milliseconds
         self._last_trace_report = None
         self._last_aggregated_report = None
+        self._latency_histograms = latency_histograms
+        self._new_span_id = self._next_counter_span_id if counter_span_ids else random_span_id
+        self._parent_context = parent_context
+        self._trace_sampler = trace_sampler
+        assert span_overhead_ms is not None or not compensate_overhead, \
+            "compensate_overhead requires span_overhead_ms"
+        self._span_overhead_ms = span_overhead_ms
+        self._compensate_overhead = compensate_overhead
+        if compensate_overhead:
+            self._span_overhead = span_overhead_ms / self._ms_per_unit
+            if monotonic_ns:
+                self._span_overhead = int(round(self._span_overhead))
+        # Whether the current root scope is traced
+        self._trace_root = True
+        if parent_context is not None:
+            assert parent_context.stopwatch._monotonic_ns == monotonic_ns, \
+                "StopWatch and its parent_context must use the same clock"
+            # Share interned paths, so that merged values use the same keys
+            self._paths = parent_context.stopwatch._paths
+            self._root_parent_path = parent_context.timer_data.path
+        else:
+            self._paths = SpanPathTree()
+            self._root_parent_path = None
 
         # Verifies how deep inside a context manager the current stopwatch is.
         self.context_manager_depth = 0
@@ -193,9 +1252,19 @@ class StopWatch(object):
             assert not self._strict_assert, \
                 "StopWatch reset() but stack not empty: %r" % (self._timer_stack,)
         self._reported_values = {}
-        self._reported_traces = []
+        self._reported_self_values = {}
+        self._reported_traces = self._new_traces()
+        self._reported_histograms = {} if self._latency_histograms else None
         self._root_annotations = []
         self._slow_annotations = {}
+        self._span_id_prefix = None
+        self._span_id_counter = 0
+        # Created by span_context(), to collect child StopWatches
+        self._root_scope = None
+        # Approximate memory used by the root scope, and how far it degraded to stay
+        # within max_bytes
+        self._used_bytes = 0
+        self._degradation = 0
 
         # Dictionary of span names that have been cancelled in the current
         # context. Used to ensure that a cancelled span is not redundantly ended as well.
@@ -204,28 +1273,36 @@ class StopWatch(object):
     ################
     # Public methods
     ################
-    @contextlib.contextmanager
     def sampling_timer(self, name, p, *n, **kwargs):
         """Context manager that will time the context with probability p."""
+        if not (_enabled and self.enabled) and not self._timer_stack:
+            # Skipped as a whole, see timer()
+            return self.timer(name, *n, **kwargs)
         if p > insecure_random.uniform(0.0, 1.0):
-            with self.timer(name, *n, **kwargs):
-                yield
-        else:
-            yield
+            return self.timer(name, *n, **kwargs)
+        return NULL_TIMER
 
-    @contextlib.contextmanager
     def timer(self, name, bucket=None, start_time=None, end_time=None):
-        """Context manager to wrap a stopwatch span"""
-        self.start(name, start_time=start_time)
-        self.context_manager_depth += 1
-        try:
-            yield
-        except Exception as e:
-            self.add_annotation('Exception', type(e).__name__, event_time=end_time)
-            raise
-        finally:
-            self.context_manager_depth -= 1
-            self.end(name, end_time=end_time, bucket=bucket)
+        """Context manager to wrap a stopwatch span. The returned SpanTimer can be kept
+        and re-entered to avoid creating one per span. While the stopwatch is disabled,
+        a root scope entered with it is skipped as a whole (see start())."""
+        return SpanTimer(self, name, bucket, start_time, end_time)
+
+    def timed(self, name=None, bucket=None):
+        """Decorator which wraps every call of the function in a stopwatch span
+        Arguments:
+            name: Name of the span. Defaults to the function name.
+            bucket: optional enum.Enum value, see end()
+        """
+        def decorator(func):
+            span_timer = SpanTimer(self, name or func.__name__, bucket)
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with span_timer:
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
 
     def start(self, name, start_time=None):
         """Begin a stopwatch span
@@ -235,13 +1312,23 @@ class StopWatch(object):
             start_time:
                 Time (s) at which the scope began if set. (if not, use the current time)
         """
+        if self._disabled_depth or (not self._timer_stack and not (_enabled and self.enabled)):
+            # Skip the whole root scope, even if the stopwatch is enabled before it ends
+            self._disabled_depth += 1
+            return
         if start_time is None:
             start_time = self._time_func()
-        self._timer_stack.append(TimerData(
-            name=name,
-            start_time=start_time,
-            parent_name=self._timer_stack[-1].log_name if self._timer_stack else None
-        ))
+        if self._timer_stack:
+            path = self._timer_stack[-1].path.child(name)
+        elif self._root_parent_path is not None:
+            path = self._root_parent_path.child(name)
+            self._trace_root = self._parent_context.stopwatch._trace_root
+            self._start_nested_root()
+        else:
+            path = self._paths.root(name)
+            if self._trace_sampler is not None:
+                self._trace_root = bool(self._trace_sampler(name))
+        self._timer_stack.append(TimerData(path, start_time))
 
     def end(self, name, end_time=None, bucket=None):
         """End a stopwatch span (must match latest started span)
@@ -263,12 +1350,16 @@ class StopWatch(object):
                 self._cancelled_spans.remove(name)
             return
 
+        if self._disabled_depth:
+            self._disabled_depth -= 1
+            return
+
         if not end_time:
             end_time = self._time_func()
 
         tr_data = self._pop_stack(name)
         tr_data.end_time = end_time
-        log_name = tr_data.log_name
+        path = tr_data.path
 
         # Aggregate into a single bucket per concatenated log name. This makes sure that code like
         # the following code stopwatches as expected.
@@ -276,41 +1367,93 @@ class StopWatch(object):
         # with StopWatch.timer('cool_loop_time'):
         #     for x in cool_loop:
         #         cool_stuff(x)
-        tr_delta_ms = max((tr_data.end_time - tr_data.start_time) * 1000.0, 0.001)
-        if log_name in self._reported_values:
-            self._reported_values[log_name][0] += tr_delta_ms
-            self._reported_values[log_name][1] += 1
+        #
+        # Durations are kept in ms, or in integer ns with monotonic_ns.
+        tr_delta = (tr_data.end_time - tr_data.start_time) * self._delta_scale
+        if self._compensate_overhead:
+            tr_delta -= tr_data.num_descendants * self._span_overhead
+        if tr_delta < self._min_delta:
+            tr_delta = self._min_delta
+
+        # Time per bucket: a span covers the time of its descendants in its own bucket,
+        # so nested spans of the same bucket aren't counted twice
+        bucket_times = tr_data.bucket_times
+        if bucket is not None:
+            if bucket_times is None:
+                bucket_times = tr_data.bucket_times = {}
+            bucket_times[bucket] = tr_delta
+        if bucket_times and self._timer_stack:
+            _add_bucket_times(self._timer_stack[-1], bucket_times)
+
+        values = self._reported_values.get(path)
+        if values is not None:
+            values[0] += tr_delta
+            values[1] += 1
+        elif self._degradation < _COLLAPSE_PATHS or not self._timer_stack or tr_data.child_time:
+            self._reported_values[path] = [tr_delta, 1, bucket]
+            self._add_used_bytes(_PATH_BYTES)
         else:
-            self._reported_values[log_name] = [tr_delta_ms, 1, bucket]
-
-        # go through slow tags and add them as tags if enough time has passed
-        if not self._timer_stack:
-            tr_data.trace_annotations.extend(self._root_annotations)
-
-            threshold_s = tr_delta_ms / 1000.0
-            for slowtag, timelimit in self._slow_annotations.items():
-                if timelimit <= threshold_s:
-                    tr_data.trace_annotations.append(
-                        TraceAnnotation(slowtag, '1', tr_data.end_time)
-                    )
+            # Over the memory budget: leave the time of the span (which has no aggregated
+            # children) to its parent
+            self.num_collapsed_spans += 1
+            self._timer_stack[-1].num_descendants += tr_data.num_descendants + 1
+            return
 
-        if self._should_trace_timer(log_name, tr_delta_ms):
-            tr_data.parent_span_id = self._timer_stack[-1].span_id if self._timer_stack else None
+        # Exclusive time: every span subtracts its duration from its parent's. It can
+        # only come out negative when compensate_overhead overestimates the overhead.
+        self_time = tr_delta - tr_data.child_time
+        if self_time < 0:
+            self_time = 0.0
+        self_values = self._reported_self_values
+        self_values[path] = self_values.get(path, 0) + self_time
+        if self._timer_stack:
+            parent = self._timer_stack[-1]
+            parent.child_time += tr_delta
+            parent.num_descendants += tr_data.num_descendants + 1
+
+        if self._reported_histograms is not None:
+            histogram = self._reported_histograms.get(path)
+            if histogram is None:
+                histogram = self._reported_histograms[path] = LatencyHistogram()
+            histogram.add(tr_delta * self._ms_per_unit)
+
+        # A root scope nested under an open span on the same thread (e.g. of an asyncio
+        # task) counts as that span's child, unless it ran at the same time as a sibling
+        # (e.g. tasks of asyncio.gather) - like root scopes on other threads, which run
+        # in parallel.
+        parent_context = self._parent_context
+        if (not self._timer_stack and parent_context is not None
+                and self._end_nested_root() and parent_context.is_open()):
+            parent = parent_context.timer_data
+            parent.child_time += tr_delta
+            parent.num_descendants += tr_data.num_descendants + 1
+            if bucket_times:
+                _add_bucket_times(parent, bucket_times)
+                bucket_times = None
+
+        if self._trace_root and self._should_trace_timer(path, tr_delta * self._ms_per_unit):
+            if tr_data._span_id is None:
+                tr_data._span_id = self._new_span_id()
+            if self._timer_stack:
+                tr_data.parent_span_id = self._get_span_id(self._timer_stack[-1])
+            elif parent_context is not None:
+                tr_data.parent_span_id = parent_context.span_id
+                # The root scope is exported on its own if the parent's finished first
+                tr_data.trace_id = parent_context.trace_id
             self._reported_traces.append(tr_data)
+            self._add_used_bytes(_TRACE_BYTES)
+        elif tr_data.trace_annotations:
+            self._used_bytes -= len(tr_data.trace_annotations) * _ANNOTATION_BYTES
 
         # report stopwatch values once the final 'end' call has been made
         if not self._timer_stack:
-            agg_report = AggregatedReport(self._reported_values, tr_data)
-            # Stash information internally
-            self._last_trace_report = self._reported_traces
-            self._last_aggregated_report = agg_report
-            # Hit callbacks
-            self._export_tracing_func(reported_traces=self._reported_traces)
-            self._export_aggregated_timers_func(aggregated_report=agg_report)
-            self._export_aggregated_timers_and_tracing_func(aggregated_report=agg_report,
-                                                            reported_traces=self._reported_traces)
-
+            collected = _Collected(self, path, bucket_times)
+            root_scope = self._root_scope
             self._reset()  # Clear out stats to prevent duplicate reporting
+            if root_scope is None:
+                self._complete_root(tr_data, tr_delta, collected)
+            else:
+                root_scope.finish(tr_data, tr_delta, collected)
 
     def cancel(self, name):
         """Cancels a stopwatch span (must match latest started span).
@@ -319,13 +1462,21 @@ class StopWatch(object):
             name:
                 Name of the scope that's being cancelled. Must match the latest start().
         """
+        if not self._timer_stack and not self._disabled_depth and not (_enabled and self.enabled):
+            # Nothing was started, e.g. in a timer() of a disabled stopwatch
+            return
         if self.context_manager_depth > 0:
             # We only care about keeping track of spans that we are cancelling while
             # in the timer() context manager, due to . Outside of the context manager, it will
             # be up to the Stopwatch end-user to ensure they are not cancelling spans
             # redundantly.
             self._cancelled_spans.add(name)
+        if self._disabled_depth:
+            self._disabled_depth -= 1
+            return
         self._pop_stack(name)
+        if not self._timer_stack and self._siblings is not None:
+            self._end_nested_root()
 
     def add_annotation(self, key, value='1', event_time=None):
         """Add an annotation to the root scope. Note that we don't do this directly
@@ -337,19 +1488,32 @@ class StopWatch(object):
             do_work(x)
 
         """
+        if not self._timer_stack and (self._disabled_depth or not (_enabled and self.enabled)):
+            return
+        if self._degradation >= _DROP_ANNOTATIONS:
+            self.num_dropped_annotations += 1
+            return
         if event_time is None:
-            event_time = self._time_func()
+            event_time = self._annotation_time_func()
         self._root_annotations.append(
             TraceAnnotation(key, value, event_time)
         )
+        self._add_used_bytes(_ANNOTATION_BYTES)
 
     def add_span_annotation(self, key, value='1', event_time=None):
         """Add an annotation to the current scope"""
+        if not self._trace_root or not self._timer_stack:
+            # No open scope, e.g. in a timer() of a disabled stopwatch
+            return
+        if self._degradation >= _DROP_ANNOTATIONS:
+            self.num_dropped_annotations += 1
+            return
         if event_time is None:
-            event_time = self._time_func()
+            event_time = self._annotation_time_func()
         self._timer_stack[-1].trace_annotations.append(
             TraceAnnotation(key, value, event_time)
         )
+        self._add_used_bytes(_ANNOTATION_BYTES)
 
     def add_slow_annotation(self, tag, timelimit):
         """add annotation that will only be used if root scope takes longer than
@@ -358,14 +1522,30 @@ class StopWatch(object):
             tag: String tag name for the slowtag
             timelimit: Lower bound for the root scope after which tag is applied
         """
+        if not self._timer_stack and (self._disabled_depth or not (_enabled and self.enabled)):
+            return
         self._slow_annotations[tag] = timelimit
 
+    def span_context(self, hold=False):
+        """Returns a SpanContext for the innermost open span (None if there is none).
+        Pass it as parent_context to another StopWatch to nest its spans under this one.
+
+        With hold=True, the current root scope is not exported (even once it ends) until
+        SpanContext.release() is called, e.g. by a worker thread once it is done. Every
+        held SpanContext must be released exactly once."""
+        if not self._timer_stack:
+            return None
+        if self._root_scope is None:
+            self._root_scope = _RootScope(self)
+        return SpanContext(self, self._timer_stack[-1], hold)
+
     def get_last_trace_report(self):
         """Returns the last trace report from when the last root_scope completed"""
         return self._last_trace_report
 
     def get_last_aggregated_report(self):
-        """Returns the last aggregated report and tags as a 2-tuple"""
+        """Returns the AggregatedReport of the last root scope, which unpacks as the
+        2-tuple (aggregated_values, root_timer_data)"""
         return self._last_aggregated_report
 
     def format_last_report(self):
@@ -401,7 +1581,119 @@ class StopWatch(object):
             tr_data = self._timer_stack.pop()
         return tr_data
 
-    def _should_trace_timer(self, log_name, delta_ms):
+    def _complete_root(self, tr_data, tr_delta, collected, children=(), parent_held=False):
+        """Merge the finished root scope into the parent_context's root scope if that is
+        still running, otherwise export it.
+        Arguments:
+            collected: _Collected of the root scope
+            children: _Collected of the child StopWatches attached to it
+            parent_held: Whether the root scope holds the parent_context's root scope open
+        """
+        for child in children:
+            collected.merge(child)
+
+        parent_context = self._parent_context
+        if parent_context is not None:
+            attached = parent_context._root_scope.add_child(collected)
+            if parent_held:
+                parent_context._root_scope.release()
+            if attached:
+                return
+
+        if self._monotonic_ns:
+            self._to_wall_clock(collected.traces, tr_data)
+
+        # go through slow tags and add them as tags if enough time has passed
+        tr_data.trace_annotations.extend(collected.root_annotations)
+        threshold_s = tr_delta * self._ms_per_unit / 1000.0
+        for slowtag, timelimit in collected.slow_annotations.items():
+            if timelimit <= threshold_s:
+                tr_data.trace_annotations.append(
+                    SlowTraceAnnotation(slowtag, '1', tr_data.end_time)
+                )
+
+        histograms = collected.histograms
+        aggregated_values = _by_log_name(collected.values, _merge_values)
+        self_values = _by_log_name(collected.self_values, _merge_sums)
+        if self._monotonic_ns:
+            aggregated_values, self_values = _ns_to_ms(aggregated_values, self_values)
+        agg_report = AggregatedReport(
+            aggregated_values,
+            tr_data,
+            _by_log_name(histograms, _merge_histograms) if histograms is not None else None,
+            self_values,
+            (tr_data.num_descendants * self._span_overhead_ms
+             if self._span_overhead_ms is not None else None),
+            {bucket: delta * self._ms_per_unit
+             for bucket, delta in collected.bucket_times.items()},
+        )
+        # Stash information internally
+        self._last_trace_report = collected.traces
+        self._last_aggregated_report = agg_report
+        # Hit callbacks
+        self._export_tracing_func(reported_traces=collected.traces)
+        self._export_aggregated_timers_func(aggregated_report=agg_report)
+        self._export_aggregated_timers_and_tracing_func(aggregated_report=agg_report,
+                                                        reported_traces=collected.traces)
+
+    def _to_wall_clock(self, traces, root_tr_data):
+        """Convert the perf_counter_ns times of a finished root scope's spans to seconds
+        since the epoch (and their child time to ms), anchoring the clocks once"""
+        offset_ns = _time_ns() - _perf_counter_ns()
+        if isinstance(traces, TraceBuffer):
+            traces._to_wall_clock(offset_ns)
+            traces = list(traces._objects.values())
+        untraced_root = () if root_tr_data in traces else (root_tr_data,)
+        for tr_data in itertools.chain(traces, untraced_root):
+            tr_data.start_time = (tr_data.start_time + offset_ns) / 1e9
+            tr_data.end_time = (tr_data.end_time + offset_ns) / 1e9
+            tr_data.child_time /= 1e6
+
+    def _new_traces(self):
+        if self._columnar_traces:
+            return TraceBuffer(self._root_parent_path, self._monotonic_ns)
+        return []
+
+    def _get_span_id(self, tr_data):
+        """Returns the span id of tr_data, allocating one with this StopWatch's scheme"""
+        if tr_data._span_id is None:
+            tr_data._span_id = self._new_span_id()
+        return tr_data._span_id
+
+    def _start_nested_root(self):
+        """Register a root scope starting under the parent_context's span. On the span's
+        thread, it and the sibling root scopes still in flight are marked as overlapping."""
+        parent_context = self._parent_context
+        self._overlapped = False
+        if parent_context._thread_ident != _get_ident():
+            return
+        siblings = parent_context._root_scope.in_flight.setdefault(
+            parent_context.timer_data, [])
+        if siblings:
+            self._overlapped = True
+            for sibling in siblings:
+                sibling._overlapped = True
+        siblings.append(self)
+        self._siblings = siblings
+
+    def _end_nested_root(self):
+        """Unregister the root scope from _start_nested_root(). Returns whether it ran on
+        the parent_context's thread without overlapping a sibling."""
+        siblings = self._siblings
+        if siblings is None:
+            return False
+        self._siblings = None
+        siblings.remove(self)
+        return not self._overlapped
+
+    def _next_counter_span_id(self):
+        """Span id generator used when counter_span_ids is set"""
+        if self._span_id_prefix is None:
+            self._span_id_prefix = '%016x' % insecure_random.getrandbits(64)
+        self._span_id_counter += 1
+        return '%s%016x' % (self._span_id_prefix, self._span_id_counter)
+
+    def _should_trace_timer(self, path, delta_ms):
         """
         Helper method to determine if we should log the message or not.
         """
@@ -413,7 +1705,43 @@ class StopWatch(object):
         # is making for loop with 50k stopwatches, we will log only the first
         # MAX_REQUEST_TRACING_SPANS_FOR_PATH spans.
 
-        return bool(
-            log_name not in self._reported_values
-            or self._reported_values[log_name][1] <= self.MAX_REQUEST_TRACING_SPANS_FOR_PATH
-        )
+        values = self._reported_values.get(path)
+        if values is not None and values[1] > self.MAX_REQUEST_TRACING_SPANS_FOR_PATH:
+            return False
+
+        # Root spans are always kept, for exporters which need them
+        if self._timer_stack and (self._degradation
+                                  or len(self._reported_traces) >= self._max_trace_spans):
+            self.num_dropped_traces += 1
+            return False
+        return True
+
+    def _add_used_bytes(self, num_bytes):
+        self._used_bytes += num_bytes
+        if self._used_bytes > self._max_bytes:
+            self._degrade()
+
+    def _degrade(self):
+        """Degrade the current root scope until it is back within max_bytes: drop the
+        traces, then the annotations, then stop adding paths"""
+        while self._used_bytes > self._max_bytes and self._degradation < _COLLAPSE_PATHS:
+            self._degradation += 1
+            if self._degradation == _DROP_TRACES:
+                for tr_data in self._reported_traces:
+                    self._used_bytes -= (_TRACE_BYTES
+                                         + len(tr_data.trace_annotations) * _ANNOTATION_BYTES)
+                self.num_dropped_traces += len(self._reported_traces)
+                self._reported_traces = self._new_traces()
+            elif self._degradation == _DROP_ANNOTATIONS:
+                num_annotations = len(self._root_annotations)
+                for tr_data in self._timer_stack:
+                    num_annotations += len(tr_data.trace_annotations)
+                    tr_data.trace_annotations = []
+                self._root_annotations = []
+                self.num_dropped_annotations += num_annotations
+                self._used_bytes -= num_annotations * _ANNOTATION_BYTES
+
+if __name__ == '__main__':
+    import sys
+    import stopwatch_cli
+    sys.exit(stopwatch_cli.main())
@@ -0,0 +1,194 @@
+"""StopWatch - library for adding timers and tags in your code for performance monitoring
+https://github.com/dropbox/stopwatch
+
+This module provides a rolling aggregator which merges the AggregatedReport of every
+root scope into time-windowed buckets, so callers don't have to write their own
+accumulator inside export_aggregated_timers_func.
+
+For example:
+```
+aggregator = RollingAggregator(window_seconds=60, num_windows=5)
+sw = StopWatch(export_aggregated_timers_func=aggregator)
+...
+for log_name, stats in aggregator.merged().items():
+    print(log_name, stats.count, stats.total_ms / stats.count)
+```
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import threading
+
+AggregatedStats = collections.namedtuple('AggregatedStats',
+                                         ['count', 'total_ms', 'min_ms', 'max_ms', 'bucket'])
+
+# Indices into the mutable per-path stats lists. Lists are merged in place to keep the
+# per-root cost down to a few additions per path.
+_COUNT = 0
+_TOTAL_MS = 1
+_MIN_MS = 2
+_MAX_MS = 3
+
+class AggregationWindow(object):
+    """All reports whose root scope ended within [start_time, start_time + window_seconds)"""
+
+    __slots__ = ('start_time', 'end_time', 'num_roots', '_values', '_histograms')
+
+    def __init__(self, start_time, end_time):
+        self.start_time = start_time
+        self.end_time = end_time
+        self.num_roots = 0
+        self._values = {}
+        self._histograms = {}
+
+    def merge(self, aggregated_values, histograms=None):
+        """Merge the aggregated values (and optionally the LatencyHistograms) of a single
+        root scope into this window"""
+        self.num_roots += 1
+        if histograms:
+            window_histograms = self._histograms
+            for log_name, histogram in histograms.items():
+                existing = window_histograms.get(log_name)
+                if existing is None:
+                    window_histograms[log_name] = histogram.copy()
+                else:
+                    existing.merge(histogram)
+
+        window_values = self._values
+        for log_name, (delta_ms, count, bucket) in aggregated_values.items():
+            stats = window_values.get(log_name)
+            if stats is None:
+                window_values[log_name] = [count, delta_ms, delta_ms, delta_ms, bucket]
+                continue
+            stats[_COUNT] += count
+            stats[_TOTAL_MS] += delta_ms
+            if delta_ms < stats[_MIN_MS]:
+                stats[_MIN_MS] = delta_ms
+            if delta_ms > stats[_MAX_MS]:
+                stats[_MAX_MS] = delta_ms
+
+    def values(self):
+        """Returns a dict of log_name -> AggregatedStats for this window"""
+        return {log_name: AggregatedStats(*stats) for log_name, stats in self._values.items()}
+
+    def histograms(self):
+        """Returns a dict of log_name -> LatencyHistogram for this window. Only filled in
+        when the reporting StopWatch tracks latency histograms."""
+        return {log_name: histogram.copy() for log_name, histogram in self._histograms.items()}
+
+    def __repr__(self):
+        return 'AggregationWindow(start_time=%r, end_time=%r, num_roots=%r)' % (
+            self.start_time, self.end_time, self.num_roots)
+
+def merge_stats(into, values):
+    """Merge a dict of log_name -> AggregatedStats into another such dict (in place)"""
+    for log_name, stats in values.items():
+        existing = into.get(log_name)
+        if existing is None:
+            into[log_name] = stats
+        else:
+            into[log_name] = AggregatedStats(
+                existing.count + stats.count,
+                existing.total_ms + stats.total_ms,
+                min(existing.min_ms, stats.min_ms),
+                max(existing.max_ms, stats.max_ms),
+                existing.bucket if existing.bucket is not None else stats.bucket,
+            )
+    return into
+
+class RollingAggregator(object):
+    """Merges AggregatedReports across root scopes into a ring of time windows.
+
+    Per log_name it keeps the total number of spans, the total time and the min/max time
+    a single root scope spent in that path.
+    """
+
+    def __init__(self, window_seconds=60, num_windows=1, rollover_func=None):
+        """
+        Arguments:
+          window_seconds: Width of each window, in the units of the StopWatch time_func.
+
+          num_windows: Number of windows (including the current one) to retain.
+
+          rollover_func:
+            Optional function called with an AggregationWindow once a newer window has
+            started. Reports arriving late for a window are still merged into it as long
+            as it is retained, but will not trigger another rollover_func call.
+        """
+        assert window_seconds > 0, "window_seconds must be positive"
+        assert num_windows >= 1, "num_windows must be at least 1"
+        self._window_seconds = window_seconds
+        self._num_windows = num_windows
+        self._rollover_func = rollover_func
+        self._windows = collections.deque()
+        self._lock = threading.Lock()
+        # Reports which didn't fall into any retained window (e.g. older than the oldest)
+        self.num_late_reports = 0
+
+    def __call__(self, aggregated_report):
+        self.add_report(aggregated_report)
+
+    def add_report(self, aggregated_report):
+        """Merge the aggregated values of a finished root scope into its window"""
+        end_time = aggregated_report.root_timer_data.end_time
+        window_start = (end_time // self._window_seconds) * self._window_seconds
+        with self._lock:
+            window, rolled_over = self._window_for(window_start)
+            if window is None:
+                self.num_late_reports += 1
+                return
+            window.merge(aggregated_report.aggregated_values, aggregated_report.histograms)
+
+        if rolled_over is not None and self._rollover_func is not None:
+            self._rollover_func(rolled_over)
+
+    def windows(self):
+        """Returns the retained windows, oldest first"""
+        with self._lock:
+            return list(self._windows)
+
+    def merged(self):
+        """Returns a dict of log_name -> AggregatedStats merged over all retained windows"""
+        merged = {}
+        for window in self.windows():
+            with self._lock:
+                values = window.values()
+            merge_stats(merged, values)
+        return merged
+
+    def merged_histograms(self):
+        """Returns a dict of log_name -> LatencyHistogram merged over all retained windows"""
+        merged = {}
+        for window in self.windows():
+            with self._lock:
+                histograms = window.histograms()
+            for log_name, histogram in histograms.items():
+                if log_name in merged:
+                    merged[log_name].merge(histogram)
+                else:
+                    merged[log_name] = histogram
+        return merged
+
+    def _window_for(self, window_start):
+        """Returns a (window, rolled_over_window) tuple for window_start. The window is
+        created (evicting the oldest windows) if it is newer than every retained window,
+        in which case the previously newest window is returned as rolled over.
+        Must hold _lock."""
+        windows = self._windows
+        if not windows or window_start > windows[-1].start_time:
+            rolled_over = windows[-1] if windows else None
+            windows.append(AggregationWindow(window_start, window_start + self._window_seconds))
+            while len(windows) > self._num_windows:
+                windows.popleft()
+            return windows[-1], rolled_over
+
+        # Late report - windows are few, so a linear scan from the newest one is cheap.
+        for window in reversed(windows):
+            if window.start_time == window_start:
+                return window, None
+            if window.start_time < window_start:
+                break
+        return None, None
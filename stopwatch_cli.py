@@ -0,0 +1,298 @@
+"""StopWatch - library for adding timers and tags in your code for performance monitoring
+https://github.com/dropbox/stopwatch
+
+Command line analysis of exported stopwatch data, run as `python -m stopwatch`.
+
+Inputs are either aggregated reports written as JSON lines by JsonLinesReportWriter,
+or binary trace logs written by stopwatch_tracelog.TraceLogWriter (aggregated from their
+traced spans, so subject to the StopWatch tracing limits). Inputs are streamed one root
+scope at a time, so memory only grows with the number of distinct paths.
+
+```
+python -m stopwatch folded reports.jsonl > folded.txt   # flamegraph.pl folded.txt
+python -m stopwatch top -n 20 --by self reports.jsonl
+python -m stopwatch buckets reports.jsonl
+python -m stopwatch diff before.jsonl after.jsonl
+```
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+import sys
+import threading
+
+from stopwatch_tracelog import (
+    _MAGIC as _TRACE_LOG_MAGIC,
+    TraceLogReader,
+)
+
+class JsonLinesReportWriter(object):
+    """Writes every AggregatedReport as one JSON line, for analysis with this CLI"""
+
+    def __init__(self, fileobj):
+        """
+        Arguments:
+          fileobj: Path or text file-like object to write to.
+        """
+        if isinstance(fileobj, str):
+            self._file = open(fileobj, 'a')
+            self._owns_file = True
+        else:
+            self._file = fileobj
+            self._owns_file = False
+        self._lock = threading.Lock()
+
+    def __call__(self, aggregated_report):
+        self.write(aggregated_report)
+
+    def write(self, aggregated_report):
+        root = aggregated_report.root_timer_data
+        report = {
+            'root': root.name,
+            'start_time': root.start_time,
+            'end_time': root.end_time,
+            'values': {
+                log_name: [delta_ms, count, bucket.name if bucket is not None else None]
+                for log_name, (delta_ms, count, bucket)
+                in aggregated_report.aggregated_values.items()
+            },
+        }
+        if aggregated_report.self_values is not None:
+            report['self_values'] = aggregated_report.self_values
+        if aggregated_report.bucket_totals is not None:
+            report['bucket_totals'] = {
+                bucket.name: total_ms
+                for bucket, total_ms in aggregated_report.bucket_totals.items()
+            }
+        line = json.dumps(report, sort_keys=True)
+        with self._lock:
+            self._file.write(line + '\n')
+
+    def close(self):
+        with self._lock:
+            if self._owns_file:
+                self._file.close()
+            else:
+                self._file.flush()
+
+def read_reports(path):
+    """Iterate over (root name, {log_name: (total_ms, count, bucket name)},
+    {log_name: self_ms} or None, {bucket name: total_ms} or None) for every root scope
+    in a JSON lines report file ('-' for stdin) or binary trace log"""
+    if path == '-':
+        for report in _read_json_lines(sys.stdin):
+            yield report
+        return
+
+    with open(path, 'rb') as f:
+        is_trace_log = f.read(len(_TRACE_LOG_MAGIC)) == _TRACE_LOG_MAGIC
+    if is_trace_log:
+        for report in _read_trace_log(path):
+            yield report
+    else:
+        with open(path) as f:
+            for report in _read_json_lines(f):
+                yield report
+
+def _read_json_lines(f):
+    for line in f:
+        if line.strip():
+            report = json.loads(line)
+            yield (report['root'], report['values'], report.get('self_values'),
+                   report.get('bucket_totals'))
+
+def _read_trace_log(path):
+    reader = TraceLogReader(path)
+    try:
+        for root in reader.roots():
+            values = {}
+            for span in reader.spans(root):
+                delta_ms = (span.end_time - span.start_time) * 1000.0
+                stats = values.get(span.log_name)
+                if stats is None:
+                    values[span.log_name] = [delta_ms, 1, None]
+                else:
+                    stats[0] += delta_ms
+                    stats[1] += 1
+            yield root.name, values, None, None
+    finally:
+        reader.close()
+
+class Capture(object):
+    """Per-path totals accumulated over any number of root scopes"""
+
+    def __init__(self):
+        self.num_roots = 0
+        # log_name -> [total_ms, count, bucket name]
+        self.values = {}
+        # log_name -> self_ms
+        self._self_values = {}
+        # bucket name -> total_ms
+        self._bucket_totals = {}
+
+    @classmethod
+    def from_files(cls, paths):
+        capture = cls()
+        for path in paths:
+            for _, values, self_values, bucket_totals in read_reports(path):
+                capture.add(values, self_values, bucket_totals)
+        return capture
+
+    def add(self, values, self_values=None, bucket_totals=None):
+        """Add the values of one root scope. Without self times or bucket totals (e.g.
+        from trace logs) they are derived from the values of each path's relatives."""
+        self.num_roots += 1
+        if self_values is None:
+            self_values = _self_times(values)
+        for log_name, self_ms in self_values.items():
+            self._self_values[log_name] = self._self_values.get(log_name, 0.0) + self_ms
+        if bucket_totals is None:
+            bucket_totals = _bucket_totals(values)
+        for bucket, total_ms in bucket_totals.items():
+            self._bucket_totals[bucket] = self._bucket_totals.get(bucket, 0.0) + total_ms
+        for log_name, (delta_ms, count, bucket) in values.items():
+            stats = self.values.get(log_name)
+            if stats is None:
+                self.values[log_name] = [delta_ms, count, bucket]
+            else:
+                stats[0] += delta_ms
+                stats[1] += count
+                if stats[2] is None:
+                    stats[2] = bucket
+
+    def self_times(self):
+        """Returns {log_name: self_ms}: time not spent in any child path"""
+        return dict(self._self_values)
+
+    def bucket_totals(self):
+        """Returns {bucket name: total_ms}, not counting paths nested under a path of the
+        same bucket twice"""
+        return dict(self._bucket_totals)
+
+def _bucket_totals(values):
+    totals = {}
+    for log_name, (delta_ms, _, bucket) in values.items():
+        if bucket is None:
+            continue
+        parent = log_name.rpartition('#')[0]
+        nested = False
+        while parent:
+            parent_stats = values.get(parent)
+            if parent_stats is not None and parent_stats[2] == bucket:
+                nested = True
+                break
+            parent = parent.rpartition('#')[0]
+        if not nested:
+            totals[bucket] = totals.get(bucket, 0.0) + delta_ms
+    return totals
+
+def _self_times(values):
+    self_ms = {log_name: stats[0] for log_name, stats in values.items()}
+    for log_name, stats in values.items():
+        parent, sep, _ = log_name.rpartition('#')
+        if sep and parent in self_ms:
+            self_ms[parent] -= stats[0]
+    return {log_name: max(ms, 0.0) for log_name, ms in self_ms.items()}
+
+def folded(capture):
+    """Folded stack lines ('root;child;grandchild <self microseconds>') for flame graphs"""
+    lines = []
+    for log_name, self_ms in sorted(capture.self_times().items()):
+        self_us = int(round(self_ms * 1000.0))
+        if self_us > 0:
+            lines.append('%s %d' % (log_name.replace('#', ';'), self_us))
+    return lines
+
+def top(capture, n=20, by='self'):
+    """Table of the n paths with the most self (or inclusive) time"""
+    self_times = capture.self_times()
+    total_ms = sum(self_times.values()) or 1.0
+    rows = sorted(
+        capture.values.items(),
+        key=lambda item: self_times[item[0]] if by == 'self' else item[1][0],
+        reverse=True,
+    )[:n]
+    lines = ['%12s %12s %10s %6s  %s' % ('self_ms', 'incl_ms', 'count', 'self%', 'path')]
+    for log_name, (delta_ms, count, _) in rows:
+        lines.append('%12.3f %12.3f %10d %5.1f%%  %s' % (
+            self_times[log_name], delta_ms, count,
+            self_times[log_name] / total_ms * 100.0, log_name,
+        ))
+    return lines
+
+def buckets(capture):
+    """Table of total time per bucket"""
+    totals = capture.bucket_totals()
+    lines = ['%12s %12s  %s' % ('total_ms', 'per_root_ms', 'bucket')]
+    for bucket, total_ms in sorted(totals.items(), key=lambda item: -item[1]):
+        lines.append('%12.3f %12.3f  %s' % (total_ms, total_ms / capture.num_roots, bucket))
+    return lines
+
+def diff(before, after, n=20):
+    """Table of the n paths whose time per root scope changed most between captures"""
+    paths = set(before.values) | set(after.values)
+
+    def per_root(capture, log_name):
+        stats = capture.values.get(log_name)
+        return stats[0] / capture.num_roots if stats else 0.0
+
+    rows = sorted(
+        ((per_root(before, log_name), per_root(after, log_name), log_name)
+         for log_name in paths),
+        key=lambda row: -abs(row[1] - row[0]),
+    )[:n]
+    lines = ['%12s %12s %12s %8s  %s' % ('before_ms', 'after_ms', 'delta_ms', 'delta%', 'path')]
+    for before_ms, after_ms, log_name in rows:
+        change = '%+7.1f%%' % ((after_ms - before_ms) / before_ms * 100.0) if before_ms else 'new'
+        lines.append('%12.3f %12.3f %+12.3f %8s  %s' % (
+            before_ms, after_ms, after_ms - before_ms, change, log_name))
+    return lines
+
+def main(argv=None, out=None):
+    out = out or sys.stdout
+    parser = argparse.ArgumentParser(
+        prog='python -m stopwatch',
+        description='Analyze exported stopwatch reports and trace logs',
+    )
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    folded_parser = subparsers.add_parser('folded', help='Folded stacks for flame graphs')
+    folded_parser.add_argument('files', nargs='+')
+
+    top_parser = subparsers.add_parser('top', help='Top paths by self or inclusive time')
+    top_parser.add_argument('files', nargs='+')
+    top_parser.add_argument('-n', type=int, default=20)
+    top_parser.add_argument('--by', choices=['self', 'inclusive'], default='self')
+
+    buckets_parser = subparsers.add_parser('buckets', help='Total time per bucket')
+    buckets_parser.add_argument('files', nargs='+')
+
+    diff_parser = subparsers.add_parser('diff', help='Compare two captures')
+    diff_parser.add_argument('before')
+    diff_parser.add_argument('after')
+    diff_parser.add_argument('-n', type=int, default=20)
+
+    args = parser.parse_args(argv)
+    if args.command == 'diff':
+        lines = diff(Capture.from_files([args.before]), Capture.from_files([args.after]),
+                     n=args.n)
+    else:
+        capture = Capture.from_files(args.files)
+        if not capture.num_roots:
+            print('No root scopes found', file=sys.stderr)
+            return 1
+        if args.command == 'folded':
+            lines = folded(capture)
+        elif args.command == 'top':
+            lines = top(capture, n=args.n, by=args.by)
+        else:
+            lines = buckets(capture)
+
+    for line in lines:
+        out.write(line + '\n')
+    return 0
@@ -0,0 +1,167 @@
+"""StopWatch - library for adding timers and tags in your code for performance monitoring
+https://github.com/dropbox/stopwatch
+
+This module provides an export pipeline which moves exporting off the thread that
+closes the root scope. Finished reports are handed to a bounded queue which is drained
+in batches by a background worker thread.
+
+For example:
+```
+def export_batch(batch):
+    for item in batch:
+        send(item.aggregated_report, item.reported_traces)
+
+exporter = BackgroundExporter(export_batch, overflow_policy=DROP_OLDEST)
+sw = StopWatch(export_aggregated_timers_and_tracing_func=exporter)
+...
+exporter.close()
+```
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import threading
+import time
+
+ExportItem = collections.namedtuple('ExportItem', ['aggregated_report', 'reported_traces'])
+
+# Overflow policies, applied when a report is exported while the queue is full.
+DROP_OLDEST = 'drop_oldest'  # Evict the oldest queued report to make room
+DROP_NEWEST = 'drop_newest'  # Drop the report being exported
+BLOCK = 'block'  # Block the exporting thread until there is room
+
+class BackgroundExporter(object):
+    """Queues finished root scopes and exports them in batches from a worker thread"""
+
+    def __init__(self,
+                 export_batch_func,
+                 max_queue_size=10000,
+                 max_batch_size=100,
+                 overflow_policy=DROP_OLDEST):
+        """
+        Arguments:
+          export_batch_func:
+            Function called on the worker thread with a list of ExportItems, oldest first.
+            Exceptions raised from it are counted in num_export_errors and otherwise
+            ignored, so a broken exporter cannot kill the worker.
+
+          max_queue_size: Maximum number of reports waiting to be exported.
+
+          max_batch_size: Maximum number of reports handed to a single export_batch_func call.
+
+          overflow_policy: One of DROP_OLDEST, DROP_NEWEST or BLOCK.
+        """
+        assert overflow_policy in (DROP_OLDEST, DROP_NEWEST, BLOCK), \
+            "Unknown overflow_policy: %r" % (overflow_policy,)
+        assert max_queue_size > 0 and max_batch_size > 0
+        self._export_batch_func = export_batch_func
+        self._max_queue_size = max_queue_size
+        self._max_batch_size = max_batch_size
+        self._overflow_policy = overflow_policy
+
+        self._queue = collections.deque()
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._idle = threading.Condition(self._lock)
+        self._exporting = False
+        self._closed = False
+
+        self.num_enqueued = 0
+        self.num_dropped = 0
+        self.num_exported = 0
+        self.num_batches = 0
+        self.num_export_errors = 0
+
+        self._worker = threading.Thread(target=self._run, name='stopwatch-exporter')
+        self._worker.daemon = True
+        self._worker.start()
+
+    def __call__(self, aggregated_report, reported_traces):
+        self.export(aggregated_report, reported_traces)
+
+    def export(self, aggregated_report, reported_traces):
+        """Queue a finished root scope for export. Never calls the exporter inline."""
+        item = ExportItem(aggregated_report, reported_traces)
+        with self._lock:
+            if self._closed:
+                self.num_dropped += 1
+                return
+            queue = self._queue
+            if len(queue) >= self._max_queue_size:
+                if self._overflow_policy == DROP_NEWEST:
+                    self.num_dropped += 1
+                    return
+                elif self._overflow_policy == DROP_OLDEST:
+                    queue.popleft()
+                    self.num_dropped += 1
+                else:
+                    while len(queue) >= self._max_queue_size and not self._closed:
+                        self._not_full.wait()
+                    if self._closed:
+                        self.num_dropped += 1
+                        return
+            queue.append(item)
+            self.num_enqueued += 1
+            self._not_empty.notify()
+
+    def queue_size(self):
+        """Returns the number of reports waiting to be exported"""
+        with self._lock:
+            return len(self._queue)
+
+    def flush(self, timeout=None):
+        """Wait until every queued report has been exported.
+        Returns False if the timeout (in seconds) expired first."""
+        deadline = None if timeout is None else time.time() + timeout
+        with self._lock:
+            while self._queue or self._exporting:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._idle.wait(remaining)
+            return True
+
+    def close(self, timeout=None):
+        """Export whatever is still queued and stop the worker thread. Reports exported
+        after close() are dropped."""
+        with self._lock:
+            self._closed = True
+            self._not_empty.notify()
+            self._not_full.notify_all()
+        self._worker.join(timeout)
+
+    def _run(self):
+        """Worker loop: drain the queue in batches until closed and empty"""
+        while True:
+            with self._lock:
+                while not self._queue and not self._closed:
+                    self._not_empty.wait()
+                if not self._queue:
+                    self._idle.notify_all()
+                    return
+                batch = []
+                queue = self._queue
+                while queue and len(batch) < self._max_batch_size:
+                    batch.append(queue.popleft())
+                self._exporting = True
+                self._not_full.notify_all()
+
+            try:
+                self._export_batch_func(batch)
+                failed = False
+            except Exception:
+                failed = True
+
+            with self._lock:
+                self._exporting = False
+                self.num_batches += 1
+                if failed:
+                    self.num_export_errors += 1
+                else:
+                    self.num_exported += len(batch)
+                if not self._queue:
+                    self._idle.notify_all()
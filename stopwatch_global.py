@@ -11,42 +11,167 @@ with global_sw().timer('root'):
         with global_sw().timer('inner_task'):
             do_inner_task(i)
 ```
+
+Under asyncio, where many requests share one thread, initialize with
+global_sw_init(use_contextvars=True) instead. Every task then gets its own stopwatch
+(tracked with contextvars), and the spans of a child task (asyncio.gather / create_task)
+are nested under the span that was open in its parent task when the child first called
+global_sw(), and merged into the parent's root scope.
+
+While stopwatches are disabled with stopwatch.set_enabled(False), the stopwatches
+returned by global_sw() skip their root scopes without reading the clock.
+
+Work handed to other threads (e.g. a thread pool) can be nested the same way by wrapping
+it with propagate(). The root scope is then only exported once all of it has run:
+```
+with global_sw().timer('fanout'):
+    futures = [executor.submit(propagate(fetch), url) for url in urls]
+```
 """
 
+import contextlib
+import functools
 import threading
+import weakref
+
+try:
+    import asyncio
+    import contextvars
+except ImportError:  # Python < 3.7
+    asyncio = None
+    contextvars = None
 
 from stopwatch import StopWatch
 
 _GLOBAL_SW = None
 
+# The per-task stopwatches created by global_sw_init(use_contextvars=True)
+_TASK_SWS = weakref.WeakSet()
+
 class _GlobalSw(object):
     """A global store for thread-local stopwatches. Helps with the common case where
     the caller only wants one stopwatch per thread.
     """
     def __init__(self, time_func=None, export_aggregated_timers_func=None,
-                 export_tracing_func=None, export_aggregated_timers_and_tracing_func=None):
+                 export_tracing_func=None, export_aggregated_timers_and_tracing_func=None,
+                 trace_sampler=None, monotonic_ns=False, max_trace_spans=None,
+                 max_bytes=None):
         self.threadlocal_sws = threading.local()
         self.time_func = time_func
         self.export_agg_timers_func = export_aggregated_timers_func
         self.export_tracing_func = export_tracing_func
         self.export_agg_timers_and_tracing_func = export_aggregated_timers_and_tracing_func
+        # Shared by the stopwatches of all threads, so it needs to be thread safe
+        self.trace_sampler = trace_sampler
+        self.monotonic_ns = monotonic_ns
+        self.max_trace_spans = max_trace_spans
+        self.max_bytes = max_bytes
 
     def global_sw(self):
         """Returns the thread local stopwatch (creating if it doesn't exists)"""
         if not hasattr(self.threadlocal_sws, 'sw'):
-            self.threadlocal_sws.sw = StopWatch(
-                export_aggregated_timers_func=self.export_agg_timers_func,
-                time_func=self.time_func,
-                export_tracing_func=self.export_tracing_func,
-                export_aggregated_timers_and_tracing_func=self.export_agg_timers_and_tracing_func,
-            )
+            self.threadlocal_sws.sw = self._new_sw()
         return self.threadlocal_sws.sw
 
+    def existing_sw(self):
+        """Returns the thread local stopwatch, or None if there isn't one"""
+        return getattr(self.threadlocal_sws, 'sw', None)
+
+    @contextlib.contextmanager
+    def attached(self, parent_context):
+        """Temporarily replace the stopwatch of the current thread with one nested under
+        parent_context"""
+        previous = getattr(self.threadlocal_sws, 'sw', None)
+        self.threadlocal_sws.sw = self._new_sw(parent_context)
+        try:
+            yield
+        finally:
+            if previous is None:
+                del self.threadlocal_sws.sw
+            else:
+                self.threadlocal_sws.sw = previous
+
+    def _new_sw(self, parent_context=None):
+        return StopWatch(
+            export_aggregated_timers_func=self.export_agg_timers_func,
+            time_func=self.time_func,
+            export_tracing_func=self.export_tracing_func,
+            export_aggregated_timers_and_tracing_func=self.export_agg_timers_and_tracing_func,
+            parent_context=parent_context,
+            trace_sampler=self.trace_sampler,
+            monotonic_ns=self.monotonic_ns,
+            max_trace_spans=self.max_trace_spans,
+            max_bytes=self.max_bytes,
+        )
+
+class _ContextGlobalSw(_GlobalSw):
+    """A global store for per-asyncio-task stopwatches (per thread outside of tasks).
+
+    The context variable holds a (task, stopwatch) pair. A task that finds a pair
+    belonging to another task inherited it from its parent, so it creates its own
+    stopwatch nested under the parent's currently open span.
+
+    Spans measure wall time, including the time a task spends suspended in await.
+    """
+    def __init__(self, *args, **kwargs):
+        assert contextvars is not None, "use_contextvars requires Python 3.7+"
+        super(_ContextGlobalSw, self).__init__(*args, **kwargs)
+        self.context_sw = contextvars.ContextVar('stopwatch_global_sw', default=None)
+
+    def _new_sw(self, parent_context=None):
+        sw = super(_ContextGlobalSw, self)._new_sw(parent_context)
+        _TASK_SWS.add(sw)
+        return sw
+
+    def global_sw(self):
+        """Returns the stopwatch of the current task (creating if it doesn't exist)"""
+        task = _current_task()
+        entry = self.context_sw.get()
+        if entry is not None and entry[0] is task:
+            return entry[1]
+
+        sw = self._new_sw(entry[1].span_context() if entry is not None else None)
+        self.context_sw.set((task, sw))
+        return sw
+
+    def existing_sw(self):
+        """Returns the stopwatch of the current task, or None if there isn't one"""
+        entry = self.context_sw.get()
+        if entry is not None and entry[0] is _current_task():
+            return entry[1]
+        return None
+
+    @contextlib.contextmanager
+    def attached(self, parent_context):
+        """Temporarily replace the stopwatch of the current task with one nested under
+        parent_context"""
+        token = self.context_sw.set((_current_task(), self._new_sw(parent_context)))
+        try:
+            yield
+        finally:
+            self.context_sw.reset(token)
+
+def _current_task():
+    """Returns the running asyncio task, or None outside of one"""
+    try:
+        return asyncio.current_task()
+    except RuntimeError:  # No running event loop
+        return None
+
 def global_sw_init(*args, **kwargs):
-    """Initialize global stopwatch with the completion callbacks"""
+    """Initialize global stopwatch with the completion callbacks.
+    Pass use_contextvars=True for one stopwatch per asyncio task instead of per thread."""
     global _GLOBAL_SW
     assert _GLOBAL_SW is None, "Cannot initialize global_sw twice"
-    _GLOBAL_SW = _GlobalSw(*args, **kwargs)
+    if kwargs.pop('use_contextvars', False):
+        _GLOBAL_SW = _ContextGlobalSw(*args, **kwargs)
+    else:
+        _GLOBAL_SW = _GlobalSw(*args, **kwargs)
+
+def is_task_sw(sw):
+    """Returns whether sw is one of the per-asyncio-task (or per-thread outside of tasks)
+    stopwatches of global_sw_init(use_contextvars=True)"""
+    return sw in _TASK_SWS
 
 def global_sw_del():
     """Delete the global stopwatch. Typically not necessary, as stopwatch is reusable
@@ -56,6 +181,26 @@ def global_sw_del():
     _GLOBAL_SW = None
 
 def global_sw():
-    """Return the stopwatch for the current thread"""
+    """Return the stopwatch for the current thread (or asyncio task)"""
     assert _GLOBAL_SW is not None, "Must initialize global_sw_init first"
     return _GLOBAL_SW.global_sw()
+
+def propagate(func):
+    """Wrap func, e.g. before submitting it to a thread pool, so that the spans it starts
+    with global_sw() on another thread are nested under the currently open span and merged
+    into its root scope. That root scope is not exported until the wrapper has run, so it
+    must be called exactly once."""
+    assert _GLOBAL_SW is not None, "Must initialize global_sw_init first"
+    global_sws = _GLOBAL_SW
+    parent_context = global_sws.global_sw().span_context(hold=True)
+    if parent_context is None:
+        return func
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            with global_sws.attached(parent_context):
+                return func(*args, **kwargs)
+        finally:
+            parent_context.release()
+    return wrapper
@@ -0,0 +1,191 @@
+"""StopWatch - library for adding timers and tags in your code for performance monitoring
+https://github.com/dropbox/stopwatch
+
+This module provides a low frequency sampling profiler which attributes the sampled
+Python stacks of a thread to the innermost span open in that thread's StopWatch, to see
+which functions make a span slow without the overhead of a tracing profiler.
+
+For example:
+```
+profiler = SpanProfiler(interval=0.01)
+profiler.start()
+...
+# in every thread to profile
+profiler.register(global_sw())
+...
+profiler.hotspots()['root#render']  # [(function, self_samples, total_samples), ...]
+profiler.folded()  # for flamegraph.pl
+profiler.stop()
+```
+
+Only threads with an open span are sampled. Memory is bounded by max_stacks distinct
+(span path, stack) pairs, and stacks are cut off at max_depth frames.
+
+A thread is profiled with one stopwatch, so the stopwatches of
+global_sw_init(use_contextvars=True), where the tasks sharing a thread each have their
+own, can't be registered. Other stopwatches can, whichever global_sw_init is used.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import threading
+
+import stopwatch_global
+
+try:
+    from threading import get_ident as _get_ident
+except ImportError:  # Python 2
+    from thread import get_ident as _get_ident
+
+# Upper bound of the sampling rate, in samples per second
+MAX_SAMPLES_PER_SECOND = 1000
+
+class SpanProfiler(object):
+    """Samples the stacks of the threads of registered stopwatches from a background
+    thread, keyed by the path of the thread's innermost open span"""
+
+    def __init__(self, interval=0.01, max_depth=64, max_stacks=10000):
+        """
+        Arguments:
+          interval: Seconds between samples.
+          max_depth: Maximum number of (innermost) frames kept per sample.
+          max_stacks:
+            Maximum number of distinct (span path, stack) pairs kept. Samples of new
+            stacks beyond it are counted in num_dropped_samples.
+        """
+        assert interval >= 1.0 / MAX_SAMPLES_PER_SECOND, \
+            "interval must be at least %s seconds" % (1.0 / MAX_SAMPLES_PER_SECOND,)
+        assert max_depth > 0 and max_stacks > 0
+        self._interval = interval
+        self._max_depth = max_depth
+        self._max_stacks = max_stacks
+        # thread ident -> StopWatch
+        self._stopwatches = {}
+        # (SpanPath, tuple of code objects, outermost first) -> number of samples
+        self._counts = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+        self.num_samples = 0
+        self.num_dropped_samples = 0
+
+    def register(self, sw, thread_ident=None):
+        """Profile the spans of sw, running on the given thread (the current one by
+        default). A thread has at most one registered stopwatch."""
+        # The sampling thread can't tell which task's stopwatch is current on a thread
+        assert not stopwatch_global.is_task_sw(sw), \
+            "SpanProfiler does not support the stopwatches of " \
+            "global_sw_init(use_contextvars=True)"
+        if thread_ident is None:
+            thread_ident = _get_ident()
+        self._stopwatches[thread_ident] = sw
+
+    def unregister(self, thread_ident=None):
+        """Stop profiling the thread (the current one by default)"""
+        if thread_ident is None:
+            thread_ident = _get_ident()
+        self._stopwatches.pop(thread_ident, None)
+
+    def start(self):
+        """Start sampling from a background thread"""
+        assert self._thread is None, "SpanProfiler already started"
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='stopwatch-profiler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background thread. Samples are kept until reset()."""
+        if self._thread is not None:
+            self._stopped.set()
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stopped.wait(self._interval):
+            self.sample()
+
+    def sample(self):
+        """Sample every registered thread with an open span once"""
+        frames = sys._current_frames()
+        samples = []
+        for thread_ident, sw in list(self._stopwatches.items()):
+            frame = frames.get(thread_ident)
+            if frame is None:
+                # The thread is gone
+                self._stopwatches.pop(thread_ident, None)
+                continue
+            try:
+                path = sw._timer_stack[-1].path
+            except (IndexError, AttributeError):  # No open span, or NULL_STOPWATCH
+                continue
+            stack = []
+            while frame is not None and len(stack) < self._max_depth:
+                stack.append(frame.f_code)
+                frame = frame.f_back
+            stack.reverse()
+            samples.append((path, tuple(stack)))
+        del frames
+
+        with self._lock:
+            counts = self._counts
+            for key in samples:
+                count = counts.get(key)
+                if count is not None:
+                    counts[key] = count + 1
+                elif len(counts) < self._max_stacks:
+                    counts[key] = 1
+                else:
+                    self.num_dropped_samples += 1
+                    continue
+                self.num_samples += 1
+
+    def reset(self):
+        """Forget all samples"""
+        with self._lock:
+            self._counts = {}
+            self.num_samples = 0
+            self.num_dropped_samples = 0
+
+    def folded(self):
+        """Folded stack lines ('root;child;file.py:func;file.py:func2 <samples>'), span
+        names first, for flame graphs"""
+        with self._lock:
+            counts = list(self._counts.items())
+        folded = {}
+        for (path, stack), count in counts:
+            line = ';'.join([path.log_name.replace('#', ';')] + [_describe(c) for c in stack])
+            folded[line] = folded.get(line, 0) + count
+        return ['%s %d' % (line, count) for line, count in sorted(folded.items())]
+
+    def hotspots(self, n=10):
+        """Returns {log_name: [(function, self_samples, total_samples), ...]} with the n
+        functions of each span path with the most samples, most self samples (the
+        function was running, rather than one it called) first"""
+        with self._lock:
+            counts = list(self._counts.items())
+        by_path = {}
+        for (path, stack), count in counts:
+            functions = by_path.setdefault(path.log_name, {})
+            if stack:
+                leaf = _describe(stack[-1])
+                functions.setdefault(leaf, [0, 0])[0] += count
+            for name in set(_describe(code) for code in stack):
+                functions.setdefault(name, [0, 0])[1] += count
+        return {
+            log_name: sorted(
+                ((name, self_count, total) for name, (self_count, total) in functions.items()),
+                key=lambda item: (-item[1], -item[2], item[0]),
+            )[:n]
+            for log_name, functions in by_path.items()
+        }
+
+def _describe(code):
+    """'file.py:function' for a code object"""
+    name = getattr(code, 'co_qualname', code.co_name)  # co_qualname is Python 3.11+
+    return '%s:%s' % (os.path.basename(code.co_filename), name)
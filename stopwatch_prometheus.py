@@ -0,0 +1,259 @@
+"""StopWatch - library for adding timers and tags in your code for performance monitoring
+https://github.com/dropbox/stopwatch
+
+This module keeps cumulative per-path and per-bucket metrics of every root scope and
+exposes them in the Prometheus text exposition format, either with render() or from an
+HTTP endpoint served on a background thread.
+
+For example:
+```
+metrics = PrometheusMetrics()
+sw = StopWatch(export_aggregated_timers_func=metrics)
+server = metrics.serve(port=9102, host='0.0.0.0')  # http://host:9102/metrics
+...
+server.close()
+```
+
+Reports are added to a shard owned by the exporting thread, so threads never contend
+with each other or with scrapes. A scrape copies every shard (each dict copy is atomic
+under the GIL) and sums the copies. The shards of threads which exited are folded into
+one shared shard by the next scrape, so short lived threads don't add up.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import bisect
+import threading
+import weakref
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:  # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Upper bounds (in seconds) of the span duration histogram buckets
+DEFAULT_BUCKETS_SECONDS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                           2.5, 5.0, 10.0)
+
+# Indices into the mutable per-path stats lists of a shard
+_COUNT = 0
+_TOTAL_SECONDS = 1
+_SELF_SECONDS = 2
+
+class _Shard(object):
+    """Cumulative metrics of the reports added by one thread"""
+
+    __slots__ = ('thread', 'num_roots', 'values', 'bucket_totals', 'histograms')
+
+    def __init__(self, thread=None):
+        # weakref to the thread adding reports, None if no thread adds any more
+        self.thread = thread
+        self.num_roots = 0
+        # log_name -> [count, total_seconds, self_seconds]
+        self.values = {}
+        # bucket name -> total_seconds
+        self.bucket_totals = {}
+        # log_name -> [count per histogram bucket (the last one is +Inf), sum_seconds]
+        self.histograms = {}
+
+class PrometheusMetrics(object):
+    """Cumulative metrics of AggregatedReports, rendered in Prometheus text format.
+
+    Span durations are observed from the AggregatedReport histograms when the StopWatch
+    tracks latency_histograms, otherwise only the duration of the root span is observed.
+    """
+
+    def __init__(self, namespace='stopwatch', buckets_seconds=DEFAULT_BUCKETS_SECONDS):
+        """
+        Arguments:
+          namespace: Prefix of the metric names.
+          buckets_seconds: Increasing upper bounds of the span duration histogram buckets.
+        """
+        assert list(buckets_seconds) == sorted(buckets_seconds), \
+            "buckets_seconds must be increasing"
+        self._namespace = namespace
+        self._bounds = tuple(buckets_seconds)
+        self._local = threading.local()
+        self._shards = []
+        # The metrics of threads which exited
+        self._retired = _Shard()
+        # Taken by a thread adding its first report, and by scrapes
+        self._shards_lock = threading.Lock()
+
+    def __call__(self, aggregated_report):
+        self.add_report(aggregated_report)
+
+    def add_report(self, aggregated_report):
+        """Add the aggregated values of a finished root scope"""
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = _Shard(weakref.ref(threading.current_thread()))
+            with self._shards_lock:
+                self._shards.append(shard)
+
+        self_values = aggregated_report.self_values or {}
+        values = shard.values
+        for log_name, (delta_ms, count, _) in aggregated_report.aggregated_values.items():
+            stats = values.get(log_name)
+            if stats is None:
+                stats = values[log_name] = [0, 0.0, 0.0]
+            stats[_COUNT] += count
+            stats[_TOTAL_SECONDS] += delta_ms / 1000.0
+            stats[_SELF_SECONDS] += self_values.get(log_name, 0.0) / 1000.0
+
+        if aggregated_report.bucket_totals:
+            bucket_totals = shard.bucket_totals
+            for bucket, total_ms in aggregated_report.bucket_totals.items():
+                bucket_totals[bucket.name] = bucket_totals.get(bucket.name, 0.0) + total_ms / 1000.0
+
+        if aggregated_report.histograms is not None:
+            for log_name, histogram in aggregated_report.histograms.items():
+                for value_ms, count in histogram.items():
+                    self._observe(shard, log_name, value_ms / 1000.0, count)
+        else:
+            root = aggregated_report.root_timer_data
+            self._observe(shard, root.log_name, root.end_time - root.start_time, 1)
+
+        shard.num_roots += 1
+
+    def _observe(self, shard, log_name, value_seconds, count):
+        histogram = shard.histograms.get(log_name)
+        if histogram is None:
+            histogram = shard.histograms[log_name] = [0] * (len(self._bounds) + 1) + [0.0]
+        histogram[bisect.bisect_left(self._bounds, value_seconds)] += count
+        histogram[-1] += value_seconds * count
+
+    def _merged(self):
+        """Returns the (num_roots, values, bucket_totals, histograms) summed over all
+        shards, in the formats of a _Shard. Folds the shards of exited threads into the
+        retired shard."""
+        merged = _Shard()
+        with self._shards_lock:
+            live_shards = []
+            for shard in self._shards:
+                thread = shard.thread()
+                if thread is None or not thread.is_alive():
+                    # Nothing adds to the shard any more
+                    _add_shard(self._retired, shard)
+                else:
+                    live_shards.append(shard)
+            self._shards = live_shards
+            _add_shard(merged, self._retired)
+            for shard in live_shards:
+                _add_shard(merged, shard)
+        return merged.num_roots, merged.values, merged.bucket_totals, merged.histograms
+
+    def render(self):
+        """Returns all metrics in the Prometheus text exposition format"""
+        num_roots, values, bucket_totals, histograms = self._merged()
+        prefix = self._namespace + '_'
+        lines = []
+
+        def header(name, metric_type, help_text):
+            lines.append('# HELP %s%s %s' % (prefix, name, help_text))
+            lines.append('# TYPE %s%s %s' % (prefix, name, metric_type))
+
+        header('roots_total', 'counter', 'Number of finished root scopes.')
+        lines.append('%sroots_total %s' % (prefix, _format_value(num_roots)))
+
+        for name, index, help_text in (
+            ('spans_total', _COUNT, 'Number of finished spans, by path.'),
+            ('span_seconds_total', _TOTAL_SECONDS, 'Time spent in spans, by path.'),
+            ('span_self_seconds_total', _SELF_SECONDS,
+             'Time spent in spans outside of their child spans, by path.'),
+        ):
+            header(name, 'counter', help_text)
+            for log_name in sorted(values):
+                lines.append('%s%s{path="%s"} %s' % (
+                    prefix, name, _escape(log_name), _format_value(values[log_name][index])))
+
+        header('bucket_seconds_total', 'counter',
+               'Time spent in spans of each bucket, counting nested spans once.')
+        for bucket in sorted(bucket_totals):
+            lines.append('%sbucket_seconds_total{bucket="%s"} %s' % (
+                prefix, _escape(bucket), _format_value(bucket_totals[bucket])))
+
+        header('span_duration_seconds', 'histogram', 'Duration of spans, by path.')
+        bounds = [_format_value(bound) for bound in self._bounds] + ['+Inf']
+        for log_name in sorted(histograms):
+            histogram = histograms[log_name]
+            path = _escape(log_name)
+            cumulative = 0
+            for bound, count in zip(bounds, histogram):
+                cumulative += count
+                lines.append('%sspan_duration_seconds_bucket{path="%s",le="%s"} %s' % (
+                    prefix, path, bound, _format_value(cumulative)))
+            lines.append('%sspan_duration_seconds_sum{path="%s"} %s' % (
+                prefix, path, _format_value(histogram[-1])))
+            lines.append('%sspan_duration_seconds_count{path="%s"} %s' % (
+                prefix, path, _format_value(cumulative)))
+
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port=0, host='127.0.0.1'):
+        """Serve render() at /metrics from a background thread. Returns the MetricsServer.
+        Pass port=0 to pick a free port (see MetricsServer.port)."""
+        return MetricsServer(self, port, host)
+
+def _add_shard(into, shard):
+    """Add the metrics of shard to the _Shard into. shard may be in use by its thread."""
+    into.num_roots += shard.num_roots
+    for log_name, stats in shard.values.copy().items():
+        _add_into(into.values, log_name, stats)
+    for bucket, total_seconds in shard.bucket_totals.copy().items():
+        into.bucket_totals[bucket] = into.bucket_totals.get(bucket, 0.0) + total_seconds
+    for log_name, histogram in shard.histograms.copy().items():
+        _add_into(into.histograms, log_name, histogram)
+
+def _add_into(into, key, stats):
+    existing = into.get(key)
+    if existing is None:
+        into[key] = list(stats)
+    else:
+        for i, value in enumerate(stats):
+            existing[i] += value
+
+def _escape(label_value):
+    return label_value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_value(value):
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class MetricsServer(object):
+    """HTTP server for the metrics of a PrometheusMetrics, on a daemon thread"""
+
+    def __init__(self, metrics, port=0, host='127.0.0.1'):
+        self._server = HTTPServer((host, port), _MetricsHandler)
+        self._server.metrics = metrics
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name='stopwatch-metrics')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        """Stop serving and wait for the server thread to exit"""
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
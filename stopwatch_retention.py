@@ -0,0 +1,189 @@
+"""StopWatch - library for adding timers and tags in your code for performance monitoring
+https://github.com/dropbox/stopwatch
+
+This module provides tail-based trace retention: instead of exporting the traces of every
+root scope, only the slowest roots per root name and window, plus roots which failed
+or were flagged slow, are exported.
+
+For example:
+```
+retention = TailRetention(my_export_tracing, top_k=5, window_seconds=60, flush_interval=1)
+sw = StopWatch(export_aggregated_timers_and_tracing_func=retention)
+...
+retention.close()
+```
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import heapq
+import itertools
+import threading
+import time
+
+from stopwatch import (
+    SlowTraceAnnotation,
+    TraceBuffer,
+)
+
+class TailRetention(object):
+    """Buffers finished root scopes' traces and exports only those worth keeping.
+
+    Per window (by root end time) and root name, the top_k slowest roots are kept.
+    Roots whose root span carries one of keep_annotation_keys (by default the
+    'Exception' annotation added by StopWatch.timer()) or a tag from
+    add_slow_annotation() are always kept, up to max_flagged per window.
+
+    Retained traces are kept in TraceBuffers and exported with
+    export_tracing_func(reported_traces=...) once the window ends (see flush_interval),
+    a root ends in a newer window, or on flush().
+    """
+
+    def __init__(self,
+                 export_tracing_func,
+                 top_k=10,
+                 window_seconds=60,
+                 keep_annotation_keys=('Exception',),
+                 max_flagged=1000,
+                 flush_interval=None,
+                 time_func=time.time):
+        """
+        Arguments:
+          flush_interval:
+            If set, a background thread calls flush_expired() every flush_interval
+            seconds, so a window is exported soon after it ends even if no later root
+            does. Call close() to stop it.
+          time_func: Clock of the roots' end times (the StopWatch's time_func).
+        """
+        self._export_tracing_func = export_tracing_func
+        self._top_k = top_k
+        self._window_seconds = window_seconds
+        self._keep_annotation_keys = frozenset(keep_annotation_keys)
+        self._max_flagged = max_flagged
+        self._lock = threading.Lock()
+        # Breaks ties between equally slow roots, so traces are never compared
+        self._sequence = itertools.count()
+        self._window_start = None
+        self._reset_window()
+        self._time_func = time_func
+
+        self.num_retained = 0
+        self.num_discarded = 0
+
+        self._closed = threading.Event()
+        self._worker = None
+        if flush_interval is not None:
+            assert flush_interval > 0, "flush_interval must be positive"
+            self._worker = threading.Thread(target=self._run, args=(flush_interval,),
+                                            name='stopwatch-retention')
+            self._worker.daemon = True
+            self._worker.start()
+
+    def _reset_window(self):
+        # root name -> min-heap of (duration, sequence, TraceBuffer)
+        self._slowest = {}
+        # (sequence, TraceBuffer) of roots kept regardless of duration
+        self._flagged = []
+
+    def __call__(self, aggregated_report, reported_traces):
+        self.add_root(aggregated_report, reported_traces)
+
+    def add_root(self, aggregated_report, reported_traces):
+        """Offer a finished root scope for retention"""
+        root = aggregated_report.root_timer_data
+        if not reported_traces:
+            return
+        window_start = (root.end_time // self._window_seconds) * self._window_seconds
+        to_export = None
+        with self._lock:
+            if self._window_start is None:
+                self._window_start = window_start
+            elif window_start > self._window_start:
+                to_export = self._take_retained()
+                self._window_start = window_start
+
+            if self._is_flagged(root):
+                if len(self._flagged) < self._max_flagged:
+                    self._flagged.append((next(self._sequence),
+                                          _compact(root, reported_traces)))
+                else:
+                    self.num_discarded += 1
+            else:
+                duration = root.end_time - root.start_time
+                heap = self._slowest.get(root.name)
+                if heap is None:
+                    heap = self._slowest[root.name] = []
+                if len(heap) < self._top_k:
+                    heapq.heappush(heap, (duration, next(self._sequence),
+                                          _compact(root, reported_traces)))
+                else:
+                    if heap and duration > heap[0][0]:
+                        heapq.heapreplace(heap, (duration, next(self._sequence),
+                                                 _compact(root, reported_traces)))
+                    self.num_discarded += 1
+
+        if to_export:
+            self._export(to_export)
+
+    def flush(self):
+        """Export everything retained for the current window"""
+        with self._lock:
+            to_export = self._take_retained()
+        self._export(to_export)
+
+    def flush_expired(self, now=None):
+        """Export the roots retained for the current window if it ended by now
+        (time_func() by default). The next root starts a new window."""
+        if now is None:
+            now = self._time_func()
+        with self._lock:
+            if self._window_start is None or now < self._window_start + self._window_seconds:
+                return
+            to_export = self._take_retained()
+            self._window_start = None
+        self._export(to_export)
+
+    def close(self, timeout=None):
+        """Stop the background thread, if any, and export what is left"""
+        self._closed.set()
+        if self._worker is not None:
+            self._worker.join(timeout)
+        self.flush()
+
+    def _run(self, flush_interval):
+        while not self._closed.wait(flush_interval):
+            self.flush_expired()
+
+    def _is_flagged(self, root):
+        keep_annotation_keys = self._keep_annotation_keys
+        for annotation in root.trace_annotations:
+            if annotation.key in keep_annotation_keys or \
+                    isinstance(annotation, SlowTraceAnnotation):
+                return True
+        return False
+
+    def _take_retained(self):
+        """Returns the retained traces in the order their roots finished, and starts a
+        new window. Must hold _lock."""
+        retained = list(self._flagged)
+        for heap in self._slowest.values():
+            retained.extend((sequence, traces) for _, sequence, traces in heap)
+        retained.sort(key=lambda entry: entry[0])
+        self._reset_window()
+        return [traces for _, traces in retained]
+
+    def _export(self, retained):
+        for reported_traces in retained:
+            self.num_retained += 1
+            self._export_tracing_func(reported_traces=reported_traces)
+
+def _compact(root, reported_traces):
+    """Returns the traces of a retained root as a TraceBuffer, so they don't keep a
+    TimerData per span alive until the window is exported"""
+    if isinstance(reported_traces, TraceBuffer):
+        return reported_traces
+    traces = TraceBuffer(root.path.parent)
+    traces.extend(reported_traces)
+    return traces
@@ -0,0 +1,289 @@
+"""StopWatch - library for adding timers and tags in your code for performance monitoring
+https://github.com/dropbox/stopwatch
+
+This module aggregates the reports of many processes (e.g. the workers of a pre-fork
+server) into a shared, mmap-backed file, without any IPC round-trips.
+
+The segment is split into one slot per worker. Each worker only ever writes its own
+slot, so writers need no locks; a reader merges all slots. Every slot is guarded by a
+sequence counter (a seqlock), so readers retry instead of seeing half applied reports.
+
+For example:
+```
+segment = SharedAggregationSegment.create('/dev/shm/stopwatch', num_slots=num_workers)
+# ... fork workers. In each worker:
+sw = StopWatch(export_aggregated_timers_func=segment.writer(worker_index))
+# ... in the master or any other process:
+SharedAggregationSegment.open('/dev/shm/stopwatch').read()  # {log_name: AggregatedStats}
+```
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import errno
+import mmap
+import os
+import struct
+import time
+import zlib
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+from stopwatch_aggregator import (
+    AggregatedStats,
+    merge_stats,
+)
+
+_MAGIC = b'SWSHM001'
+# magic, num_slots, entries_per_slot, max_name_len
+_HEADER = struct.Struct('<8sIII')
+_HEADER_SIZE = 64
+# sequence (odd while a report is being applied), owner pid
+_SLOT_HEADER = struct.Struct('<QQ')
+# state, name length, count, total_ms, min_ms, max_ms - followed by the name bytes
+_ENTRY = struct.Struct('<BxH4xQddd')
+_COUNTERS = struct.Struct('<Qddd')
+_COUNTERS_OFFSET = 8
+
+_ENTRY_EMPTY = 0
+_ENTRY_USED = 1
+
+_MAX_READ_RETRIES = 100
+
+class SharedAggregationSegment(object):
+    """A file backed, memory mapped table of per-log_name counters per worker slot"""
+
+    def __init__(self, path, fileobj, num_slots, entries_per_slot, max_name_len):
+        self.path = path
+        self.num_slots = num_slots
+        self.entries_per_slot = entries_per_slot
+        self.max_name_len = max_name_len
+        self._file = fileobj
+        self._entry_size, self._slot_size = _layout(entries_per_slot, max_name_len)
+        # Slots skipped by the last read() because their sequence stayed odd, e.g. as
+        # their writer died while applying a report
+        self.stuck_slots = []
+        self._mmap = mmap.mmap(fileobj.fileno(), _HEADER_SIZE + self._slot_size * num_slots)
+
+    @classmethod
+    def create(cls, path, num_slots, entries_per_slot=4096, max_name_len=200):
+        """Create (or truncate) the segment file. Call this before forking workers.
+        Arguments:
+          num_slots: Number of writers (typically one per worker process).
+          entries_per_slot: Number of distinct log_names each slot can hold.
+          max_name_len: Longest log_name (in utf-8 bytes) which can be stored.
+        """
+        fileobj = open(path, 'w+b')
+        header = _HEADER.pack(_MAGIC, num_slots, entries_per_slot, max_name_len)
+        fileobj.write(header.ljust(_HEADER_SIZE, b'\0'))
+        # Size the file before mapping it; new pages read as zeros (= empty entries)
+        fileobj.truncate(_HEADER_SIZE + _layout(entries_per_slot, max_name_len)[1] * num_slots)
+        fileobj.flush()
+        return cls(path, fileobj, num_slots, entries_per_slot, max_name_len)
+
+    @classmethod
+    def open(cls, path):
+        """Open an existing segment file, e.g. from a process which was not forked from
+        the creator"""
+        fileobj = open(path, 'r+b')
+        magic, num_slots, entries_per_slot, max_name_len = _HEADER.unpack(
+            fileobj.read(_HEADER.size))
+        if magic != _MAGIC:
+            fileobj.close()
+            raise ValueError("%s is not a stopwatch shared aggregation segment" % (path,))
+        return cls(path, fileobj, num_slots, entries_per_slot, max_name_len)
+
+    def close(self):
+        self._mmap.close()
+        self._file.close()
+
+    def writer(self, slot=None):
+        """Returns a SlotWriter for `slot`. If slot is None, claims the first slot not
+        owned by a live process (requires fcntl)."""
+        if slot is None:
+            slot = self._claim_slot()
+        assert 0 <= slot < self.num_slots, "slot %r out of range" % (slot,)
+        return SlotWriter(self, slot)
+
+    def read(self):
+        """Returns a dict of log_name -> AggregatedStats merged over all slots. Slots
+        which can't be read consistently are skipped and listed in stuck_slots."""
+        merged = {}
+        stuck_slots = []
+        for slot in range(self.num_slots):
+            values = self._read_slot(slot)
+            if values is None:
+                stuck_slots.append(slot)
+            else:
+                merge_stats(merged, values)
+        self.stuck_slots = stuck_slots
+        return merged
+
+    def read_slot(self, slot):
+        """Returns a dict of log_name -> AggregatedStats for a single slot"""
+        values = self._read_slot(slot)
+        if values is None:
+            raise RuntimeError("Slot %d kept changing while being read" % (slot,))
+        return values
+
+    def _read_slot(self, slot):
+        """Returns the values of a slot, or None if it kept changing (or its writer died
+        while applying a report)"""
+        offset = self._slot_offset(slot)
+        for _ in range(_MAX_READ_RETRIES):
+            sequence = _SLOT_HEADER.unpack_from(self._mmap, offset)[0]
+            if sequence % 2:
+                time.sleep(0.0001)  # A writer is applying a report
+                continue
+            data = self._mmap[offset:offset + self._slot_size]
+            if _SLOT_HEADER.unpack_from(self._mmap, offset)[0] == sequence:
+                break
+        else:
+            return None
+
+        values = {}
+        for entry_offset in range(_SLOT_HEADER.size, self._slot_size, self._entry_size):
+            state, name_len, count, total_ms, min_ms, max_ms = _ENTRY.unpack_from(
+                data, entry_offset)
+            if state != _ENTRY_USED:
+                continue
+            name_offset = entry_offset + _ENTRY.size
+            log_name = data[name_offset:name_offset + name_len].decode('utf-8')
+            values[log_name] = AggregatedStats(count, total_ms, min_ms, max_ms, None)
+        return values
+
+    def reset_slot(self, slot):
+        """Clear all counters of a slot. Only safe while no writer uses the slot."""
+        offset = self._slot_offset(slot)
+        self._mmap[offset:offset + self._slot_size] = b'\0' * self._slot_size
+
+    def _slot_offset(self, slot):
+        return _HEADER_SIZE + slot * self._slot_size
+
+    def _claim_slot(self):
+        assert fcntl is not None, "Claiming slots requires fcntl, pass an explicit slot"
+        pid = os.getpid()
+        # Forked workers share the open file description of self._file, and flock
+        # locks are per description, so lock a description of our own.
+        fd = os.open(self.path, os.O_RDWR)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            for slot in range(self.num_slots):
+                offset = self._slot_offset(slot)
+                sequence, owner = _SLOT_HEADER.unpack_from(self._mmap, offset)
+                if owner == pid:
+                    return slot
+                if not _pid_alive(owner):
+                    # The previous owner may have died while applying a report
+                    _SLOT_HEADER.pack_into(self._mmap, offset, _even(sequence), pid)
+                    return slot
+        finally:
+            os.close(fd)
+        raise RuntimeError("All %d slots of %s are in use" % (self.num_slots, self.path))
+
+def _layout(entries_per_slot, max_name_len):
+    """Returns the (entry size, slot size) in bytes. Entries are 8 byte aligned so the
+    counters are too."""
+    entry_size = (_ENTRY.size + max_name_len + 7) // 8 * 8
+    return entry_size, _SLOT_HEADER.size + entry_size * entries_per_slot
+
+def _even(sequence):
+    """Rounds a slot sequence up to an even (not being written) value. Rounding up
+    rather than down makes readers which saw the old value retry."""
+    return sequence + (sequence & 1)
+
+def _pid_alive(pid):
+    if pid == 0:
+        return False
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+class SlotWriter(object):
+    """Merges AggregatedReports into one slot of a SharedAggregationSegment.
+
+    Unlike most exporters, it must only be used by one thread at a time, and each slot
+    by one writer.
+    """
+
+    def __init__(self, segment, slot):
+        self._segment = segment
+        self._mmap = segment._mmap
+        self.slot = slot
+        self._slot_offset = segment._slot_offset(slot)
+        self._entry_size = segment._entry_size
+        # log_name -> offset of its entry, so steady state reports don't hash or probe
+        self._offsets = {}
+        # Reports' log_names which could not be stored (too long or slot full)
+        self.num_dropped_names = 0
+
+        # Take over the slot, picking up the entries of its previous owner. If that died
+        # while applying a report the sequence is stuck odd; the slot is ours now, so
+        # make it even. Recording our pid keeps _claim_slot from handing it out again.
+        mm = self._mmap
+        sequence = _SLOT_HEADER.unpack_from(mm, self._slot_offset)[0]
+        _SLOT_HEADER.pack_into(mm, self._slot_offset, _even(sequence), os.getpid())
+        for index in range(segment.entries_per_slot):
+            offset = self._entry_offset(index)
+            state, name_len = _ENTRY.unpack_from(mm, offset)[:2]
+            if state == _ENTRY_USED:
+                name_offset = offset + _ENTRY.size
+                self._offsets[mm[name_offset:name_offset + name_len].decode('utf-8')] = offset
+
+    def __call__(self, aggregated_report):
+        self.add_report(aggregated_report)
+
+    def add_report(self, aggregated_report):
+        """Merge the aggregated values of a finished root scope into the slot"""
+        mm = self._mmap
+        sequence, owner = _SLOT_HEADER.unpack_from(mm, self._slot_offset)
+        _SLOT_HEADER.pack_into(mm, self._slot_offset, sequence + 1, owner)
+        try:
+            for log_name, (delta_ms, count, _) in aggregated_report.aggregated_values.items():
+                offset = self._offsets.get(log_name)
+                if offset is None:
+                    offset = self._add_entry(log_name)
+                    if offset is None:
+                        self.num_dropped_names += 1
+                        continue
+                counters_offset = offset + _COUNTERS_OFFSET
+                old_count, total_ms, min_ms, max_ms = _COUNTERS.unpack_from(mm, counters_offset)
+                if old_count:
+                    _COUNTERS.pack_into(mm, counters_offset, old_count + count,
+                                        total_ms + delta_ms,
+                                        min(min_ms, delta_ms), max(max_ms, delta_ms))
+                else:
+                    _COUNTERS.pack_into(mm, counters_offset, count, delta_ms, delta_ms, delta_ms)
+        finally:
+            _SLOT_HEADER.pack_into(mm, self._slot_offset, sequence + 2, owner)
+
+    def _entry_offset(self, index):
+        return self._slot_offset + _SLOT_HEADER.size + index * self._entry_size
+
+    def _add_entry(self, log_name):
+        """Claim an empty entry for log_name with linear probing. Returns its offset,
+        or None if it can't be stored."""
+        entries_per_slot = self._segment.entries_per_slot
+        if len(self._offsets) >= entries_per_slot:
+            # Only this writer adds entries to the slot, so it is full for good
+            return None
+        name = log_name.encode('utf-8')
+        if len(name) > self._segment.max_name_len:
+            return None
+        start = zlib.crc32(name) % entries_per_slot
+        for probe in range(entries_per_slot):
+            offset = self._entry_offset((start + probe) % entries_per_slot)
+            if _ENTRY.unpack_from(self._mmap, offset)[0] == _ENTRY_EMPTY:
+                _ENTRY.pack_into(self._mmap, offset, _ENTRY_USED, len(name), 0, 0.0, 0.0, 0.0)
+                name_offset = offset + _ENTRY.size
+                self._mmap[name_offset:name_offset + len(name)] = name
+                self._offsets[log_name] = offset
+                return offset
+        return None
@@ -0,0 +1,181 @@
+"""StopWatch - library for adding timers and tags in your code for performance monitoring
+https://github.com/dropbox/stopwatch
+
+This module provides a StatsD exporter. Reports are aggregated in-process, and every
+flush_interval a background thread sends the aggregates as StatsD lines, packed into as
+few UDP datagrams as fit within max_packet_bytes.
+
+For example:
+```
+exporter = StatsdExporter('statsd.local', 8125, prefix='myservice')
+sw = StopWatch(export_aggregated_timers_func=exporter)
+...
+exporter.close()
+```
+
+Every root scope produces one timing sample per path (its total time in that path) and
+per bucket. At most max_samples of them are kept per name and interval (a uniform
+sample) and sent with the matching sample rate, so StatsD still counts all of them.
+Span counts per path are sent as counters.
+
+Each kind of metric has its own namespace under the prefix, so no span path can clash
+with another metric:
+- prefix.timers.root.child: Timing of the path root#child.
+- prefix.counts.root.child: Number of spans of the path root#child.
+- prefix.buckets.DB: Timing of the bucket DB.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import random as insecure_random
+import re
+import socket
+import threading
+
+# Fits the payload of a UDP datagram on a 1500 byte MTU with room for IP options
+DEFAULT_MAX_PACKET_BYTES = 1432
+
+_INVALID_NAME_CHARS = re.compile(r'[:|@\s]')
+
+class _Timing(object):
+    """Timing samples of one name in the current interval"""
+
+    __slots__ = ('count', 'samples')
+
+    def __init__(self):
+        self.count = 0
+        self.samples = []
+
+class StatsdExporter(object):
+    """Aggregates AggregatedReports and sends them to StatsD over UDP"""
+
+    def __init__(self, host='127.0.0.1', port=8125, prefix='stopwatch', flush_interval=10.0,
+                 max_packet_bytes=DEFAULT_MAX_PACKET_BYTES, max_samples=100):
+        """
+        Arguments:
+          host/port: Address of the StatsD server.
+          prefix: Prepended to every name, before the namespace of the metric, e.g.
+            'prefix.timers.root.child', 'prefix.counts.root.child' or 'prefix.buckets.DB'.
+          flush_interval: Seconds between sends from the background thread.
+          max_packet_bytes: Maximum payload of a datagram. Longer lines are sent alone.
+          max_samples: Maximum timing samples sent per name and interval.
+        """
+        assert flush_interval > 0, "flush_interval must be positive"
+        assert max_samples > 0, "max_samples must be positive"
+        family, _, _, _, self._address = socket.getaddrinfo(
+            host, port, 0, socket.SOCK_DGRAM)[0]
+        self._socket = socket.socket(family, socket.SOCK_DGRAM)
+        self._prefix = prefix + '.' if prefix else ''
+        self._flush_interval = flush_interval
+        self._max_packet_bytes = max_packet_bytes
+        self._max_samples = max_samples
+        # (namespace, log_name) -> StatsD name. Filled in without the lock, as racing
+        # threads only compute the same name twice.
+        self._names = {}
+
+        self._lock = threading.Lock()
+        # timing name -> _Timing, and counter name -> count
+        self._timings = {}
+        self._counters = {}
+        self._closed = threading.Event()
+
+        self.num_reports = 0
+        self.num_packets = 0
+        self.num_send_errors = 0
+
+        self._worker = threading.Thread(target=self._run, name='stopwatch-statsd')
+        self._worker.daemon = True
+        self._worker.start()
+
+    def __call__(self, aggregated_report):
+        self.add_report(aggregated_report)
+
+    def add_report(self, aggregated_report):
+        """Aggregate a finished root scope into the current interval"""
+        samples = [
+            (self._name('timers', log_name), delta_ms, self._name('counts', log_name), count)
+            for log_name, (delta_ms, count, _) in aggregated_report.aggregated_values.items()
+        ]
+        if aggregated_report.bucket_totals:
+            samples.extend(
+                (self._name('buckets', bucket.name), total_ms, None, None)
+                for bucket, total_ms in aggregated_report.bucket_totals.items()
+            )
+
+        with self._lock:
+            self.num_reports += 1
+            timings = self._timings
+            counters = self._counters
+            for name, delta_ms, counter_name, count in samples:
+                timing = timings.get(name)
+                if timing is None:
+                    timing = timings[name] = _Timing()
+                timing.count += 1
+                if len(timing.samples) < self._max_samples:
+                    timing.samples.append(delta_ms)
+                else:
+                    # Reservoir sampling keeps a uniform sample of the interval
+                    index = insecure_random.randrange(timing.count)
+                    if index < self._max_samples:
+                        timing.samples[index] = delta_ms
+                if counter_name is not None:
+                    counters[counter_name] = counters.get(counter_name, 0) + count
+
+    def flush(self):
+        """Send everything aggregated so far. Called every flush_interval from the
+        background thread, but may also be called directly."""
+        with self._lock:
+            timings, self._timings = self._timings, {}
+            counters, self._counters = self._counters, {}
+
+        lines = []
+        for name, timing in sorted(timings.items()):
+            rate = len(timing.samples) / timing.count
+            suffix = '|ms' if rate == 1 else '|ms|@%.6g' % rate
+            lines.extend('%s:%.3f%s' % (name, delta_ms, suffix) for delta_ms in timing.samples)
+        for name, count in sorted(counters.items()):
+            lines.append('%s:%d|c' % (name, count))
+
+        for datagram in _pack(lines, self._max_packet_bytes):
+            try:
+                self._socket.sendto(datagram.encode('utf-8'), self._address)
+                self.num_packets += 1
+            except (socket.error, OSError):
+                self.num_send_errors += 1
+
+    def close(self, timeout=None):
+        """Stop the background thread and send what is left"""
+        self._closed.set()
+        self._worker.join(timeout)
+        self.flush()
+        self._socket.close()
+
+    def _name(self, namespace, log_name):
+        key = (namespace, log_name)
+        name = self._names.get(key)
+        if name is None:
+            name = self._names[key] = '%s%s.%s' % (
+                self._prefix, namespace, _INVALID_NAME_CHARS.sub('_', log_name).replace('#', '.'))
+        return name
+
+    def _run(self):
+        while not self._closed.wait(self._flush_interval):
+            self.flush()
+
+def _pack(lines, max_packet_bytes):
+    """Join lines with newlines into as few datagrams of at most max_packet_bytes as the
+    line order allows"""
+    datagram = []
+    size = 0
+    for line in lines:
+        line_size = len(line.encode('utf-8'))
+        if datagram and size + 1 + line_size > max_packet_bytes:
+            yield '\n'.join(datagram)
+            datagram = []
+            size = 0
+        size += line_size + (1 if datagram else 0)
+        datagram.append(line)
+    if datagram:
+        yield '\n'.join(datagram)
@@ -0,0 +1,290 @@
+"""StopWatch - library for adding timers and tags in your code for performance monitoring
+https://github.com/dropbox/stopwatch
+
+This module provides tracing exporters which stream finished root scopes to a file (or
+file-like object) in standard trace formats:
+
+- ChromeTraceExporter: Chrome trace-event JSON (chrome://tracing, Perfetto)
+- ZipkinExporter: Zipkin v2 JSON, one array of spans per root scope per line
+- OtlpJsonExporter: OTLP-JSON, one ExportTraceServiceRequest per root scope per line
+
+For example:
+```
+exporter = ChromeTraceExporter('/tmp/trace.json')
+sw = StopWatch(export_tracing_func=exporter)
+...
+exporter.close()
+```
+
+Spans are serialized straight into strings, without building a dict per span, and
+written out whenever chunk_size characters are buffered, so memory stays bounded. Span
+times are expected in seconds since the epoch (the default time_func).
+
+Zipkin and OTLP span ids are 64 bit, so they are derived from a hash of the 128 bit
+StopWatch span ids (the trace id is the full span id of the trace's root span).
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import hashlib
+import itertools
+import json
+import os
+import threading
+
+# C accelerated JSON string quoting (returns the string including quotes)
+_quote = json.encoder.encode_basestring_ascii
+
+_MAX_QUOTE_CACHE_SIZE = 10000
+
+class _StreamingTraceExporter(object):
+    """Base class handling buffering, chunked writes and string quoting. Subclasses must
+    implement _write_root(reported_traces), serializing one root scope with _write(), and
+    may implement _write_trailer(), called once by close().
+    """
+
+    def __init__(self, fileobj, chunk_size=64 * 1024):
+        """
+        Arguments:
+          fileobj: Path or text file-like object to write to.
+          chunk_size: Number of buffered characters after which they are written out.
+        """
+        if isinstance(fileobj, str):
+            self._file = open(fileobj, 'w')
+            self._owns_file = True
+        else:
+            self._file = fileobj
+            self._owns_file = False
+        self._chunk_size = chunk_size
+        self._buf = []
+        self._buf_size = 0
+        self._lock = threading.Lock()
+        self._quoted = {}
+        self._closed = False
+        self.num_roots = 0
+        self.num_spans = 0
+
+    def __call__(self, reported_traces):
+        self.export(reported_traces)
+
+    def export(self, reported_traces):
+        """Serialize the traces of one finished root scope"""
+        if not reported_traces:
+            return
+        with self._lock:
+            assert not self._closed, "Exporter already closed"
+            self._write_root(reported_traces)
+            self.num_roots += 1
+            self.num_spans += len(reported_traces)
+            if self._buf_size >= self._chunk_size:
+                self._flush_buf()
+
+    def flush(self):
+        """Write out everything buffered so far"""
+        with self._lock:
+            self._flush_buf()
+            self._file.flush()
+
+    def close(self):
+        """Write the format's trailer, flush, and close the file if it was opened here"""
+        with self._lock:
+            if self._closed:
+                return
+            self._write_trailer()
+            self._flush_buf()
+            self._closed = True
+            if self._owns_file:
+                self._file.close()
+            else:
+                self._file.flush()
+
+    def _write(self, data):
+        self._buf.append(data)
+        self._buf_size += len(data)
+
+    def _flush_buf(self):
+        if self._buf:
+            self._file.write(''.join(self._buf))
+            self._buf = []
+            self._buf_size = 0
+
+    def _quote(self, value):
+        """Returns value as a quoted JSON string. Span names repeat a lot, so they are
+        cached."""
+        quoted = self._quoted.get(value)
+        if quoted is None:
+            if len(self._quoted) >= _MAX_QUOTE_CACHE_SIZE:
+                self._quoted.clear()
+            quoted = self._quoted[value] = _quote(value if isinstance(value, str) else
+                                                  str(value))
+        return quoted
+
+    def _write_root(self, reported_traces):
+        raise NotImplementedError("%s must implement _write_root" % (type(self).__name__,))
+
+    def _write_trailer(self):
+        pass
+
+def _trace_id(reported_traces):
+    """Returns the id of the trace of one root scope: the span id of the root span of
+    the trace. The root span of a child StopWatch exported on its own (as its
+    parent_context's root scope had finished) records it as trace_id. If the root span
+    wasn't traced, its id is the parent id of the outermost traced spans."""
+    if reported_traces[-1].parent_span_id is None:
+        return reported_traces[-1].span_id
+    span_ids = set()
+    for trace in reported_traces:
+        if trace.parent_span_id is None:
+            return trace.span_id
+        trace_id = getattr(trace, 'trace_id', None)
+        if trace_id is not None:
+            return trace_id
+        span_ids.add(trace.span_id)
+    for trace in reported_traces:
+        if trace.parent_span_id not in span_ids:
+            return trace.parent_span_id
+    raise ValueError("Reported traces without a root span: %r" % (reported_traces,))
+
+def _span_id_64(span_id, cache):
+    """Returns a 64 bit (16 hex characters) id for a span id. The full id is hashed: a
+    suffix alone isn't unique, e.g. for counter_span_ids of stopwatches in one trace.
+    cache maps span ids already seen in the root scope, since parents repeat."""
+    short_id = cache.get(span_id)
+    if short_id is None:
+        short_id = cache[span_id] = hashlib.sha1(span_id.encode('ascii')).hexdigest()[:16]
+    return short_id
+
+class ChromeTraceExporter(_StreamingTraceExporter):
+    """Chrome trace-event format, as a single JSON array of complete ('X') events.
+    Each root scope is laid out on its own row (tid) so concurrent roots don't overlap.
+    Span annotations are listed as [key, value] pairs in args.annotations.
+    Viewers accept the file before close(), which only adds the closing bracket."""
+
+    def __init__(self, fileobj, chunk_size=64 * 1024, pid=None):
+        super(ChromeTraceExporter, self).__init__(fileobj, chunk_size)
+        self._pid = os.getpid() if pid is None else pid
+        self._root_ids = itertools.count(1)
+        self._write('[')
+        self._separator = '\n'
+
+    def _write_root(self, reported_traces):
+        tid = next(self._root_ids)
+        write = self._write
+        quote = self._quote
+        for trace in reported_traces:
+            write('%s{"name":%s,"cat":"stopwatch","ph":"X","ts":%.3f,"dur":%.3f,'
+                  '"pid":%d,"tid":%d,"args":{"log_name":%s,"span_id":"%s"' % (
+                      self._separator,
+                      quote(trace.name),
+                      trace.start_time * 1e6,
+                      (trace.end_time - trace.start_time) * 1e6,
+                      self._pid,
+                      tid,
+                      quote(trace.log_name),
+                      trace.span_id,
+                  ))
+            self._separator = ',\n'
+            if trace.trace_annotations:
+                annotation_separator = ',"annotations":['
+                for annotation in trace.trace_annotations:
+                    write('%s[%s,%s]' % (annotation_separator, quote(annotation.key),
+                                         quote(annotation.value)))
+                    annotation_separator = ','
+                write(']')
+            write('}}')
+
+    def _write_trailer(self):
+        self._write('\n]\n')
+
+class ZipkinExporter(_StreamingTraceExporter):
+    """Zipkin v2 JSON. Every root scope is written as one JSON array of spans on its own
+    line, each of which can be POSTed to /api/v2/spans as is."""
+
+    def __init__(self, fileobj, chunk_size=64 * 1024, service_name='stopwatch'):
+        super(ZipkinExporter, self).__init__(fileobj, chunk_size)
+        self._endpoint = '{"serviceName":%s}' % (_quote(service_name),)
+
+    def _write_root(self, reported_traces):
+        trace_id = _trace_id(reported_traces)
+        write = self._write
+        quote = self._quote
+        short_ids = {}
+        separator = '['
+        for trace in reported_traces:
+            write('%s{"traceId":"%s","id":"%s",%s"name":%s,"timestamp":%d,"duration":%d,'
+                  '"localEndpoint":%s,"tags":{"log_name":%s}' % (
+                      separator,
+                      trace_id,
+                      _span_id_64(trace.span_id, short_ids),
+                      ('"parentId":"%s",' % _span_id_64(trace.parent_span_id, short_ids)
+                       if trace.parent_span_id else ''),
+                      quote(trace.name),
+                      trace.start_time * 1e6,
+                      max((trace.end_time - trace.start_time) * 1e6, 1),
+                      self._endpoint,
+                      quote(trace.log_name),
+                  ))
+            separator = ','
+            if trace.trace_annotations:
+                annotation_separator = ',"annotations":['
+                for annotation in trace.trace_annotations:
+                    write('%s{"timestamp":%d,"value":%s}' % (
+                        annotation_separator,
+                        annotation.time * 1e6,
+                        _quote('%s=%s' % (annotation.key, annotation.value)),
+                    ))
+                    annotation_separator = ','
+                write(']')
+            write('}')
+        write(']\n')
+
+class OtlpJsonExporter(_StreamingTraceExporter):
+    """OTLP-JSON (the OpenTelemetry file exporter format). Every root scope is written as
+    one ExportTraceServiceRequest on its own line."""
+
+    def __init__(self, fileobj, chunk_size=64 * 1024, service_name='stopwatch'):
+        super(OtlpJsonExporter, self).__init__(fileobj, chunk_size)
+        self._prefix = (
+            '{"resourceSpans":[{"resource":{"attributes":[{"key":"service.name",'
+            '"value":{"stringValue":%s}}]},"scopeSpans":[{"scope":{"name":"stopwatch"},'
+            '"spans":[' % (_quote(service_name),)
+        )
+
+    def _write_root(self, reported_traces):
+        trace_id = _trace_id(reported_traces)
+        write = self._write
+        quote = self._quote
+        short_ids = {}
+        write(self._prefix)
+        separator = ''
+        for trace in reported_traces:
+            write('%s{"traceId":"%s","spanId":"%s",%s"name":%s,"kind":1,'
+                  '"startTimeUnixNano":"%d","endTimeUnixNano":"%d",'
+                  '"attributes":[{"key":"log_name","value":{"stringValue":%s}}]' % (
+                      separator,
+                      trace_id,
+                      _span_id_64(trace.span_id, short_ids),
+                      ('"parentSpanId":"%s",' % _span_id_64(trace.parent_span_id, short_ids)
+                       if trace.parent_span_id else ''),
+                      quote(trace.name),
+                      trace.start_time * 1e9,
+                      trace.end_time * 1e9,
+                      quote(trace.log_name),
+                  ))
+            separator = ','
+            if trace.trace_annotations:
+                event_separator = ',"events":['
+                for annotation in trace.trace_annotations:
+                    write('%s{"timeUnixNano":"%d","name":%s,"attributes":[{"key":"value",'
+                          '"value":{"stringValue":%s}}]}' % (
+                              event_separator,
+                              annotation.time * 1e9,
+                              quote(annotation.key),
+                              quote(annotation.value),
+                          ))
+                    event_separator = ','
+                write(']')
+            write('}')
+        write(']}]}]}\n')
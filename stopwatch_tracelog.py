@@ -0,0 +1,376 @@
+"""StopWatch - library for adding timers and tags in your code for performance monitoring
+https://github.com/dropbox/stopwatch
+
+This module provides a compact, append-only binary log of traced root scopes, and a
+reader which memory-maps the log and iterates over spans without parsing the whole file.
+
+For example:
+```
+writer = TraceLogWriter('/var/log/stopwatch.swlog')
+sw = StopWatch(export_tracing_func=writer)
+...
+writer.close()
+
+reader = TraceLogReader('/var/log/stopwatch.swlog')
+for root in reader.roots(name='request', start_time=t0, end_time=t1):
+    for span in reader.spans(root):
+        print(span.log_name, span.end_time - span.start_time)
+```
+
+File layout (all integers little endian):
+- 8 byte magic
+- records, each starting with a one byte type:
+  - N: a string, interned once per file (span names, log names, annotations)
+  - R: a root scope, followed by its S records
+  - S: a span (fixed width), followed by its A records
+  - A: a span annotation (fixed width)
+- footer, written by close(): the root index sorted by (root name, start time) and
+  the full string table, followed by a fixed size trailer pointing at both.
+
+A log without a footer (e.g. the writer crashed) is still readable; the reader then
+scans the records to rebuild the index. Opening an existing log for writing appends
+to it.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import binascii
+import bisect
+import collections
+import mmap
+import os
+import struct
+import threading
+
+_MAGIC = b'SWTLOG02'
+_TRAILER_MAGIC = b'SWTIDX01'
+
+# type, id, length - followed by the utf-8 bytes
+_NAME = struct.Struct('<cII')
+# type, root name id, number of spans, start time, end time
+_ROOT = struct.Struct('<cIIdd')
+# type, name id, log name id, start time, end time, span id, parent span id,
+# number of annotations
+_SPAN = struct.Struct('<cIIdd16s16sI')
+# type, key id, value id, time
+_ANNOTATION = struct.Struct('<cIId')
+# root name id, start time, end time, offset of the R record, number of spans
+_INDEX_ENTRY = struct.Struct('<IddQI')
+# index offset, number of roots, string table offset, number of strings, magic
+_TRAILER = struct.Struct('<QQQQ8s')
+
+_NAME_TYPE = b'N'
+_ROOT_TYPE = b'R'
+_SPAN_TYPE = b'S'
+_ANNOTATION_TYPE = b'A'
+
+_NO_PARENT = b'\0' * 16
+
+LoggedRoot = collections.namedtuple('LoggedRoot',
+                                    ['name', 'start_time', 'end_time', 'offset', 'num_spans'])
+# Mirrors the TimerData attributes used by tracing exporters
+LoggedSpan = collections.namedtuple('LoggedSpan', ['name', 'log_name', 'start_time', 'end_time',
+                                                   'span_id', 'parent_span_id',
+                                                   'trace_annotations'])
+LoggedAnnotation = collections.namedtuple('LoggedAnnotation', ['key', 'value', 'time'])
+
+def _pack_span_id(span_id):
+    if span_id is None:
+        return _NO_PARENT
+    return binascii.unhexlify(span_id.rjust(32, '0')[-32:])
+
+def _unpack_span_id(packed):
+    if packed == _NO_PARENT:
+        return None
+    return binascii.hexlify(packed).decode('ascii')
+
+class TraceLogWriter(object):
+    """Appends traced root scopes to a binary trace log.
+
+    Errors writing a root scope (e.g. a full disk) are counted in num_export_errors
+    rather than raised into StopWatch.end(), and leave nothing of that root scope in the
+    log.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._names = {}
+        self._closed = False
+        self.num_export_errors = 0
+        # (root name id, start time, end time, offset, number of spans)
+        self._index = []
+
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            reader = TraceLogReader(path)
+            try:
+                self._names = {name: name_id for name_id, name in enumerate(reader._names)}
+                self._index = [(self._names[root.name], root.start_time, root.end_time,
+                                root.offset, root.num_spans) for root in reader.roots()]
+                data_end = reader._data_end
+            finally:
+                reader.close()
+            self._file = open(path, 'r+b')
+            self._file.truncate(data_end)
+            self._file.seek(data_end)
+        else:
+            self._file = open(path, 'wb')
+            self._file.write(_MAGIC)
+
+    def __call__(self, reported_traces):
+        self.export(reported_traces)
+
+    def export(self, reported_traces):
+        """Append the traces of one finished root scope"""
+        if not reported_traces:
+            return
+        try:
+            self._export(reported_traces)
+        except Exception:
+            with self._lock:
+                self.num_export_errors += 1
+
+    def _export(self, reported_traces):
+        root = reported_traces[-1]
+        if root.parent_span_id is not None:
+            # Root span wasn't traced; cover the traced spans instead
+            root_name = root.log_name.split('#', 1)[0]
+            start_time = min(trace.start_time for trace in reported_traces)
+            end_time = max(trace.end_time for trace in reported_traces)
+        else:
+            root_name, start_time, end_time = root.name, root.start_time, root.end_time
+
+        with self._lock:
+            buf = []
+            # Strings new in this root scope, only interned once it has been written
+            new_names = {}
+            name_id = self._name_id(root_name, buf, new_names)
+            start = self._file.tell()
+            offset = start + sum(len(data) for data in buf)
+            buf.append(_ROOT.pack(_ROOT_TYPE, name_id, len(reported_traces),
+                                  start_time, end_time))
+            for trace in reported_traces:
+                annotations = trace.trace_annotations
+                span = _SPAN.pack(
+                    _SPAN_TYPE,
+                    self._name_id(trace.name, buf, new_names),
+                    self._name_id(trace.log_name, buf, new_names),
+                    trace.start_time,
+                    trace.end_time,
+                    _pack_span_id(trace.span_id),
+                    _pack_span_id(trace.parent_span_id),
+                    len(annotations),
+                )
+                # Strings must be defined before the first record using them, which
+                # includes the annotations following the span
+                annotation_records = [
+                    _ANNOTATION.pack(_ANNOTATION_TYPE,
+                                     self._name_id(annotation.key, buf, new_names),
+                                     self._name_id(annotation.value, buf, new_names),
+                                     annotation.time)
+                    for annotation in annotations
+                ]
+                buf.append(span)
+                buf.extend(annotation_records)
+            try:
+                self._file.write(b''.join(buf))
+            except Exception:
+                # Don't leave a partial root scope behind
+                self._file.seek(start)
+                self._file.truncate(start)
+                raise
+            self._names.update(new_names)
+            self._index.append((name_id, start_time, end_time, offset, len(reported_traces)))
+
+    def flush(self):
+        with self._lock:
+            self._file.flush()
+
+    def close(self):
+        """Write the footer (index and string table) and close the file. Calling it
+        again does nothing."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            index_offset = self._file.tell()
+            names = sorted(self._names, key=self._names.get)
+            self._index.sort(key=lambda entry: (names[entry[0]], entry[1]))
+            self._file.write(b''.join(_INDEX_ENTRY.pack(*entry) for entry in self._index))
+            names_offset = self._file.tell()
+            self._file.write(b''.join(self._pack_name(name_id, name)
+                                      for name_id, name in enumerate(names)))
+            self._file.write(_TRAILER.pack(index_offset, len(self._index),
+                                           names_offset, len(names), _TRAILER_MAGIC))
+            self._file.close()
+
+    def _name_id(self, name, buf, new_names):
+        """Returns the id of an interned string. New strings are added to new_names, and
+        their N record is appended to buf."""
+        if not isinstance(name, str):
+            name = str(name)
+        name_id = self._names.get(name)
+        if name_id is None:
+            name_id = new_names.get(name)
+            if name_id is None:
+                name_id = new_names[name] = len(self._names) + len(new_names)
+                buf.append(self._pack_name(name_id, name))
+        return name_id
+
+    @staticmethod
+    def _pack_name(name_id, name):
+        encoded = name.encode('utf-8')
+        return _NAME.pack(_NAME_TYPE, name_id, len(encoded)) + encoded
+
+class TraceLogReader(object):
+    """Memory-maps a binary trace log for random access by root name and time range"""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        size = os.fstat(self._file.fileno()).st_size
+        assert size >= len(_MAGIC), "%s is not a stopwatch trace log" % (path,)
+        self._mmap = mmap.mmap(self._file.fileno(), size, access=mmap.ACCESS_READ)
+        if self._mmap[:len(_MAGIC)] != _MAGIC:
+            self.close()
+            raise ValueError("%s is not a stopwatch trace log" % (path,))
+
+        # root name -> list of LoggedRoots sorted by start time
+        self._roots_by_name = collections.OrderedDict()
+        if not self._read_footer(size):
+            self._scan(size)
+        self._start_times = {name: [root.start_time for root in roots]
+                             for name, roots in self._roots_by_name.items()}
+
+    def close(self):
+        self._mmap.close()
+        self._file.close()
+
+    def root_names(self):
+        """Returns the names of all root scopes in the log"""
+        return list(self._roots_by_name)
+
+    def roots(self, name=None, start_time=None, end_time=None):
+        """Iterate over the logged root scopes, optionally only those named `name` and
+        starting within [start_time, end_time]. Roots are sorted by name, then start time.
+        """
+        names = [name] if name is not None else self._roots_by_name
+        for root_name in names:
+            roots = self._roots_by_name.get(root_name, [])
+            start_times = self._start_times[root_name] if roots else []
+            lo = 0 if start_time is None else bisect.bisect_left(start_times, start_time)
+            hi = len(roots) if end_time is None else bisect.bisect_right(start_times, end_time)
+            for i in range(lo, hi):
+                yield roots[i]
+
+    def spans(self, root):
+        """Iterate over the LoggedSpans of a root returned by roots()"""
+        mm = self._mmap
+        names = self._names
+        offset = root.offset + _ROOT.size
+        for _ in range(root.num_spans):
+            while mm[offset:offset + 1] == _NAME_TYPE:
+                offset = self._skip_name(offset)
+            (_, name_id, log_name_id, start_time, end_time, span_id, parent_span_id,
+             num_annotations) = _SPAN.unpack_from(mm, offset)
+            offset += _SPAN.size
+            annotations = []
+            for _ in range(num_annotations):
+                while mm[offset:offset + 1] == _NAME_TYPE:
+                    offset = self._skip_name(offset)
+                _, key_id, value_id, event_time = _ANNOTATION.unpack_from(mm, offset)
+                offset += _ANNOTATION.size
+                annotations.append(LoggedAnnotation(names[key_id], names[value_id], event_time))
+            yield LoggedSpan(names[name_id], names[log_name_id], start_time, end_time,
+                             _unpack_span_id(span_id), _unpack_span_id(parent_span_id),
+                             annotations)
+
+    def _skip_name(self, offset):
+        return offset + _NAME.size + _NAME.unpack_from(self._mmap, offset)[2]
+
+    def _read_footer(self, size):
+        """Load the index and string table from the footer. Returns False if there is
+        no valid footer."""
+        mm = self._mmap
+        if size < len(_MAGIC) + _TRAILER.size:
+            return False
+        index_offset, num_roots, names_offset, num_names, magic = _TRAILER.unpack_from(
+            mm, size - _TRAILER.size)
+        if magic != _TRAILER_MAGIC:
+            return False
+
+        self._names = names = []
+        offset = names_offset
+        for _ in range(num_names):
+            _, _, length = _NAME.unpack_from(mm, offset)
+            offset += _NAME.size
+            names.append(mm[offset:offset + length].decode('utf-8'))
+            offset += length
+
+        for i in range(num_roots):
+            name_id, start_time, end_time, root_offset, num_spans = _INDEX_ENTRY.unpack_from(
+                mm, index_offset + i * _INDEX_ENTRY.size)
+            root = LoggedRoot(names[name_id], start_time, end_time, root_offset, num_spans)
+            self._roots_by_name.setdefault(root.name, []).append(root)
+        self._data_end = index_offset
+        return True
+
+    def _scan(self, size):
+        """Rebuild the string table and index by reading every record"""
+        mm = self._mmap
+        self._names = names = []
+        roots = []
+        # Number of strings defined before each root's R record
+        num_names = []
+        offset = len(_MAGIC)
+        while offset < size:
+            record_type = mm[offset:offset + 1]
+            if record_type == _NAME_TYPE:
+                if offset + _NAME.size > size:
+                    break
+                _, _, length = _NAME.unpack_from(mm, offset)
+                if offset + _NAME.size + length > size:
+                    break
+                names.append(mm[offset + _NAME.size:offset + _NAME.size + length].decode('utf-8'))
+                offset += _NAME.size + length
+            elif record_type == _ROOT_TYPE and offset + _ROOT.size <= size:
+                _, name_id, num_spans, start_time, end_time = _ROOT.unpack_from(mm, offset)
+                roots.append(LoggedRoot(names[name_id], start_time, end_time, offset, num_spans))
+                num_names.append(len(names))
+                offset += _ROOT.size
+            elif record_type == _SPAN_TYPE and offset + _SPAN.size <= size:
+                offset += _SPAN.size
+            elif record_type == _ANNOTATION_TYPE and offset + _ANNOTATION.size <= size:
+                offset += _ANNOTATION.size
+            else:
+                # Truncated record at the end of a log whose writer didn't close it
+                break
+        self._data_end = offset
+
+        # A truncated last root is dropped (along with the strings it defined), as its
+        # spans are incomplete
+        if roots and not self._root_complete(roots[-1], offset):
+            self._data_end = roots.pop().offset
+            del names[num_names[-1]:]
+        for root in sorted(roots, key=lambda root: (root.name, root.start_time)):
+            self._roots_by_name.setdefault(root.name, []).append(root)
+
+    def _root_complete(self, root, data_end):
+        mm = self._mmap
+        offset = root.offset + _ROOT.size
+        for _ in range(root.num_spans):
+            while offset < data_end and mm[offset:offset + 1] == _NAME_TYPE:
+                offset = self._skip_name(offset)
+            if offset + _SPAN.size > data_end:
+                return False
+            num_annotations = _SPAN.unpack_from(mm, offset)[-1]
+            offset += _SPAN.size
+            for _ in range(num_annotations):
+                while offset < data_end and mm[offset:offset + 1] == _NAME_TYPE:
+                    offset = self._skip_name(offset)
+                if offset + _ANNOTATION.size > data_end:
+                    return False
+                offset += _ANNOTATION.size
+        return True
@@ -0,0 +1,95 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import sys
+
+import pytest
+
+from benchmark_stopwatch import (
+    BENCHMARKS,
+    BenchmarkResult,
+    compare,
+    count_allocations,
+    load_results,
+    main,
+    measure,
+    save_results,
+)
+
+
+class TestBenchmark(object):
+    def test_measure(self):
+        results = {}
+        for name in ('timer', 'global_sw_lookup'):
+            result = results[name] = measure(name, min_time=0.001, repeat=1)
+            assert result.name == name
+            assert result.ns_per_span > 0
+            assert result.peak_bytes_per_span > 0
+        if count_allocations(lambda: None) is not None:
+            # Blocks freed again within the iteration are counted as well
+            assert results['timer'].allocs_per_span > 1
+
+    @pytest.mark.skipif(not hasattr(sys, 'getallocatedblocks') or sys.version_info < (3, 7),
+                        reason='needs sys.getallocatedblocks and opcode tracing')
+    def test_count_allocations(self):
+        def noop():
+            pass
+
+        def run():
+            for _ in range(100):
+                [noop]
+                noop()
+        # One list per iteration, and a few blocks for the loop itself
+        assert 100 <= count_allocations(run) < 110
+
+    def test_all_benchmarks_run(self):
+        for name in BENCHMARKS:
+            setup_func, _ = BENCHMARKS[name]
+            run = setup_func()
+            if isinstance(run, tuple):
+                run, teardown = run
+                run()
+                teardown()
+            else:
+                run()
+
+    def test_save_and_compare(self, tmpdir):
+        path = str(tmpdir.join('baseline.json'))
+        baseline = {
+            'timer': BenchmarkResult('timer', 1000.0, 0.0, 10.0),
+            'start_end': BenchmarkResult('start_end', 1000.0, None, None),
+        }
+        save_results(baseline, path)
+        assert load_results(path) == baseline
+
+        results = {
+            'timer': BenchmarkResult('timer', 1200.0, 0.001, 10.0),
+            'start_end': BenchmarkResult('start_end', 1050.0, 2.0, None),
+            'new': BenchmarkResult('new', 1.0, None, None),
+        }
+        assert compare(baseline, results, threshold=0.1) == [
+            ('timer', 'ns_per_span', 1000.0, 1200.0, 1.2)]
+        assert compare(baseline, results, threshold=0.3) == []
+
+        # Allocation regressions are flagged too
+        results['timer'] = BenchmarkResult('timer', 1000.0, 1.0, 15.0)
+        assert compare(baseline, results, threshold=0.1) == [
+            ('timer', 'allocs_per_span', 0.0, 1.0, float('inf')),
+            ('timer', 'peak_bytes_per_span', 10.0, 15.0, 1.5),
+        ]
+
+    def test_load_old_results(self, tmpdir):
+        path = tmpdir.join('baseline.json')
+        path.write(json.dumps({'results': {
+            'timer': {'name': 'timer', 'ns_per_span': 1000.0, 'bytes_per_span': 10.0},
+        }}))
+        assert load_results(str(path)) == {'timer': BenchmarkResult('timer', 1000.0, None, None)}
+
+    def test_main(self, tmpdir):
+        path = str(tmpdir.join('baseline.json'))
+        args = ['--filter', 'start_end', '--min-time', '0.001', '--repeat', '1']
+        assert main(args + ['--save', path]) == 0
+        assert list(load_results(path)) == ['start_end']
+        assert main(args + ['--compare', path, '--threshold', '1000']) == 0
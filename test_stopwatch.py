@@ -3,16 +3,33 @@ from __future__ import division
 from __future__ import print_function
 
 import enum
+import itertools
+import pickle
+import threading
+import time
 import pytest
 
 from mock import Mock
 
 from stopwatch import (
+    AdaptiveSampler,
+    AggregatedReport,
+    calibrate_overhead,
     format_report,
+    LatencyHistogram,
+    NULL_STOPWATCH,
+    NULL_TIMER,
+    ProbabilitySampler,
+    set_enabled,
+    SpanPathTree,
     TraceAnnotation,
+    TraceBuffer,
     StopWatch,
 )
 
+requires_ns_clock = pytest.mark.skipif(not hasattr(time, 'perf_counter_ns'),
+                                       reason='monotonic_ns requires Python 3.7+')
+
 class MyBuckets(enum.Enum):
     BUCKET_A = 1
     BUCKET_B = 2
@@ -135,6 +152,325 @@ class TestStopWatch(object):
             if len(agg_report.aggregated_values) == 2:
                 assert agg_report.aggregated_values['root#child'] == [60000.0, 1, None]
 
+    def test_reusable_timer(self):
+        sw = StopWatch()
+        root_timer = sw.timer('root')
+        child_timer = sw.timer('child', bucket=MyBuckets.BUCKET_A)
+        for _ in range(2):
+            with root_timer:
+                for _ in range(3):
+                    with child_timer:
+                        with child_timer:
+                            pass
+            agg_values = sw.get_last_aggregated_report().aggregated_values
+            assert sorted(agg_values) == ['root', 'root#child', 'root#child#child']
+            assert agg_values['root#child'][1:] == [3, MyBuckets.BUCKET_A]
+        assert sw.context_manager_depth == 0
+
+        class SpecialError(Exception):
+            pass
+
+        with pytest.raises(SpecialError):
+            with root_timer:
+                raise SpecialError()
+        root_timer_data = sw.get_last_aggregated_report().root_timer_data
+        assert root_timer_data.trace_annotations[0][:2] == ('Exception', 'SpecialError')
+
+    def test_timed(self):
+        sw = StopWatch()
+
+        @sw.timed('work', bucket=MyBuckets.BUCKET_B)
+        def work(x, y=1):
+            """Does work"""
+            return x + y
+
+        @sw.timed()
+        def default_name():
+            pass
+
+        with sw.timer('root'):
+            assert work(1, y=2) == 3
+            assert work(2) == 3
+            default_name()
+        agg_values = sw.get_last_aggregated_report().aggregated_values
+        assert agg_values['root#work'][1:] == [2, MyBuckets.BUCKET_B]
+        assert agg_values['root#default_name'][1] == 1
+        assert work.__name__ == 'work'
+        assert work.__doc__ == 'Does work'
+
+    def test_parent_context(self):
+        export_timers = Mock()
+        sw = StopWatch(export_aggregated_timers_func=export_timers)
+        child_export_timers = Mock()
+        with sw.timer('root', start_time=0, end_time=10):
+            with sw.timer('fanout', start_time=1, end_time=9):
+                context = sw.span_context()
+                assert context.log_name == 'root#fanout'
+                child_sw = StopWatch(parent_context=context,
+                                     export_aggregated_timers_func=child_export_timers)
+                with child_sw.timer('work', start_time=2, end_time=5):
+                    child_sw.add_annotation('child_tag', event_time=3)
+                    with child_sw.timer('inner', start_time=3, end_time=4):
+                        pass
+        assert not child_export_timers.called
+        report = sw.get_last_aggregated_report()
+        assert report.aggregated_values == {
+            'root': [10000.0, 1, None],
+            'root#fanout': [8000.0, 1, None],
+            'root#fanout#work': [3000.0, 1, None],
+            'root#fanout#work#inner': [1000.0, 1, None],
+        }
+        assert report.root_timer_data.trace_annotations == [TraceAnnotation('child_tag', '1', 3)]
+        traces = {trace.name: trace for trace in sw.get_last_trace_report()}
+        assert traces['work'].parent_span_id == traces['fanout'].span_id
+        assert traces['inner'].parent_span_id == traces['work'].span_id
+        assert not context.is_open()
+
+        # Once the parent span is closed, child root scopes are exported on their own
+        with child_sw.timer('late', start_time=20, end_time=21):
+            pass
+        child_report = child_export_timers.call_args[1]['aggregated_report']
+        assert list(child_report.aggregated_values) == ['root#fanout#late']
+        assert sw.span_context() is None
+
+    def test_held_span_context_threads(self):
+        export_timers = Mock()
+        sw = StopWatch(export_aggregated_timers_func=export_timers)
+        started = threading.Event()
+        finish = threading.Event()
+
+        def work(context, i):
+            child_sw = StopWatch(parent_context=context)
+            try:
+                with child_sw.timer('work', start_time=2, end_time=6):
+                    child_sw.add_annotation('worker%d' % i, event_time=3)
+                    started.set()
+                    finish.wait()
+            finally:
+                context.release()
+
+        with sw.timer('root', start_time=0, end_time=10):
+            with sw.timer('fanout', start_time=1, end_time=9):
+                threads = [
+                    threading.Thread(target=work, args=(sw.span_context(hold=True), i))
+                    for i in range(4)
+                ]
+                for thread in threads:
+                    thread.start()
+                started.wait()
+
+        # The root scope ended, but is only exported once all workers are done
+        assert not export_timers.called
+        assert sw.span_context() is None
+        finish.set()
+        for thread in threads:
+            thread.join()
+
+        export_timers.assert_called_once()
+        report = export_timers.call_args[1]['aggregated_report']
+        assert report.aggregated_values == {
+            'root': [10000.0, 1, None],
+            'root#fanout': [8000.0, 1, None],
+            'root#fanout#work': [16000.0, 4, None],
+        }
+        # Work on other threads runs in parallel, it isn't taken out of the parent's time
+        assert report.self_values['root#fanout'] == 8000.0
+        assert sorted(ann.key for ann in report.root_timer_data.trace_annotations) == \
+            ['worker0', 'worker1', 'worker2', 'worker3']
+        traces = sw.get_last_trace_report()
+        fanout = [trace for trace in traces if trace.name == 'fanout'][0]
+        assert [trace.parent_span_id for trace in traces if trace.name == 'work'] == \
+            [fanout.span_id] * 4
+
+    def test_held_span_context_nested(self):
+        export_timers = Mock()
+        sw = StopWatch(export_aggregated_timers_func=export_timers)
+        with sw.timer('root', start_time=0, end_time=10):
+            context = sw.span_context(hold=True)
+            child_sw = StopWatch(parent_context=context)
+            with child_sw.timer('child', start_time=1, end_time=5):
+                grandchild_context = child_sw.span_context(hold=True)
+            # The child's root scope waits for the grandchild, and holds the root open
+            context.release()
+        assert not export_timers.called
+
+        grandchild_sw = StopWatch(parent_context=grandchild_context)
+        with grandchild_sw.timer('grandchild', start_time=2, end_time=3):
+            pass
+        grandchild_context.release()
+        export_timers.assert_called_once()
+        assert sorted(export_timers.call_args[1]['aggregated_report'].aggregated_values) == \
+            ['root', 'root#child', 'root#child#grandchild']
+
+        with pytest.raises(AssertionError):
+            grandchild_context.release()
+
+    def test_max_trace_spans(self):
+        sw = StopWatch(max_trace_spans=3)
+        for _ in range(2):
+            with sw.timer('root', start_time=0, end_time=10):
+                for i in range(10):
+                    with sw.timer('child', start_time=i, end_time=i + 0.5):
+                        pass
+            assert [trace.name for trace in sw.get_last_trace_report()] == \
+                ['child'] * 3 + ['root']
+            assert sw.get_last_aggregated_report().aggregated_values['root#child'][1] == 10
+        assert sw.num_dropped_traces == 14
+
+    def test_max_bytes(self):
+        sw = StopWatch(max_bytes=2000)
+        with sw.timer('root', start_time=0, end_time=100):
+            # 5 traces and their annotations: 1 * 200 + 5 * (150 + 100) = 1450 bytes
+            for i in range(5):
+                with sw.timer('traced', start_time=i, end_time=i + 0.5):
+                    sw.add_span_annotation('i', i)
+            for i in range(5):
+                sw.add_annotation('tag%d' % i)
+            assert sw._used_bytes == 1950
+            assert sw._degradation == 0
+
+            # Over budget: all traces (including the new span's) are dropped first
+            with sw.timer('a', start_time=10, end_time=11):
+                pass
+            assert sw._degradation == 1
+            assert sw.num_dropped_traces == 6
+            assert sw._used_bytes == 2150 - 1250
+
+            # Then annotations
+            for i in range(12):
+                sw.add_annotation('more%d' % i)
+            assert sw._degradation == 2
+            assert sw.num_dropped_annotations == 5 + 12
+            assert sw._used_bytes == 900 - 5 * 100
+
+            # And finally spans with new paths are collapsed into their parent, unless
+            # their children were already aggregated
+            with sw.timer('b', start_time=20, end_time=30):
+                for i in range(10):
+                    with sw.timer('c%d' % i, start_time=20 + i, end_time=21 + i):
+                        with sw.timer('d', start_time=20 + i, end_time=20.5 + i):
+                            pass
+            assert sw._degradation == 3
+
+        assert sw.num_collapsed_spans == 2 * 5
+        agg_report = sw.get_last_aggregated_report()
+        values = agg_report.aggregated_values
+        assert sorted(values) == ['root', 'root#a', 'root#b'] + [
+            'root#b#c%d%s' % (i, suffix) for i in range(5) for suffix in ('', '#d')
+        ] + ['root#traced']
+        assert values['root#b'][0] == 10000.0
+        assert agg_report.self_values['root#b'] == 5000.0
+        assert agg_report.root_timer_data.trace_annotations == []
+        assert [trace.name for trace in sw.get_last_trace_report()] == ['root']
+
+        # Budgets are per root scope
+        with sw.timer('root', start_time=0, end_time=1):
+            with sw.timer('child', start_time=0, end_time=0.5):
+                sw.add_span_annotation('kept')
+        traces = sw.get_last_trace_report()
+        assert [trace.name for trace in traces] == ['child', 'root']
+        assert traces[0].trace_annotations[0].key == 'kept'
+
+    def test_interned_paths(self):
+        sw = StopWatch()
+        paths = []
+        for _ in range(2):
+            with sw.timer('root'):
+                with sw.timer('child'):
+                    paths.append(sw._timer_stack[-1].path)
+        assert paths[0] is paths[1]
+        assert paths[0].log_name == 'root#child'
+        assert paths[0].parent.log_name == 'root'
+        assert sw._paths.num_paths == 2
+
+    def test_path_tree_restart(self):
+        tree = SpanPathTree(max_paths=3)
+        root = tree.root('root')
+        child = root.child('child')
+        assert tree.root('root') is root
+        assert root.child('child') is child
+        root.child('other')
+        assert tree.num_paths == 3
+
+        # The next new path starts the cache over, but already handed out paths keep working
+        tree.root('other_root')
+        assert tree.num_paths == 1
+        new_root = tree.root('root')
+        assert new_root is not root
+        assert new_root.log_name == 'root'
+        assert child.child('grandchild').log_name == 'root#child#grandchild'
+        assert len(set([child.id, new_root.id, root.id])) == 3
+
+    def test_path_tree_restart_mid_root(self):
+        sw = StopWatch()
+        sw._paths.max_paths = 2
+        with sw.timer('root', start_time=0, end_time=10):
+            with sw.timer('a', start_time=0, end_time=1):
+                pass
+            for t in range(2, 6):
+                # Every new top level span reaches the limit and restarts the cache
+                with sw.timer('b%d' % (t % 2), start_time=t, end_time=t + 1):
+                    pass
+        assert sw.get_last_aggregated_report().aggregated_values == {
+            'root': [10000.0, 1, None],
+            'root#a': [1000.0, 1, None],
+            'root#b0': [2000.0, 2, None],
+            'root#b1': [2000.0, 2, None],
+        }
+
+    def test_trace_sampler(self):
+        decisions = iter([False, True])
+        sampler = Mock(side_effect=lambda name: next(decisions))
+        sw = StopWatch(trace_sampler=sampler)
+
+        add_timers(sw)
+        sampler.assert_called_once_with('root')
+        assert sw.get_last_trace_report() == []
+        agg_report = sw.get_last_aggregated_report()
+        assert len(agg_report.aggregated_values) == 8
+        assert [ann.key for ann in agg_report.root_timer_data.trace_annotations] == \
+            ['Cooltag', 'Slowtag']
+
+        add_timers(sw)
+        assert len(sw.get_last_trace_report()) == 10
+
+    def test_trace_sampler_child_stopwatch(self):
+        sw = StopWatch(trace_sampler=lambda name: False)
+        with sw.timer('root', start_time=0, end_time=10):
+            child_sw = StopWatch(parent_context=sw.span_context())
+            with child_sw.timer('child', start_time=1, end_time=5):
+                child_sw.add_span_annotation('ignored')
+        assert sw.get_last_trace_report() == []
+        assert sorted(sw.get_last_aggregated_report().aggregated_values) == \
+            ['root', 'root#child']
+
+    def test_probability_sampler(self):
+        assert not any(ProbabilitySampler(0.0)('root') for _ in range(100))
+        assert all(ProbabilitySampler(1.0)('root') for _ in range(100))
+
+    def test_adaptive_sampler(self):
+        now = [0.0]
+        sampler = AdaptiveSampler(traces_per_second=10, time_func=lambda: now[0])
+
+        def run_seconds(seconds, roots_per_second):
+            traced = 0
+            for i in range(int(seconds * roots_per_second)):
+                traced += sampler('root')
+                now[0] += 1.0 / roots_per_second
+            return traced
+
+        # At most 10 per interval, even before the rate is known
+        assert run_seconds(1, 1000) == 10
+        # Then the probability adapts to the observed rate
+        assert 40 <= run_seconds(10, 1000) <= 100
+        assert abs(sampler.p - 0.01) < 0.001
+        # Traffic spikes are capped (2 seconds overlap at most 3 intervals)
+        assert run_seconds(2, 100000) <= 30
+        # And quiet periods trace everything
+        run_seconds(2, 5)
+        assert sampler.p == 1.0
+        assert run_seconds(2, 5) == 10
+
     def test_scope_in_loop(self):
         sw = StopWatch()
         with sw.timer('root', start_time=20, end_time=120):
@@ -223,6 +559,193 @@ class TestStopWatch(object):
             TraceAnnotation('Slowtag', '1', 920),
         ]
 
+    def test_aggregated_report_tuple(self):
+        sw = StopWatch(latency_histograms=True)
+        with sw.timer('root', start_time=0, end_time=1):
+            with sw.timer('child', start_time=0, end_time=0.25, bucket=MyBuckets.BUCKET_A):
+                pass
+        agg_report = sw.get_last_aggregated_report()
+
+        # Still unpacks as a 2-tuple, the later fields are attributes
+        values, root_timer_data = agg_report
+        assert values is agg_report.aggregated_values
+        assert root_timer_data.log_name == 'root'
+        assert agg_report.self_values == {'root': 750.0, 'root#child': 250.0}
+        assert agg_report.bucket_totals == {MyBuckets.BUCKET_A: 250.0}
+        assert 'bucket_totals=' in repr(agg_report)
+
+        replaced = agg_report._replace(self_values=None)
+        assert tuple(replaced) == tuple(agg_report)
+        assert replaced.self_values is None
+        assert replaced.bucket_totals == agg_report.bucket_totals
+
+        made = AggregatedReport._make(agg_report)
+        assert tuple(made) == tuple(agg_report)
+        assert made.self_values is None
+        assert format_report(made) == format_report(agg_report._replace(
+            self_values=None, bucket_totals=None))
+        made = AggregatedReport._make(agg_report.__getnewargs__())
+        assert format_report(made) == format_report(agg_report)
+        # As is any 2-tuple of the same layout
+        assert format_report(tuple(agg_report)) == format_report(made._replace(
+            self_values=None, bucket_totals=None))
+
+        unpickled = pickle.loads(pickle.dumps(agg_report._replace(histograms=None)))
+        assert unpickled.aggregated_values == values
+        assert unpickled.bucket_totals == {MyBuckets.BUCKET_A: 250.0}
+        assert unpickled.root_timer_data.log_name == 'root'
+
+    def test_pickle_reports(self):
+        sw = StopWatch(min_tracing_milliseconds=0)
+        with sw.timer('root', start_time=0, end_time=1):
+            with sw.timer('child', start_time=0.25, end_time=0.5):
+                sw.add_span_annotation('rows', 3, event_time=0.3)
+        agg_report = pickle.loads(pickle.dumps(sw.get_last_aggregated_report()))
+        assert agg_report.aggregated_values == \
+            sw.get_last_aggregated_report().aggregated_values
+        assert agg_report.root_timer_data.log_name == 'root'
+        assert agg_report.root_timer_data.span_id == \
+            sw.get_last_aggregated_report().root_timer_data.span_id
+
+        traces = pickle.loads(pickle.dumps(sw.get_last_trace_report()))
+        assert [trace.log_name for trace in traces] == ['root#child', 'root']
+        assert traces[0].trace_annotations == sw.get_last_trace_report()[0].trace_annotations
+        # Unpickled paths are interned too
+        assert traces[0].path.parent is traces[1].path
+
+        columnar_sw = StopWatch(min_tracing_milliseconds=0, columnar_traces=True)
+        with columnar_sw.timer('root', start_time=0, end_time=1):
+            with columnar_sw.timer('child', start_time=0.25, end_time=0.5):
+                pass
+        traces = pickle.loads(pickle.dumps(columnar_sw.get_last_trace_report()))
+        assert [trace.log_name for trace in traces] == ['root#child', 'root']
+        assert traces[0].parent_span_id == traces[1].span_id
+
+    def test_latency_histograms(self):
+        sw = StopWatch(latency_histograms=True)
+        with sw.timer('root', start_time=0, end_time=10):
+            for t in range(1, 101):
+                with sw.timer('child', start_time=0, end_time=t / 1000.0):
+                    pass
+
+        histograms = sw.get_last_aggregated_report().histograms
+        assert sorted(histograms) == ['root', 'root#child']
+        child_histogram = histograms['root#child']
+        assert child_histogram.count == 100
+        assert child_histogram.min_ms == 1.0
+        assert child_histogram.max_ms == 100.0
+        for q, expected in [(0.5, 50.5), (0.99, 99), (1.0, 100)]:
+            assert abs(child_histogram.quantile(q) - expected) <= expected * 0.02
+
+        sw = StopWatch()
+        add_timers(sw)
+        assert sw.get_last_aggregated_report().histograms is None
+
+    def test_latency_histogram_merge(self):
+        histogram1 = LatencyHistogram()
+        histogram2 = LatencyHistogram()
+        for value in range(1, 501):
+            histogram1.add(value)
+            histogram2.add(value + 500)
+        histogram2.add(0)
+        histogram2.add(1e12)
+
+        merged = histogram1.copy()
+        merged.merge(histogram2)
+        assert histogram1.count == 500
+        assert merged.count == 1002
+        assert merged.min_ms == 0
+        assert merged.max_ms == 1e12
+        assert abs(merged.quantile(0.5) - 500) <= 500 * 0.01
+        assert abs(merged.quantile(0.999) - 999) <= 999 * 0.01
+        # Values beyond max_ms are clamped into the last bucket
+        assert len(merged._counts) < 1000
+        assert LatencyHistogram().quantile(0.5) is None
+        items = merged.items()
+        assert sum(count for _, count in items) == 1002
+        assert abs(items[1][0] - 1) <= 0.01
+        assert [value for value, _ in items] == sorted(value for value, _ in items)
+
+        with pytest.raises(AssertionError):
+            merged.merge(LatencyHistogram(relative_accuracy=0.05))
+
+    def test_lazy_span_ids(self):
+        sw = StopWatch()
+        fast_spans = []
+        with sw.timer('root', start_time=0, end_time=1):
+            for t in range(3):
+                with sw.timer('fast', start_time=t / 10.0, end_time=t / 10.0 + 0.0001):
+                    fast_spans.append(sw._timer_stack[-1])
+            with sw.timer('slow', start_time=0.5, end_time=0.6):
+                pass
+        traces = sw.get_last_trace_report()
+        assert [trace.name for trace in traces] == ['slow', 'root']
+        assert traces[0].parent_span_id == traces[1].span_id
+        assert len(traces[0].span_id) == 32
+        assert traces[0].span_id != traces[1].span_id
+        # Untraced spans never allocate an id unless asked for one
+        assert all(fast_span._span_id is None for fast_span in fast_spans)
+
+    def test_counter_span_ids(self):
+        sw = StopWatch(counter_span_ids=True)
+        add_timers(sw)
+        span_ids = [trace.span_id for trace in sw.get_last_trace_report()]
+        assert len(set(span_ids)) == len(span_ids)
+        assert all(len(span_id) == 32 for span_id in span_ids)
+        prefixes = set(span_id[:16] for span_id in span_ids)
+        assert len(prefixes) == 1
+
+        add_timers(sw)
+        next_prefixes = set(trace.span_id[:16] for trace in sw.get_last_trace_report())
+        assert next_prefixes != prefixes
+
+    def test_columnar_traces(self):
+        sw = StopWatch(counter_span_ids=True)
+        columnar_sw = StopWatch(counter_span_ids=True, columnar_traces=True)
+        for stopwatch in (sw, columnar_sw):
+            stopwatch._span_id_prefix = 'abcdef0123456789'
+            add_timers(stopwatch)
+
+        traces = sw.get_last_trace_report()
+        columnar_traces = columnar_sw.get_last_trace_report()
+        assert isinstance(columnar_traces, TraceBuffer)
+        assert len(columnar_traces) == len(traces)
+        for trace, columnar_trace in zip(traces, columnar_traces):
+            for attr in ('name', 'log_name', 'span_id', 'parent_span_id', 'start_time',
+                         'end_time', 'child_time', 'trace_annotations', 'self_ms'):
+                assert getattr(columnar_trace, attr) == getattr(trace, attr)
+        # The root span is kept as it is, with its root annotations
+        assert columnar_traces[-1] is columnar_sw.get_last_aggregated_report().root_timer_data
+        assert columnar_traces[-1].trace_annotations == traces[-1].trace_annotations
+        assert columnar_traces[0].name == 'grand_children1'
+        with pytest.raises(IndexError):
+            columnar_traces[len(traces)]
+
+    def test_columnar_traces_parent_context(self):
+        sw = StopWatch(columnar_traces=True)
+        with sw.timer('root', start_time=0, end_time=10):
+            with sw.timer('fanout', start_time=1, end_time=9):
+                child_sw = StopWatch(parent_context=sw.span_context(), columnar_traces=True)
+                with child_sw.timer('work', start_time=2, end_time=5):
+                    child_sw.add_span_annotation('key', 'value', event_time=3)
+        traces = {trace.name: trace for trace in sw.get_last_trace_report()}
+        assert traces['work'].parent_span_id == traces['fanout'].span_id
+        assert traces['fanout'].parent_span_id == traces['root'].span_id
+        assert traces['work'].trace_annotations == [TraceAnnotation('key', 'value', 3)]
+        assert traces['fanout'].child_time == 3000.0
+
+    @requires_ns_clock
+    def test_columnar_traces_monotonic_ns(self):
+        sw = StopWatch(monotonic_ns=True, columnar_traces=True, min_tracing_milliseconds=0)
+        with sw.timer('root', start_time=1000, end_time=5001000):
+            with sw.timer('child', start_time=2000, end_time=1502000):
+                pass
+        traces = sw.get_last_trace_report()
+        root = traces[-1]
+        assert traces[0].end_time - traces[0].start_time == pytest.approx(0.0015, abs=1e-6)
+        assert traces[0].start_time - root.start_time == pytest.approx(0.000001, abs=1e-6)
+        assert root.child_time == pytest.approx(1.5)
+
     def test_trace_annotations(self):
         sw = StopWatch()
         sw.add_annotation('key0', 'value0', event_time=0)
@@ -264,19 +787,342 @@ class TestStopWatch(object):
         agg_report = sw.get_last_aggregated_report()
         formatted_report = format_report(agg_report)
         assert formatted_report == \
-            "root                    900000.000ms (100%)\n" \
-            "    BUCKET_A        child1                  2  240000.000ms (27%)\n" \
-            "                        grand_children1         1  20000.000ms (2%)\n" \
-            "                        grand_children2         2  80000.000ms (9%)\n" \
-            "                        grand_children3         1  10000.000ms (1%)\n" \
-            "    BUCKET_B        child2                  1  560000.000ms (62%)\n" \
-            "                        grand_children1         1  260000.000ms (29%)\n" \
-            "                        grand_children3         1  10000.000ms (1%)\n" \
+            "root                    900000.000ms (100%)  self 100000.000ms (11%)\n" \
+            "    BUCKET_A        child1                  2  240000.000ms (27%)" \
+            "  self 130000.000ms (14%)\n" \
+            "                        grand_children1         1  20000.000ms (2%)" \
+            "  self 20000.000ms (2%)\n" \
+            "                        grand_children2         2  80000.000ms (9%)" \
+            "  self 80000.000ms (9%)\n" \
+            "                        grand_children3         1  10000.000ms (1%)" \
+            "  self 10000.000ms (1%)\n" \
+            "    BUCKET_B        child2                  1  560000.000ms (62%)" \
+            "  self 290000.000ms (32%)\n" \
+            "                        grand_children1         1  260000.000ms (29%)" \
+            "  self 260000.000ms (29%)\n" \
+            "                        grand_children3         1  10000.000ms (1%)" \
+            "  self 10000.000ms (1%)\n" \
+            "Buckets: BUCKET_A 240000.000ms (27%), BUCKET_B 560000.000ms (62%)\n" \
             "Annotations: Cooltag, Slowtag"
 
         formatted_report2 = sw.format_last_report()
         assert formatted_report == formatted_report2
 
+    def test_self_time(self):
+        sw = StopWatch()
+        add_timers(sw)
+
+        agg_report = sw.get_last_aggregated_report()
+        assert agg_report.self_values == {
+            'root': 100000.0,
+            'root#child1': 130000.0,
+            'root#child1#grand_children1': 20000.0,
+            'root#child1#grand_children2': 80000.0,
+            'root#child1#grand_children3': 10000.0,
+            'root#child2': 290000.0,
+            'root#child2#grand_children1': 260000.0,
+            'root#child2#grand_children3': 10000.0,
+        }
+        assert agg_report.root_timer_data.self_ms == 100000.0
+        traces = {trace.span_id: trace for trace in sw.get_last_trace_report()}
+        assert sorted(trace.self_ms for trace in traces.values()
+                      if trace.log_name == 'root#child1') == [60000.0, 70000.0]
+
+        # Without self times, e.g. for reports built elsewhere, the column is left out
+        report = format_report(agg_report._replace(self_values=None))
+        assert report.splitlines()[0] == "root                    900000.000ms (100%)"
+
+    def test_self_time_parent_context(self):
+        parent_sw = StopWatch()
+        with parent_sw.timer('root', start_time=0, end_time=10):
+            child_sw = StopWatch(parent_context=parent_sw.span_context())
+            with child_sw.timer('task', start_time=2, end_time=6):
+                pass
+        assert parent_sw.get_last_aggregated_report().self_values == {
+            'root': 6000.0,
+            'root#task': 4000.0,
+        }
+
+    def test_bucket_totals(self):
+        sw = StopWatch()
+        add_timers(sw)
+        assert sw.get_last_aggregated_report().bucket_totals == {
+            MyBuckets.BUCKET_A: 240000.0,
+            MyBuckets.BUCKET_B: 560000.0,
+        }
+
+        # Spans nested under a span of the same bucket are already part of its time
+        with sw.timer('root', start_time=0, end_time=10):
+            with sw.timer('query', start_time=1, end_time=5, bucket=MyBuckets.BUCKET_A):
+                with sw.timer('retry', start_time=2, end_time=4, bucket=MyBuckets.BUCKET_A):
+                    with sw.timer('rpc', start_time=2, end_time=3, bucket=MyBuckets.BUCKET_B):
+                        pass
+            with sw.timer('handler', start_time=5, end_time=9):
+                with sw.timer('query', start_time=6, end_time=7, bucket=MyBuckets.BUCKET_A):
+                    pass
+        assert sw.get_last_aggregated_report().bucket_totals == {
+            MyBuckets.BUCKET_A: 5000.0,
+            MyBuckets.BUCKET_B: 1000.0,
+        }
+
+        with sw.timer('root', start_time=0, end_time=1):
+            pass
+        assert sw.get_last_aggregated_report().bucket_totals == {}
+
+    def test_bucket_totals_parent_context(self):
+        sw = StopWatch()
+        with sw.timer('root', start_time=0, end_time=10):
+            with sw.timer('query', start_time=1, end_time=9, bucket=MyBuckets.BUCKET_A):
+                child_sw = StopWatch(parent_context=sw.span_context())
+                with child_sw.timer('inner', start_time=2, end_time=3,
+                                    bucket=MyBuckets.BUCKET_A):
+                    pass
+
+            def work(context, bucket):
+                try:
+                    thread_sw = StopWatch(parent_context=context)
+                    with thread_sw.timer('work', start_time=2, end_time=5, bucket=bucket):
+                        pass
+                finally:
+                    context.release()
+
+            with sw.timer('fanout', start_time=1, end_time=9, bucket=MyBuckets.BUCKET_B):
+                threads = [
+                    threading.Thread(target=work, args=(sw.span_context(hold=True), bucket))
+                    for bucket in (MyBuckets.BUCKET_A, MyBuckets.BUCKET_B)
+                ]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+
+        # Work on other threads is added unless an enclosing span has the same bucket
+        assert sw.get_last_aggregated_report().bucket_totals == {
+            MyBuckets.BUCKET_A: 11000.0,
+            MyBuckets.BUCKET_B: 8000.0,
+        }
+
+    def test_calibrate_overhead(self):
+        overhead_ms = calibrate_overhead(num_spans=1000, repeat=2)
+        assert 0.0 < overhead_ms < 1.0
+
+        # A clock which advances 1ms per call: every span adds the 1ms before its start()
+        # to its parent (plus one more 1ms gap after the last span)
+        clock = itertools.count()
+        overhead_ms = calibrate_overhead(lambda: next(clock) / 1000.0, num_spans=10, repeat=1)
+        assert overhead_ms == pytest.approx(1.1)
+
+    @requires_ns_clock
+    def test_calibrate_overhead_monotonic_ns(self):
+        overhead_ms = calibrate_overhead(num_spans=1000, repeat=2, monotonic_ns=True)
+        assert 0.0 < overhead_ms < 1.0
+        # The same clock in integer nanoseconds
+        clock = itertools.count()
+        overhead_ms = calibrate_overhead(lambda: next(clock) * 1000000, num_spans=10,
+                                         repeat=1, monotonic_ns=True)
+        assert overhead_ms == pytest.approx(1.1)
+
+    def test_overhead_compensation(self):
+        def add_root(sw):
+            with sw.timer('root', start_time=0, end_time=1):
+                with sw.timer('child', start_time=0.1, end_time=0.5):
+                    for i in range(10):
+                        start_time = 0.1 + i * 0.02
+                        with sw.timer('grand', start_time=start_time, end_time=start_time + 0.01):
+                            pass
+
+        sw = StopWatch(span_overhead_ms=2.0)
+        add_root(sw)
+        agg_report = sw.get_last_aggregated_report()
+        assert agg_report.overhead_ms == 22.0
+        assert agg_report.aggregated_values['root'] == [1000.0, 1, None]
+        assert format_report(agg_report).splitlines()[-1] == \
+            "Instrumentation overhead: 22.000ms (2%)"
+
+        sw = StopWatch(span_overhead_ms=2.0, compensate_overhead=True)
+        add_root(sw)
+        agg_report = sw.get_last_aggregated_report()
+        assert agg_report.overhead_ms == 22.0
+        assert agg_report.aggregated_values['root'][0] == pytest.approx(978.0)
+        assert agg_report.aggregated_values['root#child'][0] == pytest.approx(380.0)
+        assert agg_report.aggregated_values['root#child#grand'][0] == pytest.approx(100.0)
+        # Each span's overhead is taken out of its direct parent's self time
+        assert agg_report.self_values['root'] == pytest.approx(598.0)
+        assert agg_report.self_values['root#child'] == pytest.approx(280.0)
+
+        # An overestimated overhead can't make a self time negative
+        sw = StopWatch(span_overhead_ms=300.0, compensate_overhead=True)
+        with sw.timer('root', start_time=0, end_time=1):
+            with sw.timer('child', start_time=0.1, end_time=0.9):
+                with sw.timer('a', start_time=0.2, end_time=0.3):
+                    pass
+                with sw.timer('b', start_time=0.4, end_time=0.5):
+                    pass
+        self_ms = sw.get_last_aggregated_report().self_values['root']
+        assert self_ms == 0.0
+        assert isinstance(self_ms, float)
+
+        sw = StopWatch()
+        add_root(sw)
+        assert sw.get_last_aggregated_report().overhead_ms is None
+
+    def test_overhead_parent_context(self):
+        parent_sw = StopWatch(span_overhead_ms=1.0)
+        with parent_sw.timer('root', start_time=0, end_time=10):
+            child_sw = StopWatch(parent_context=parent_sw.span_context())
+            with child_sw.timer('task', start_time=2, end_time=6):
+                with child_sw.timer('step', start_time=3, end_time=4):
+                    pass
+        assert parent_sw.get_last_aggregated_report().overhead_ms == 2.0
+
+    @requires_ns_clock
+    def test_monotonic_ns(self):
+        sw = StopWatch(monotonic_ns=True, min_tracing_milliseconds=0)
+        with sw.timer('root', start_time=1000, end_time=5001000):
+            with sw.timer('child', start_time=2000, end_time=1502000):
+                pass
+            with sw.timer('child', start_time=2000000, end_time=3000001):
+                sw.add_span_annotation('key')
+
+        agg_report = sw.get_last_aggregated_report()
+        assert agg_report.aggregated_values == {
+            'root': [5.0, 1, None],
+            'root#child': [2.500001, 2, None],
+        }
+        assert agg_report.self_values == {'root': 2.499999, 'root#child': 2.500001}
+
+        # Span times are exported as seconds since the epoch, anchored once per root
+        epoch_ns = time.time_ns() - time.perf_counter_ns()
+        now = time.time()
+        traces = sw.get_last_trace_report()
+        root = agg_report.root_timer_data
+        assert traces[-1] is root
+        assert root.end_time == pytest.approx((epoch_ns + 5001000) / 1e9, abs=1)
+        assert root.end_time - root.start_time == pytest.approx(0.005, abs=1e-6)
+        assert traces[1].start_time - root.start_time == pytest.approx(0.001999, abs=1e-6)
+        assert root.self_ms == pytest.approx(2.499999, abs=1e-3)
+        assert abs(traces[1].trace_annotations[0].time - now) < 60
+
+    @requires_ns_clock
+    def test_monotonic_ns_clock(self):
+        sw = StopWatch(monotonic_ns=True)
+        with sw.timer('root'):
+            with sw.timer('child'):
+                pass
+        agg_report = sw.get_last_aggregated_report()
+        root_ms = agg_report.aggregated_values['root'][0]
+        assert isinstance(root_ms, float)
+        assert 0 < agg_report.aggregated_values['root#child'][0] < root_ms < 1000
+        assert abs(agg_report.root_timer_data.start_time - time.time()) < 60
+
+        with sw.timer('root'):
+            with pytest.raises(AssertionError):
+                StopWatch(parent_context=sw.span_context())
+
+    def test_disabled(self):
+        time_mock = Mock(return_value=0)
+        export_timers = Mock()
+        sw = StopWatch(time_func=time_mock, export_aggregated_timers_func=export_timers,
+                       enabled=False)
+
+        @sw.timed()
+        def work():
+            sw.add_span_annotation('key')
+            return 1
+
+        sw.add_annotation('before_root')
+        sw.add_slow_annotation('slow', 0)
+        with sw.timer('root'):
+            with sw.timer('child'):
+                assert work() == 1
+                sw.add_annotation('tag')
+        sw.start('root')
+        sw.end('root')
+        assert not time_mock.called
+        assert not export_timers.called
+        assert not sw._root_annotations and not sw._slow_annotations
+
+        # Enabling takes effect with the next root scope
+        sw.start('skipped')
+        sw.enabled = True
+        with sw.timer('child'):
+            pass
+        sw.end('skipped')
+        sw.enabled = False
+        with sw.timer('skipped'):
+            sw.enabled = True
+            with sw.timer('child'):
+                pass
+        sw.enabled = False
+        with sw.sampling_timer('skipped', p=0.0):
+            sw.enabled = True
+            with sw.timer('child'):
+                pass
+        assert sw._disabled_depth == 0
+        assert not time_mock.called
+        assert not export_timers.called
+        with sw.timer('root', start_time=0, end_time=1):
+            pass
+        export_timers.assert_called_once()
+
+        # A root scope which already started finishes as usual
+        with sw.timer('root', start_time=0, end_time=1):
+            sw.enabled = False
+            with sw.timer('child', start_time=0, end_time=1):
+                pass
+        assert sorted(sw.get_last_aggregated_report().aggregated_values) == \
+            ['root', 'root#child']
+        assert sw._disabled_depth == 0
+
+    def test_disabled_cancel(self):
+        sw = StopWatch(enabled=False)
+        sw.start('root')
+        sw.cancel('root')
+        with sw.timer('root'):
+            sw.cancel('root')
+        assert sw._disabled_depth == 0
+
+        # Reused SpanTimers skip their root scope too
+        sw.enabled = True
+        span_timer = sw.timer('root', start_time=0, end_time=1)
+        sw.enabled = False
+        with span_timer:
+            sw.start('child')
+            sw.cancel('child')
+        sw.enabled = True
+        with span_timer:
+            pass
+        assert sw._disabled_depth == 0
+        assert sw.get_last_aggregated_report().aggregated_values == {'root': [1000.0, 1, None]}
+
+    def test_set_enabled(self):
+        export_timers = Mock()
+        sw = StopWatch(export_aggregated_timers_func=export_timers)
+
+        @sw.timed()
+        def work():
+            set_enabled(True)
+            with sw.timer('child'):
+                pass
+
+        set_enabled(False)
+        try:
+            work()
+            set_enabled(False)
+            with sw.timer('root'):
+                set_enabled(True)
+                work()
+        finally:
+            set_enabled(True)
+        assert sw._disabled_depth == 0
+        assert not export_timers.called
+        with NULL_TIMER:
+            pass
+
+        # The no-op stopwatch used while disabled has the whole public interface
+        public = set(name for name in dir(StopWatch()) if not name.startswith('_'))
+        assert public <= set(dir(NULL_STOPWATCH))
+
     def test_time_func(self):
         """Test override of the time_func"""
         time_mock = Mock(side_effect=[50, 70])
@@ -0,0 +1,86 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from mock import Mock
+
+from stopwatch import StopWatch
+from stopwatch_aggregator import (
+    AggregatedStats,
+    RollingAggregator,
+)
+from testutils import add_root
+
+
+class TestRollingAggregator(object):
+    def test_merge_across_roots(self):
+        aggregator = RollingAggregator(window_seconds=60)
+        sw = StopWatch(export_aggregated_timers_func=aggregator)
+        add_root(sw, 'root', 0, 1, [100, 100])
+        add_root(sw, 'root', 10, 11, [50])
+        add_root(sw, 'root', 20, 21, [400])
+
+        merged = aggregator.merged()
+        assert merged['root'] == AggregatedStats(3, 3000.0, 1000.0, 1000.0, None)
+        assert merged['root#child'].count == 4
+        assert round(merged['root#child'].total_ms) == 650
+        assert round(merged['root#child'].min_ms) == 50
+        assert round(merged['root#child'].max_ms) == 400
+        assert aggregator.windows()[0].num_roots == 3
+
+    def test_rollover(self):
+        rollover = Mock()
+        aggregator = RollingAggregator(window_seconds=60, num_windows=2, rollover_func=rollover)
+        sw = StopWatch(export_aggregated_timers_func=aggregator)
+        add_root(sw, 'root', 0, 1, [100])
+        add_root(sw, 'root', 30, 31, [100])
+        assert not rollover.called
+
+        add_root(sw, 'root', 70, 71, [100])
+        rollover.assert_called_once_with(aggregator.windows()[0])
+        assert [w.start_time for w in aggregator.windows()] == [0, 60]
+        assert aggregator.merged()['root'].count == 3
+
+        # Oldest window is evicted once num_windows is exceeded
+        add_root(sw, 'root', 130, 131, [100])
+        assert [w.start_time for w in aggregator.windows()] == [60, 120]
+        assert aggregator.merged()['root'].count == 2
+
+    def test_rollover_single_window(self):
+        rollover = Mock()
+        aggregator = RollingAggregator(window_seconds=60, rollover_func=rollover)
+        sw = StopWatch(export_aggregated_timers_func=aggregator)
+        add_root(sw, 'root', 0, 1, [100])
+        first_window = aggregator.windows()[0]
+        add_root(sw, 'root', 70, 71, [100])
+        rollover.assert_called_once_with(first_window)
+        assert first_window.values()['root'].count == 1
+        assert aggregator.merged()['root'].count == 1
+
+    def test_late_reports(self):
+        aggregator = RollingAggregator(window_seconds=60, num_windows=2)
+        sw = StopWatch(export_aggregated_timers_func=aggregator)
+        add_root(sw, 'root', 130, 131, [100])
+        add_root(sw, 'root', 70, 71, [100])
+        add_root(sw, 'root', 10, 11, [100])
+
+        windows = aggregator.windows()
+        assert [w.start_time for w in windows] == [120]
+        assert windows[0].num_roots == 1
+        assert aggregator.num_late_reports == 2
+
+        add_root(sw, 'root', 190, 191, [100])
+        add_root(sw, 'root', 150, 151, [100])
+        assert [w.num_roots for w in aggregator.windows()] == [2, 1]
+
+    def test_merged_histograms(self):
+        aggregator = RollingAggregator(window_seconds=60, num_windows=2)
+        sw = StopWatch(export_aggregated_timers_func=aggregator, latency_histograms=True)
+        for i in range(100):
+            add_root(sw, 'root', i, i + 1, [i + 1])
+
+        histograms = aggregator.merged_histograms()
+        assert histograms['root#child'].count == 100
+        assert abs(histograms['root#child'].quantile(0.99) - 99) < 99 * 0.02
+        # Merging must not modify the reported histograms
+        assert sw.get_last_aggregated_report().histograms['root#child'].count == 1
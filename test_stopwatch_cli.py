@@ -0,0 +1,121 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import io
+import json
+
+import pytest
+
+from stopwatch import StopWatch
+from stopwatch_cli import (
+    Capture,
+    JsonLinesReportWriter,
+    main,
+)
+from stopwatch_tracelog import TraceLogWriter
+from testutils import add_request
+
+
+def write_reports(path, num_roots=2, query_ms=100):
+    writer = JsonLinesReportWriter(path)
+    sw = StopWatch(export_aggregated_timers_func=writer)
+    for i in range(num_roots):
+        add_request(sw, i * 10, query_ms)
+    writer.close()
+
+
+def run(*argv):
+    out = io.StringIO()
+    assert main(list(argv), out) == 0
+    return out.getvalue().splitlines()
+
+
+@pytest.fixture
+def reports_path(tmpdir):
+    path = str(tmpdir.join('reports.jsonl'))
+    write_reports(path)
+    return path
+
+
+class TestCli(object):
+    def test_json_lines_writer(self, reports_path):
+        with open(reports_path) as f:
+            reports = [json.loads(line) for line in f]
+        assert len(reports) == 2
+        assert reports[1]['root'] == 'request'
+        assert reports[1]['start_time'] == 10
+        assert reports[1]['values']['request#handler#query'] == [pytest.approx(100), 1, 'DB']
+        assert reports[1]['self_values']['request#handler'] == pytest.approx(400)
+        assert reports[1]['bucket_totals'] == {'DB': pytest.approx(100), 'RPC': pytest.approx(200)}
+
+    def test_capture(self, reports_path):
+        capture = Capture.from_files([reports_path, reports_path])
+        assert capture.num_roots == 4
+        assert capture.values['request#rpc'] == [pytest.approx(800), 4, 'RPC']
+
+        self_times = capture.self_times()
+        assert self_times['request'] == pytest.approx(4 * 300)
+        assert self_times['request#handler'] == pytest.approx(4 * 400)
+        assert self_times['request#handler#query'] == pytest.approx(4 * 50)
+
+        # The nested query is already part of its parent's DB time
+        assert capture.bucket_totals() == {
+            'DB': pytest.approx(400), 'RPC': pytest.approx(800)}
+
+        # Reports without bucket totals get them from the bucket of each path's ancestors
+        derived = Capture()
+        derived.add(capture.values)
+        assert derived.bucket_totals() == capture.bucket_totals()
+
+    def test_folded(self, reports_path):
+        assert run('folded', reports_path) == [
+            'request 600000',
+            'request;handler 800000',
+            'request;handler;query 100000',
+            'request;handler;query;query 100000',
+            'request;rpc 400000',
+        ]
+
+    def test_top(self, reports_path):
+        lines = run('top', '-n', '2', reports_path)
+        assert len(lines) == 3
+        assert lines[1].split() == ['800.000', '1000.000', '2', '40.0%', 'request#handler']
+        assert lines[2].split()[-1] == 'request'
+
+        lines = run('top', '-n', '1', '--by', 'inclusive', reports_path)
+        assert lines[1].split()[-1] == 'request'
+
+    def test_buckets(self, reports_path):
+        assert [line.split() for line in run('buckets', reports_path)[1:]] == [
+            ['400.000', '200.000', 'RPC'],
+            ['200.000', '100.000', 'DB'],
+        ]
+
+    def test_diff(self, tmpdir, reports_path):
+        after_path = str(tmpdir.join('after.jsonl'))
+        write_reports(after_path, num_roots=4, query_ms=300)
+        lines = run('diff', '-n', '2', reports_path, after_path)
+        assert lines[1].split() == [
+            '100.000', '300.000', '+200.000', '+200.0%', 'request#handler#query']
+        assert len(lines) == 3
+
+    def test_trace_log(self, tmpdir):
+        log_path = str(tmpdir.join('traces.swlog'))
+        writer = TraceLogWriter(log_path)
+        sw = StopWatch(export_tracing_func=writer)
+        add_request(sw, 0)
+        writer.close()
+
+        assert run('folded', log_path) == [
+            'request 300000',
+            'request;handler 400000',
+            'request;handler;query 50000',
+            'request;handler;query;query 50000',
+            'request;rpc 200000',
+        ]
+
+    def test_empty_input(self, tmpdir):
+        path = tmpdir.join('empty.jsonl')
+        path.write('')
+        assert main(['top', str(path)], io.StringIO()) == 1
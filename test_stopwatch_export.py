@@ -0,0 +1,127 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import threading
+
+import pytest
+
+from stopwatch import StopWatch
+from stopwatch_export import (
+    BackgroundExporter,
+    BLOCK,
+    DROP_NEWEST,
+    DROP_OLDEST,
+)
+from testutils import add_root
+
+
+class BlockingBatchFunc(object):
+    """Export function which holds the worker thread until released"""
+    def __init__(self):
+        self.batches = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def __call__(self, batch):
+        self.started.set()
+        self.release.wait(5)
+        self.batches.append(batch)
+
+
+@pytest.fixture
+def blocked_exporter(request):
+    """Returns an exporter (with policy request.param) whose worker is blocked
+    exporting root 'r0'"""
+    batch_func = BlockingBatchFunc()
+    exporter = BackgroundExporter(batch_func, max_queue_size=2, overflow_policy=request.param)
+    sw = StopWatch(export_aggregated_timers_and_tracing_func=exporter)
+    add_root(sw, 'r0', 0, 1, [500])
+    assert batch_func.started.wait(5)
+
+    def fin():
+        batch_func.release.set()
+        exporter.close(5)
+    request.addfinalizer(fin)
+    return exporter, batch_func, sw
+
+
+def exported_names(batch_func):
+    return [item.aggregated_report.root_timer_data.name
+            for batch in batch_func.batches for item in batch]
+
+
+class TestBackgroundExporter(object):
+    def test_batches(self):
+        batch_func = BlockingBatchFunc()
+        exporter = BackgroundExporter(batch_func, max_batch_size=3)
+        sw = StopWatch(export_aggregated_timers_and_tracing_func=exporter)
+        add_root(sw, 'r0', 0, 1, [500])
+        assert batch_func.started.wait(5)
+        for i in range(1, 6):
+            add_root(sw, 'r%d' % i, 0, 1, [500])
+        assert exporter.queue_size() == 5
+
+        batch_func.release.set()
+        assert exporter.flush(5)
+        assert [len(batch) for batch in batch_func.batches] == [1, 3, 2]
+        assert exported_names(batch_func) == ['r%d' % i for i in range(6)]
+        item = batch_func.batches[0][0]
+        assert sorted(item.aggregated_report.aggregated_values) == ['r0', 'r0#child']
+        assert [trace.name for trace in item.reported_traces] == ['child', 'r0']
+        assert (exporter.num_enqueued, exporter.num_exported, exporter.num_dropped) == (6, 6, 0)
+
+        exporter.close(5)
+        add_root(sw, 'late', 0, 1, [500])
+        assert exporter.num_dropped == 1
+
+    @pytest.mark.parametrize('blocked_exporter', [DROP_OLDEST], indirect=True)
+    def test_drop_oldest(self, blocked_exporter):
+        exporter, batch_func, sw = blocked_exporter
+        for i in range(1, 5):
+            add_root(sw, 'r%d' % i, 0, 1, [500])
+        assert exporter.num_dropped == 2
+        batch_func.release.set()
+        assert exporter.flush(5)
+        assert exported_names(batch_func) == ['r0', 'r3', 'r4']
+
+    @pytest.mark.parametrize('blocked_exporter', [DROP_NEWEST], indirect=True)
+    def test_drop_newest(self, blocked_exporter):
+        exporter, batch_func, sw = blocked_exporter
+        for i in range(1, 5):
+            add_root(sw, 'r%d' % i, 0, 1, [500])
+        assert exporter.num_dropped == 2
+        batch_func.release.set()
+        assert exporter.flush(5)
+        assert exported_names(batch_func) == ['r0', 'r1', 'r2']
+
+    @pytest.mark.parametrize('blocked_exporter', [BLOCK], indirect=True)
+    def test_block(self, blocked_exporter):
+        exporter, batch_func, sw = blocked_exporter
+        add_root(sw, 'r1', 0, 1, [500])
+        add_root(sw, 'r2', 0, 1, [500])
+
+        thread = threading.Thread(target=add_root, args=(StopWatch(
+            export_aggregated_timers_and_tracing_func=exporter), 'r3', 0, 1, [500]))
+        thread.start()
+        thread.join(0.1)
+        assert thread.is_alive()
+
+        batch_func.release.set()
+        thread.join(5)
+        assert exporter.flush(5)
+        assert exported_names(batch_func) == ['r0', 'r1', 'r2', 'r3']
+        assert exporter.num_dropped == 0
+
+    def test_export_errors(self):
+        def failing_batch_func(batch):
+            raise ValueError("broken exporter")
+
+        exporter = BackgroundExporter(failing_batch_func)
+        sw = StopWatch(export_aggregated_timers_and_tracing_func=exporter)
+        add_root(sw, 'r0', 0, 1, [500])
+        assert exporter.flush(5)
+        add_root(sw, 'r1', 0, 1, [500])
+        exporter.close(5)
+        assert exporter.num_export_errors == 2
+        assert exporter.num_exported == 0
@@ -2,14 +2,18 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import threading
+
 import pytest
 
 from mock import Mock
 
+from stopwatch import set_enabled
 from stopwatch_global import (
     global_sw,
     global_sw_del,
     global_sw_init,
+    propagate,
 )
 
 
@@ -52,3 +56,70 @@ class TestStopWatchGlobal(object):
         tracing_func.assert_called_once_with(reported_traces=reported_traces)
         agg_timers_and_tracing_func.assert_called_once_with(aggregated_report=last_report,
                                                             reported_traces=reported_traces)
+
+    def test_trace_sampler(self):
+        tracing_func = Mock()
+        global_sw_init(export_tracing_func=tracing_func, trace_sampler=lambda name: False)
+        self.add_spans()
+        tracing_func.assert_called_once_with(reported_traces=[])
+
+    def test_disabled(self):
+        export_timers = Mock()
+        global_sw_init(export_aggregated_timers_func=export_timers)
+        set_enabled(False)
+        try:
+            with global_sw().timer('root'):
+                global_sw().add_span_annotation('key')
+            assert not export_timers.called
+            assert global_sw().get_last_aggregated_report() is None
+
+            # Enabling in the middle of a request takes effect with the next one
+            with global_sw().timer('request'):
+                set_enabled(True)
+                with global_sw().timer('db'):
+                    pass
+            assert not export_timers.called
+
+            # A root scope that started while enabled finishes as usual
+            with global_sw().timer('root'):
+                set_enabled(False)
+                with global_sw().timer('child'):
+                    pass
+        finally:
+            set_enabled(True)
+        report = export_timers.call_args[1]['aggregated_report']
+        assert sorted(report.aggregated_values) == ['root', 'root#child']
+
+    def test_propagate(self):
+        export_timers = Mock()
+        global_sw_init(export_aggregated_timers_func=export_timers)
+
+        def fetch(i):
+            with global_sw().timer('fetch'):
+                global_sw().add_span_annotation('i', i)
+            return i
+
+        results = []
+        with global_sw().timer('request'):
+            with global_sw().timer('fanout'):
+                threads = [
+                    threading.Thread(target=lambda func, i: results.append(func(i)),
+                                     args=(propagate(fetch), i))
+                    for i in range(3)
+                ]
+                for thread in threads:
+                    thread.start()
+            for thread in threads:
+                thread.join()
+
+        assert sorted(results) == [0, 1, 2]
+        export_timers.assert_called_once()
+        report = export_timers.call_args[1]['aggregated_report']
+        assert sorted(report.aggregated_values) == ['request', 'request#fanout',
+                                                    'request#fanout#fetch']
+        assert report.aggregated_values['request#fanout#fetch'][1] == 3
+        # Worker threads get their own stopwatch back afterwards
+        assert global_sw().span_context() is None
+
+        # Without an open span, functions run as is
+        assert propagate(fetch) is fetch
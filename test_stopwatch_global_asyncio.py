@@ -0,0 +1,146 @@
+import asyncio
+
+import pytest
+
+from mock import Mock
+
+from stopwatch_global import (
+    global_sw,
+    global_sw_del,
+    global_sw_init,
+    propagate,
+)
+
+
+@pytest.fixture
+def global_sw_fixture(request):
+    request.addfinalizer(global_sw_del)
+
+
+class FakeClock(object):
+    """time_func which advances 1 second on every call"""
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        self.now += 1
+        return self.now
+
+
+async def handle_request(name, delay):
+    with global_sw().timer(name):
+        await asyncio.sleep(delay)
+        with global_sw().timer('db'):
+            await asyncio.sleep(delay)
+
+
+async def fetch(delay):
+    with global_sw().timer('fetch'):
+        await asyncio.sleep(delay)
+        global_sw().add_annotation('fetched')
+
+
+@pytest.mark.usefixtures('global_sw_fixture')
+class TestStopWatchGlobalAsyncio(object):
+    def test_concurrent_tasks(self):
+        export_timers = Mock()
+        global_sw_init(use_contextvars=True, export_aggregated_timers_func=export_timers)
+
+        async def main():
+            await asyncio.gather(
+                handle_request('req1', 0.01),
+                handle_request('req2', 0.005),
+                handle_request('req3', 0),
+            )
+        asyncio.run(main())
+
+        reports = [call[1]['aggregated_report'] for call in export_timers.call_args_list]
+        assert sorted(sorted(report.aggregated_values) for report in reports) == [
+            ['req1', 'req1#db'], ['req2', 'req2#db'], ['req3', 'req3#db'],
+        ]
+
+    def test_child_tasks(self):
+        export_timers = Mock()
+        export_tracing = Mock()
+        global_sw_init(use_contextvars=True, time_func=FakeClock(),
+                       export_aggregated_timers_func=export_timers,
+                       export_tracing_func=export_tracing)
+
+        async def request():
+            with global_sw().timer('request'):
+                with global_sw().timer('fanout'):
+                    await asyncio.gather(fetch(0.01), fetch(0), fetch(0.005))
+                task = asyncio.get_running_loop().create_task(fetch(0))
+                await task
+
+        asyncio.run(request())
+
+        export_timers.assert_called_once()
+        report = export_timers.call_args[1]['aggregated_report']
+        values = report.aggregated_values
+        assert sorted(values) == ['request', 'request#fanout', 'request#fanout#fetch',
+                                  'request#fetch']
+        assert values['request#fanout#fetch'][1] == 3
+        assert values['request#fetch'][1] == 1
+        assert [ann.key for ann in report.root_timer_data.trace_annotations] == ['fetched'] * 4
+
+        traces = export_tracing.call_args[1]['reported_traces']
+        spans = {trace.span_id: trace for trace in traces}
+        for trace in traces:
+            if trace.name == 'fetch':
+                parent = spans[trace.parent_span_id]
+                assert trace.log_name == parent.log_name + '#fetch'
+
+    def test_self_time_of_child_tasks(self):
+        export_timers = Mock()
+        global_sw_init(use_contextvars=True, export_aggregated_timers_func=export_timers)
+
+        async def request():
+            with global_sw().timer('req'):
+                await asyncio.gather(*[fetch(0.01) for _ in range(5)])
+            with global_sw().timer('seq'):
+                for _ in range(2):
+                    await asyncio.get_running_loop().create_task(fetch(0.01))
+
+        asyncio.run(request())
+        report = export_timers.call_args_list[0][1]['aggregated_report']
+        values = report.aggregated_values
+        # Concurrent tasks overlap, so they aren't subtracted from their parent
+        assert report.self_values['req'] == values['req'][0]
+        assert report.self_values['req#fetch'] == values['req#fetch'][0]
+
+        # Tasks awaited one at a time are
+        report = export_timers.call_args_list[1][1]['aggregated_report']
+        values = report.aggregated_values
+        assert report.self_values['seq'] == \
+            pytest.approx(values['seq'][0] - values['seq#fetch'][0])
+        assert report.self_values['seq'] < values['seq#fetch'][0]
+
+    def test_outside_of_tasks(self):
+        global_sw_init(use_contextvars=True)
+        sw = global_sw()
+        assert global_sw() is sw
+        with sw.timer('root'):
+            pass
+        assert list(sw.get_last_aggregated_report().aggregated_values) == ['root']
+
+    def test_propagate_to_executor(self):
+        export_timers = Mock()
+        global_sw_init(use_contextvars=True, export_aggregated_timers_func=export_timers)
+
+        def blocking_fetch():
+            with global_sw().timer('blocking_fetch'):
+                pass
+
+        async def request():
+            with global_sw().timer('request'):
+                loop = asyncio.get_running_loop()
+                await asyncio.gather(*[
+                    loop.run_in_executor(None, propagate(blocking_fetch)) for _ in range(3)
+                ])
+
+        asyncio.run(request())
+        export_timers.assert_called_once()
+        values = export_timers.call_args[1]['aggregated_report'].aggregated_values
+        assert sorted(values) == ['request', 'request#blocking_fetch']
+        assert values['request#blocking_fetch'][1] == 3
@@ -0,0 +1,155 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import threading
+import time
+
+import pytest
+
+from stopwatch import (
+    NULL_STOPWATCH,
+    StopWatch,
+)
+from stopwatch_global import (
+    global_sw,
+    global_sw_del,
+    global_sw_init,
+)
+from stopwatch_profiler import SpanProfiler
+
+
+def busy(running):
+    count = 0
+    while running:
+        count += 1
+    return count
+
+
+class Worker(object):
+    """Runs busy() in the span root#render of a registered stopwatch on another thread"""
+
+    def __init__(self, profiler):
+        self.profiler = profiler
+        self.sw = StopWatch()
+        self.running = [True]
+        self.started = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+
+    def run(self):
+        self.profiler.register(self.sw)
+        with self.sw.timer('root'):
+            with self.sw.timer('render'):
+                self.started.set()
+                busy(self.running)
+
+    def __enter__(self):
+        self.thread.start()
+        self.started.wait()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        del self.running[:]
+        self.thread.join()
+
+
+class TestSpanProfiler(object):
+    def test_sample(self):
+        profiler = SpanProfiler()
+        with Worker(profiler):
+            for _ in range(5):
+                profiler.sample()
+        assert profiler.num_samples == 5
+
+        hotspots = profiler.hotspots()
+        assert list(hotspots) == ['root#render']
+        function, self_samples, total_samples = hotspots['root#render'][0]
+        assert function.endswith(':busy')
+        assert self_samples == total_samples == 5
+        assert any(name.endswith('run') and self_count == 0 and total == 5
+                   for name, self_count, total in hotspots['root#render'])
+
+        folded = profiler.folded()
+        assert len(folded) == 1
+        stack, count = folded[0].rsplit(' ', 1)
+        assert stack.startswith('root;render;')
+        assert stack.endswith(';test_stopwatch_profiler.py:busy')
+        assert count == '5'
+
+        profiler.reset()
+        assert profiler.folded() == []
+        assert profiler.num_samples == 0
+
+    def test_threads_without_spans(self):
+        profiler = SpanProfiler()
+        profiler.register(StopWatch())
+        profiler.sample()
+        assert profiler.num_samples == 0
+        profiler.register(NULL_STOPWATCH)
+        profiler.sample()
+        assert profiler.num_samples == 0
+
+        # Threads which are gone are unregistered
+        thread = threading.Thread(target=profiler.register, args=(StopWatch(),))
+        thread.start()
+        thread.join()
+        assert len(profiler._stopwatches) == 2
+        profiler.sample()
+        assert len(profiler._stopwatches) == 1
+        profiler.unregister()
+        assert not profiler._stopwatches
+
+    def test_bounded(self):
+        profiler = SpanProfiler(max_depth=2, max_stacks=1)
+        sw = StopWatch()
+        profiler.register(sw)
+        with sw.timer('root'):
+            profiler.sample()
+            with sw.timer('child'):
+                profiler.sample()
+        assert profiler.num_samples == 1
+        assert profiler.num_dropped_samples == 1
+        # Only the innermost frames are kept
+        stack = profiler.folded()[0].rsplit(' ', 1)[0].split(';')
+        assert stack[0] == 'root'
+        assert stack[-1].endswith('sample')
+        assert len(stack) == 3
+
+        with pytest.raises(AssertionError):
+            SpanProfiler(interval=0.0001)
+
+    def test_background_thread(self):
+        profiler = SpanProfiler(interval=0.001)
+        with Worker(profiler):
+            profiler.start()
+            deadline = time.time() + 10
+            while not profiler.num_samples and time.time() < deadline:
+                time.sleep(0.01)
+            profiler.stop()
+        assert profiler.num_samples > 0
+        assert list(profiler.hotspots()) == ['root#render']
+
+    def test_global_sw(self):
+        profiler = SpanProfiler()
+        global_sw_init()
+        try:
+            profiler.register(global_sw())
+            with global_sw().timer('root'):
+                profiler.sample()
+        finally:
+            global_sw_del()
+        assert profiler.num_samples == 1
+
+        # Tasks sharing a thread have their own stopwatches, which can't be sampled
+        global_sw_init(use_contextvars=True)
+        try:
+            with pytest.raises(AssertionError):
+                profiler.register(global_sw())
+            # Stopwatches not from global_sw() still can
+            sw = StopWatch()
+            profiler.register(sw)
+            with sw.timer('root'):
+                profiler.sample()
+        finally:
+            global_sw_del()
+        assert profiler.num_samples == 2
@@ -0,0 +1,125 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import threading
+
+try:
+    from urllib.request import urlopen
+    from urllib.error import HTTPError
+except ImportError:  # Python 2
+    from urllib2 import urlopen, HTTPError
+
+import pytest
+
+from stopwatch import StopWatch
+from stopwatch_prometheus import (
+    CONTENT_TYPE,
+    PrometheusMetrics,
+)
+from testutils import add_request
+
+
+def parse(text):
+    samples = {}
+    for line in text.splitlines():
+        if not line.startswith('#'):
+            name, value = line.rsplit(' ', 1)
+            samples[name] = float(value)
+    return samples
+
+
+class TestPrometheusMetrics(object):
+    def test_render(self):
+        metrics = PrometheusMetrics()
+        sw = StopWatch(export_aggregated_timers_func=metrics)
+        add_request(sw, 0)
+        add_request(sw, 10)
+
+        text = metrics.render()
+        assert '# TYPE stopwatch_span_seconds_total counter' in text
+        assert '# TYPE stopwatch_span_duration_seconds histogram' in text
+        samples = parse(text)
+        assert samples['stopwatch_roots_total'] == 2
+        assert samples['stopwatch_spans_total{path="request#handler#query#query"}'] == 2
+        assert samples['stopwatch_span_seconds_total{path="request"}'] == pytest.approx(2.0)
+        assert samples['stopwatch_span_self_seconds_total{path="request"}'] == \
+            pytest.approx(0.6)
+        assert samples['stopwatch_bucket_seconds_total{bucket="DB"}'] == pytest.approx(0.2)
+        assert samples['stopwatch_bucket_seconds_total{bucket="RPC"}'] == pytest.approx(0.4)
+
+        # Without latency_histograms only root spans are observed
+        assert samples['stopwatch_span_duration_seconds_bucket{path="request",le="0.5"}'] == 0
+        assert samples['stopwatch_span_duration_seconds_bucket{path="request",le="1.0"}'] == 2
+        assert samples['stopwatch_span_duration_seconds_bucket{path="request",le="+Inf"}'] == 2
+        assert samples['stopwatch_span_duration_seconds_sum{path="request"}'] == \
+            pytest.approx(2.0)
+        assert samples['stopwatch_span_duration_seconds_count{path="request"}'] == 2
+        assert 'path="request#handler"' not in text.split('# TYPE stopwatch_span_duration')[1]
+
+    def test_latency_histograms(self):
+        metrics = PrometheusMetrics(namespace='app', buckets_seconds=(0.15, 1.0))
+        sw = StopWatch(export_aggregated_timers_func=metrics, latency_histograms=True)
+        add_request(sw, 0)
+
+        samples = parse(metrics.render())
+        assert samples['app_span_duration_seconds_bucket{path="request#rpc",le="0.15"}'] == 0
+        assert samples['app_span_duration_seconds_bucket{path="request#rpc",le="1.0"}'] == 1
+        assert samples['app_span_duration_seconds_bucket{path="request#handler#query",le="0.15"}'] \
+            == 1
+        assert samples['app_span_duration_seconds_count{path="request"}'] == 1
+
+    def test_threads(self):
+        metrics = PrometheusMetrics()
+
+        def work():
+            sw = StopWatch(export_aggregated_timers_func=metrics)
+            for i in range(50):
+                add_request(sw, i)
+
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        samples = parse(metrics.render())
+        assert samples['stopwatch_roots_total'] == 200
+        assert samples['stopwatch_spans_total{path="request#rpc"}'] == 200
+        # The shards of the exited threads were folded into the retired shard
+        assert metrics._shards == []
+        assert metrics._retired.num_roots == 200
+
+        # The live thread keeps its own shard
+        sw = StopWatch(export_aggregated_timers_func=metrics)
+        add_request(sw, 0)
+        samples = parse(metrics.render())
+        assert samples['stopwatch_roots_total'] == 201
+        assert samples['stopwatch_spans_total{path="request#rpc"}'] == 201
+        assert len(metrics._shards) == 1
+        add_request(sw, 0)
+        assert parse(metrics.render())['stopwatch_roots_total'] == 202
+        assert metrics._retired.num_roots == 200
+
+    def test_escape(self):
+        metrics = PrometheusMetrics()
+        sw = StopWatch(export_aggregated_timers_func=metrics)
+        with sw.timer('say "hi"\\', start_time=0, end_time=1):
+            pass
+        assert 'stopwatch_spans_total{path="say \\"hi\\"\\\\"} 1' in metrics.render()
+
+    def test_serve(self):
+        metrics = PrometheusMetrics()
+        sw = StopWatch(export_aggregated_timers_func=metrics)
+        add_request(sw, 0)
+
+        server = metrics.serve()
+        try:
+            response = urlopen('http://127.0.0.1:%d/metrics' % server.port)
+            assert response.headers['Content-Type'] == CONTENT_TYPE
+            assert response.read().decode('utf-8') == metrics.render()
+
+            with pytest.raises(HTTPError):
+                urlopen('http://127.0.0.1:%d/other' % server.port)
+        finally:
+            server.close()
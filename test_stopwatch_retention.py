@@ -0,0 +1,119 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import threading
+
+import pytest
+
+from mock import Mock
+
+from stopwatch import (
+    StopWatch,
+    TraceBuffer,
+)
+from stopwatch_retention import TailRetention
+from testutils import add_root
+
+
+def exported_roots(export_tracing):
+    return [
+        (call[1]['reported_traces'][-1].name, call[1]['reported_traces'][-1].start_time)
+        for call in export_tracing.call_args_list
+    ]
+
+
+class TestTailRetention(object):
+    def test_top_k_per_name(self):
+        export_tracing = Mock()
+        retention = TailRetention(export_tracing, top_k=2, window_seconds=60)
+        sw = StopWatch(export_aggregated_timers_and_tracing_func=retention)
+        for start_time, duration in [(0, 1), (1, 5), (2, 3), (3, 4), (4, 2)]:
+            add_root(sw, 'a', start_time, start_time + duration)
+        add_root(sw, 'b', 10, 10.5)
+        assert not export_tracing.called
+
+        # The first root of the next window exports the previous one
+        add_root(sw, 'a', 60, 61)
+        assert exported_roots(export_tracing) == [('a', 1), ('a', 3), ('b', 10)]
+        assert retention.num_discarded == 3
+
+        retention.flush()
+        assert exported_roots(export_tracing)[-1] == ('a', 60)
+        assert retention.num_retained == 4
+
+    def test_flagged_roots(self):
+        export_tracing = Mock()
+        retention = TailRetention(export_tracing, top_k=1, window_seconds=60)
+        sw = StopWatch(export_aggregated_timers_and_tracing_func=retention)
+        add_root(sw, 'a', 0, 10)
+        with pytest.raises(ValueError):
+            with sw.timer('a', start_time=1, end_time=1.1):
+                raise ValueError()
+        sw.add_slow_annotation('slow', 0.2)
+        add_root(sw, 'a', 2, 2.3)
+        add_root(sw, 'a', 3, 3.1)
+
+        retention.flush()
+        assert exported_roots(export_tracing) == [('a', 0), ('a', 1), ('a', 2)]
+        assert retention.num_discarded == 1
+
+    def test_max_flagged(self):
+        export_tracing = Mock()
+        retention = TailRetention(export_tracing, max_flagged=2,
+                                  keep_annotation_keys=['interesting'])
+        sw = StopWatch(export_aggregated_timers_and_tracing_func=retention)
+        for i in range(4):
+            sw.add_annotation('interesting')
+            add_root(sw, 'a', i, i + 0.1)
+        retention.flush()
+        assert exported_roots(export_tracing) == [('a', 0), ('a', 1)]
+        assert retention.num_discarded == 2
+
+    def test_compact_traces(self):
+        export_tracing = Mock()
+        retention = TailRetention(export_tracing)
+        sw = StopWatch(export_aggregated_timers_and_tracing_func=retention)
+        with sw.timer('root', start_time=0, end_time=1):
+            with sw.timer('child', start_time=0.25, end_time=0.5):
+                sw.add_span_annotation('rows', 3, event_time=0.3)
+        retained = retention._slowest['root'][0][2]
+        assert isinstance(retained, TraceBuffer)
+
+        retention.flush()
+        traces = export_tracing.call_args[1]['reported_traces']
+        expected = sw.get_last_trace_report()
+        assert [trace.log_name for trace in traces] == ['root#child', 'root']
+        assert traces[0].span_id == expected[0].span_id
+        assert traces[0].parent_span_id == expected[1].span_id
+        assert traces[0].trace_annotations == expected[0].trace_annotations
+        assert (traces[0].start_time, traces[0].end_time) == (0.25, 0.5)
+
+    def test_flush_expired(self):
+        export_tracing = Mock()
+        retention = TailRetention(export_tracing, window_seconds=60)
+        sw = StopWatch(export_aggregated_timers_and_tracing_func=retention)
+        add_root(sw, 'a', 0, 1)
+        retention.flush_expired(now=59)
+        assert not export_tracing.called
+        retention.flush_expired(now=60)
+        assert exported_roots(export_tracing) == [('a', 0)]
+
+        # The next root starts a new window
+        add_root(sw, 'a', 130, 131)
+        retention.flush_expired(now=179)
+        assert export_tracing.call_count == 1
+        retention.flush_expired(now=180)
+        assert exported_roots(export_tracing) == [('a', 0), ('a', 130)]
+
+    def test_background_flush(self):
+        exported = threading.Event()
+        export_tracing = Mock(side_effect=lambda reported_traces: exported.set())
+        retention = TailRetention(export_tracing, window_seconds=60, flush_interval=0.01,
+                                  time_func=lambda: 1000.0)
+        sw = StopWatch(export_aggregated_timers_and_tracing_func=retention)
+        add_root(sw, 'a', 0, 1)
+        assert exported.wait(5)
+        assert exported_roots(export_tracing) == [('a', 0)]
+        retention.close()
+        assert retention.num_retained == 1
@@ -0,0 +1,158 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+
+import pytest
+
+from stopwatch import StopWatch
+from stopwatch_aggregator import AggregatedStats
+from stopwatch_shm import (
+    _SLOT_HEADER,
+    SharedAggregationSegment,
+)
+from testutils import add_root
+
+
+@pytest.fixture
+def segment(tmpdir, request):
+    segment = SharedAggregationSegment.create(str(tmpdir.join('segment')), num_slots=3,
+                                              entries_per_slot=8, max_name_len=16)
+    request.addfinalizer(segment.close)
+    return segment
+
+
+class TestSharedAggregationSegment(object):
+    def test_merge_slots(self, segment):
+        sw0 = StopWatch(export_aggregated_timers_func=segment.writer(0))
+        sw1 = StopWatch(export_aggregated_timers_func=segment.writer(1))
+        add_root(sw0, 'root', 0, 1, [100])
+        add_root(sw0, 'root', 0, 1, [300])
+        add_root(sw1, 'root', 0, 1, [200])
+
+        assert segment.read_slot(0)['root'] == AggregatedStats(2, 2000.0, 1000.0, 1000.0, None)
+        assert segment.read_slot(2) == {}
+        merged = segment.read()
+        assert merged['root'] == AggregatedStats(3, 3000.0, 1000.0, 1000.0, None)
+        child = merged['root#child']
+        assert child.count == 3
+        assert round(child.total_ms) == 600
+        assert (round(child.min_ms), round(child.max_ms)) == (100, 300)
+
+        # Another process can open the segment by path
+        other = SharedAggregationSegment.open(segment.path)
+        assert other.read() == merged
+        other.close()
+
+        segment.reset_slot(0)
+        assert segment.read()['root'].count == 1
+
+    def test_forked_workers(self, segment):
+        pids = []
+        for slot in range(3):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    sw = StopWatch(export_aggregated_timers_func=segment.writer(slot))
+                    for _ in range(10):
+                        add_root(sw, 'root', 0, 1, [100])
+                finally:
+                    os._exit(0)
+            pids.append(pid)
+        for pid in pids:
+            os.waitpid(pid, 0)
+        assert segment.read()['root#child'].count == 30
+
+    def test_forked_workers_claim_slots(self, tmpdir):
+        segment = SharedAggregationSegment.create(str(tmpdir.join('segment')),
+                                                  num_slots=8, entries_per_slot=1)
+        go_read, go_write = os.pipe()
+        slot_read, slot_write = os.pipe()
+        pids = []
+        for _ in range(segment.num_slots):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    # Wait for the parent so all workers claim slots at once
+                    os.read(go_read, 1)
+                    os.write(slot_write, str(segment.writer().slot).encode('ascii'))
+                    # Stay alive until all workers claimed a slot
+                    os.read(go_read, 1)
+                finally:
+                    os._exit(0)
+            pids.append(pid)
+        os.write(go_write, b'x' * len(pids))
+        slots = [int(os.read(slot_read, 1)) for _ in pids]
+        os.write(go_write, b'x' * len(pids))
+        for pid in pids:
+            os.waitpid(pid, 0)
+        for fd in (go_read, go_write, slot_read, slot_write):
+            os.close(fd)
+        segment.close()
+        assert sorted(slots) == list(range(segment.num_slots))
+
+    def test_dropped_names(self, segment):
+        writer = segment.writer(0)
+        sw = StopWatch(export_aggregated_timers_func=writer)
+        with sw.timer('root'):
+            with sw.timer('a_very_long_span_name'):
+                pass
+            for i in range(10):
+                with sw.timer('c%d' % i):
+                    pass
+        # 8 entries per slot: the first 8 of the 11 short names fit
+        assert sorted(segment.read_slot(0)) == ['root#c%d' % i for i in range(8)]
+        assert writer.num_dropped_names == 4
+        # Once the slot is full, new names are dropped without probing it
+        assert len(writer._offsets) == 8
+        assert writer._add_entry('new') is None
+
+        # A new writer for the slot picks up where the old one left off
+        writer = segment.writer(0)
+        sw = StopWatch(export_aggregated_timers_func=writer)
+        with sw.timer('root'):
+            with sw.timer('c0'):
+                pass
+        assert segment.read_slot(0)['root#c0'].count == 2
+        assert writer.num_dropped_names == 1
+
+    def test_claim_slot(self, segment):
+        writer = segment.writer()
+        assert writer.slot == 0
+        # Slots owned by this (live) process are reused
+        assert segment.writer().slot == 0
+
+        # Writers of explicit slots own them too
+        segment.writer(2)
+        assert _SLOT_HEADER.unpack_from(segment._mmap, segment._slot_offset(2))[1] == \
+            os.getpid()
+
+    def test_stuck_slot(self, segment):
+        add_root(StopWatch(export_aggregated_timers_func=segment.writer(0)),
+                 'root', 0, 1, [100])
+        add_root(StopWatch(export_aggregated_timers_func=segment.writer(1)),
+                 'root', 0, 1, [100])
+        # A writer killed while applying a report leaves its sequence odd
+        offset = segment._slot_offset(1)
+        sequence, owner = _SLOT_HEADER.unpack_from(segment._mmap, offset)
+        _SLOT_HEADER.pack_into(segment._mmap, offset, sequence + 1, owner)
+
+        with pytest.raises(RuntimeError):
+            segment.read_slot(1)
+        assert segment.read()['root'].count == 1
+        assert segment.stuck_slots == [1]
+
+        # The next writer of the slot makes the sequence even again
+        writer = segment.writer(1)
+        assert _SLOT_HEADER.unpack_from(segment._mmap, offset)[0] == sequence + 2
+        add_root(StopWatch(export_aggregated_timers_func=writer), 'root', 0, 1, [100])
+        assert _SLOT_HEADER.unpack_from(segment._mmap, offset)[0] % 2 == 0
+        assert segment.read()['root'].count == 3
+        assert segment.stuck_slots == []
+
+    def test_open_invalid(self, tmpdir):
+        path = tmpdir.join('not_a_segment')
+        path.write(b'x' * 100, mode='wb')
+        with pytest.raises(ValueError):
+            SharedAggregationSegment.open(str(path))
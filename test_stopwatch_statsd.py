@@ -0,0 +1,136 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import socket
+
+import pytest
+
+from stopwatch import StopWatch
+from stopwatch_statsd import StatsdExporter
+from testutils import (
+    add_request,
+    MyBuckets,
+)
+
+
+@pytest.fixture
+def server():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    sock.settimeout(5)
+    yield sock
+    sock.close()
+
+
+def receive(server, num_packets):
+    return [server.recv(65536).decode('utf-8') for _ in range(num_packets)]
+
+
+class TestStatsdExporter(object):
+    def test_flush(self, server):
+        exporter = StatsdExporter(port=server.getsockname()[1], prefix='app',
+                                  flush_interval=3600)
+        sw = StopWatch(export_aggregated_timers_func=exporter)
+        add_request(sw, 0)
+        add_request(sw, 10, query_ms=50)
+        exporter.flush()
+
+        packets = receive(server, 1)
+        assert sorted(packets[0].split('\n')) == [
+            'app.buckets.DB:100.000|ms',
+            'app.buckets.DB:50.000|ms',
+            'app.buckets.RPC:200.000|ms',
+            'app.buckets.RPC:200.000|ms',
+            'app.counts.request.handler.query.query:2|c',
+            'app.counts.request.handler.query:2|c',
+            'app.counts.request.handler:2|c',
+            'app.counts.request.rpc:2|c',
+            'app.counts.request:2|c',
+            'app.timers.request.handler.query.query:50.000|ms',
+            'app.timers.request.handler.query.query:50.000|ms',
+            'app.timers.request.handler.query:100.000|ms',
+            'app.timers.request.handler.query:50.000|ms',
+            'app.timers.request.handler:500.000|ms',
+            'app.timers.request.handler:500.000|ms',
+            'app.timers.request.rpc:200.000|ms',
+            'app.timers.request.rpc:200.000|ms',
+            'app.timers.request:1000.000|ms',
+            'app.timers.request:1000.000|ms',
+        ]
+        assert exporter.num_reports == 2
+        assert exporter.num_packets == 1
+
+        # Nothing is left to send
+        exporter.flush()
+        assert exporter.num_packets == 1
+        exporter.close()
+
+    def test_max_packet_bytes(self, server):
+        exporter = StatsdExporter(port=server.getsockname()[1], flush_interval=3600,
+                                  max_packet_bytes=64)
+        sw = StopWatch(export_aggregated_timers_func=exporter)
+        for i in range(20):
+            add_request(sw, i)
+        exporter.flush()
+
+        packets = receive(server, exporter.num_packets)
+        assert all(len(packet) <= 64 for packet in packets)
+        lines = [line for packet in packets for line in packet.split('\n')]
+        assert len(lines) == 20 * 7 + 5
+        assert 'stopwatch.counts.request.handler.query:20|c' in lines
+        exporter.close()
+
+    def test_max_samples(self, server):
+        exporter = StatsdExporter(port=server.getsockname()[1], flush_interval=3600,
+                                  max_samples=5)
+        sw = StopWatch(export_aggregated_timers_func=exporter)
+        for i in range(20):
+            add_request(sw, i)
+        exporter.flush()
+
+        lines = [line for packet in receive(server, exporter.num_packets)
+                 for line in packet.split('\n')]
+        request_lines = [line for line in lines if line.startswith('stopwatch.timers.request:')]
+        assert request_lines == ['stopwatch.timers.request:1000.000|ms|@0.25'] * 5
+        exporter.close()
+
+    def test_background_flush(self, server):
+        exporter = StatsdExporter(port=server.getsockname()[1], flush_interval=0.01)
+        sw = StopWatch(export_aggregated_timers_func=exporter)
+        with sw.timer('root', start_time=0, end_time=1):
+            pass
+        assert sorted(receive(server, 1)[0].split('\n')) == [
+            'stopwatch.counts.root:1|c',
+            'stopwatch.timers.root:1000.000|ms',
+        ]
+        exporter.close()
+
+    def test_close_sends_remaining(self, server):
+        exporter = StatsdExporter(port=server.getsockname()[1], flush_interval=3600)
+        sw = StopWatch(export_aggregated_timers_func=exporter)
+        with sw.timer('root:1 x', start_time=0, end_time=1):
+            pass
+        exporter.close()
+        assert 'stopwatch.counts.root_1_x:1|c' in receive(server, 1)[0].split('\n')
+
+    def test_names_dont_clash(self, server):
+        exporter = StatsdExporter(port=server.getsockname()[1], flush_interval=3600)
+        sw = StopWatch(export_aggregated_timers_func=exporter)
+        # Span paths looking like the counter and bucket names of the old scheme
+        with sw.timer('bucket', start_time=0, end_time=1):
+            with sw.timer('DB', start_time=0, end_time=0.5, bucket=MyBuckets.DB):
+                pass
+            with sw.timer('count', start_time=0.5, end_time=0.75):
+                pass
+        exporter.flush()
+        assert sorted(receive(server, 1)[0].split('\n')) == [
+            'stopwatch.buckets.DB:500.000|ms',
+            'stopwatch.counts.bucket.DB:1|c',
+            'stopwatch.counts.bucket.count:1|c',
+            'stopwatch.counts.bucket:1|c',
+            'stopwatch.timers.bucket.DB:500.000|ms',
+            'stopwatch.timers.bucket.count:250.000|ms',
+            'stopwatch.timers.bucket:1000.000|ms',
+        ]
+        exporter.close()
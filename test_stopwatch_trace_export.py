@@ -0,0 +1,168 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import io
+import json
+
+from stopwatch import StopWatch
+from stopwatch_trace_export import (
+    ChromeTraceExporter,
+    OtlpJsonExporter,
+    ZipkinExporter,
+)
+
+
+def add_root(sw, offset=0):
+    with sw.timer('root', start_time=offset + 10, end_time=offset + 11):
+        sw.add_annotation('endpoint', '/"quoted"', event_time=offset + 10)
+        with sw.timer('child', start_time=offset + 10.25, end_time=offset + 10.5):
+            sw.add_span_annotation('rows', 3, event_time=offset + 10.3)
+
+
+def export_two_roots(exporter):
+    sw = StopWatch(export_tracing_func=exporter, counter_span_ids=True)
+    add_root(sw)
+    add_root(sw, offset=100)
+    return sw
+
+
+class TestTraceExport(object):
+    def test_chrome(self):
+        f = io.StringIO()
+        exporter = ChromeTraceExporter(f, pid=42)
+        export_two_roots(exporter)
+        exporter.close()
+
+        events = json.loads(f.getvalue())
+        assert len(events) == 4
+        child, root = events[:2]
+        assert child == {
+            'name': 'child', 'cat': 'stopwatch', 'ph': 'X', 'ts': 10250000.0,
+            'dur': 250000.0, 'pid': 42, 'tid': 1,
+            'args': {'log_name': 'root#child', 'span_id': child['args']['span_id'],
+                     'annotations': [['rows', '3']]},
+        }
+        assert root['args']['annotations'] == [['endpoint', '/"quoted"']]
+        assert [event['tid'] for event in events] == [1, 1, 2, 2]
+        assert exporter.num_roots == 2
+        assert exporter.num_spans == 4
+
+    def test_chrome_annotation_keys(self):
+        f = io.StringIO()
+        exporter = ChromeTraceExporter(f)
+        sw = StopWatch(export_tracing_func=exporter)
+        with sw.timer('root', start_time=0, end_time=1):
+            sw.add_annotation('log_name', 'a')
+            sw.add_annotation('log_name', 'b')
+        exporter.close()
+
+        # Repeated keys, or keys of the span's own args, don't clash
+        args = json.loads(f.getvalue())[0]['args']
+        assert args['log_name'] == 'root'
+        assert args['annotations'] == [['log_name', 'a'], ['log_name', 'b']]
+
+    def test_chunked_writes(self):
+        f = io.StringIO()
+        exporter = ZipkinExporter(f, chunk_size=1)
+        sw = StopWatch(export_tracing_func=exporter)
+        add_root(sw)
+        # chunk_size=1 writes every root out right away
+        assert len(f.getvalue().splitlines()) == 1
+
+        f = io.StringIO()
+        exporter = ZipkinExporter(f)
+        sw = StopWatch(export_tracing_func=exporter)
+        add_root(sw)
+        assert f.getvalue() == ''
+        exporter.flush()
+        assert len(f.getvalue().splitlines()) == 1
+
+    def test_zipkin(self):
+        f = io.StringIO()
+        exporter = ZipkinExporter(f, service_name='web')
+        sw = export_two_roots(exporter)
+        exporter.flush()
+
+        lines = f.getvalue().splitlines()
+        assert len(lines) == 2
+        child, root = json.loads(lines[1])
+        traces = sw.get_last_trace_report()
+        assert root == {
+            'traceId': traces[1].span_id,
+            'id': root['id'],
+            'name': 'root',
+            'timestamp': 110000000,
+            'duration': 1000000,
+            'localEndpoint': {'serviceName': 'web'},
+            'tags': {'log_name': 'root'},
+            'annotations': [{'timestamp': 110000000, 'value': 'endpoint=/"quoted"'}],
+        }
+        assert len(root['id']) == 16
+        assert child['traceId'] == root['traceId']
+        assert child['parentId'] == root['id']
+        assert child['annotations'] == [{'timestamp': 110300000, 'value': 'rows=3'}]
+
+    def test_child_stopwatch_span_ids(self):
+        f = io.StringIO()
+        exporter = ZipkinExporter(f)
+        sw = StopWatch(export_tracing_func=exporter, counter_span_ids=True)
+        with sw.timer('root', start_time=0, end_time=10):
+            # The counter span ids of both stopwatches end in the same 64 bits
+            child_sw = StopWatch(parent_context=sw.span_context(), counter_span_ids=True)
+            with child_sw.timer('work', start_time=1, end_time=2):
+                pass
+        exporter.flush()
+
+        spans = {span['name']: span for span in json.loads(f.getvalue())}
+        traces = {trace.name: trace for trace in sw.get_last_trace_report()}
+        assert traces['work'].span_id[-16:] == traces['root'].span_id[-16:]
+        assert spans['work']['id'] != spans['root']['id']
+        assert spans['work']['parentId'] == spans['root']['id']
+
+    def test_child_stopwatch_exported_alone(self):
+        f = io.StringIO()
+        exporter = ZipkinExporter(f)
+        sw = StopWatch(export_tracing_func=exporter)
+        with sw.timer('root', start_time=0, end_time=10):
+            context = sw.span_context()
+        # The parent's root scope has been exported, so this one is exported on its own
+        child_sw = StopWatch(parent_context=context, export_tracing_func=exporter)
+        with child_sw.timer('late', start_time=11, end_time=12):
+            grandchild_sw = StopWatch(parent_context=child_sw.span_context())
+            with grandchild_sw.timer('step', start_time=11, end_time=11.5):
+                pass
+        exporter.flush()
+
+        (root,), child_spans = [json.loads(line) for line in f.getvalue().splitlines()]
+        spans = {span['name']: span for span in child_spans}
+        assert spans['late']['traceId'] == spans['step']['traceId'] == root['traceId']
+        assert spans['late']['parentId'] == root['id']
+        assert spans['step']['parentId'] == spans['late']['id']
+
+    def test_otlp_json(self, tmpdir):
+        path = str(tmpdir.join('traces.jsonl'))
+        exporter = OtlpJsonExporter(path)
+        export_two_roots(exporter)
+        exporter.close()
+
+        with open(path) as f:
+            request = json.loads(f.readlines()[0])
+        resource_spans = request['resourceSpans'][0]
+        assert resource_spans['resource']['attributes'] == [
+            {'key': 'service.name', 'value': {'stringValue': 'stopwatch'}},
+        ]
+        child, root = resource_spans['scopeSpans'][0]['spans']
+        assert root['startTimeUnixNano'] == '10000000000'
+        assert root['endTimeUnixNano'] == '11000000000'
+        assert 'parentSpanId' not in root
+        assert child['parentSpanId'] == root['spanId']
+        assert child['traceId'] == root['traceId']
+        assert child['events'] == [{
+            'timeUnixNano': '10300000000',
+            'name': 'rows',
+            'attributes': [{'key': 'value', 'value': {'stringValue': '3'}}],
+        }]
+        assert child['attributes'] == [
+            {'key': 'log_name', 'value': {'stringValue': 'root#child'}},
+        ]
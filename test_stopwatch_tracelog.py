@@ -0,0 +1,143 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+
+import pytest
+
+from stopwatch import StopWatch
+from stopwatch_tracelog import (
+    LoggedAnnotation,
+    TraceLogReader,
+    TraceLogWriter,
+)
+
+
+def add_root(sw, name, start_time):
+    with sw.timer(name, start_time=start_time, end_time=start_time + 1):
+        sw.add_annotation('endpoint', '/index', event_time=start_time)
+        for i in range(3):
+            child_start = start_time + i * 0.1
+            with sw.timer('child', start_time=child_start, end_time=child_start + 0.05):
+                sw.add_span_annotation('i', i, event_time=child_start)
+
+
+def span_summary(reader, root):
+    return [(span.name, span.log_name, span.start_time) for span in reader.spans(root)]
+
+
+@pytest.fixture
+def log_path(tmpdir):
+    return str(tmpdir.join('traces.swlog'))
+
+
+class TestTraceLog(object):
+    def test_roundtrip(self, log_path):
+        writer = TraceLogWriter(log_path)
+        sw = StopWatch(export_tracing_func=writer)
+        for start_time in (30, 10, 20):
+            add_root(sw, 'request', start_time)
+        add_root(sw, 'cron', 15)
+        writer.close()
+
+        reader = TraceLogReader(log_path)
+        assert reader.root_names() == ['cron', 'request']
+        assert [(root.name, root.start_time, root.num_spans) for root in reader.roots()] == [
+            ('cron', 15, 4), ('request', 10, 4), ('request', 20, 4), ('request', 30, 4),
+        ]
+        assert [root.start_time for root in reader.roots('request', 15, 30)] == [20, 30]
+        assert list(reader.roots('missing')) == []
+
+        root = next(reader.roots('request', start_time=20))
+        spans = list(reader.spans(root))
+        assert [(span.name, span.log_name) for span in spans] == [
+            ('child', 'request#child')] * 3 + [('request', 'request')]
+        assert spans[1].trace_annotations == [LoggedAnnotation('i', '1', 20.1)]
+        assert spans[3].trace_annotations == [LoggedAnnotation('endpoint', '/index', 20)]
+        assert spans[3].end_time == 21
+        assert all(span.parent_span_id == spans[3].span_id for span in spans[:3])
+        assert spans[3].parent_span_id is None
+        reader.close()
+
+    def test_unclosed_log(self, log_path):
+        writer = TraceLogWriter(log_path)
+        sw = StopWatch(export_tracing_func=writer)
+        add_root(sw, 'request', 10)
+        add_root(sw, 'request', 20)
+        writer.flush()
+
+        reader = TraceLogReader(log_path)
+        assert [root.start_time for root in reader.roots()] == [10, 20]
+        assert len(span_summary(reader, next(reader.roots()))) == 4
+        reader.close()
+
+        # A crash mid-write leaves a truncated last root, which is ignored
+        writer._file.close()
+        with open(log_path, 'r+b') as f:
+            f.truncate(os.path.getsize(log_path) - 10)
+        reader = TraceLogReader(log_path)
+        assert [root.start_time for root in reader.roots()] == [10]
+        reader.close()
+
+    def test_append(self, log_path):
+        writer = TraceLogWriter(log_path)
+        add_root(StopWatch(export_tracing_func=writer), 'request', 10)
+        writer.close()
+
+        writer = TraceLogWriter(log_path)
+        sw = StopWatch(export_tracing_func=writer)
+        add_root(sw, 'request', 20)
+        with sw.timer('other', start_time=30, end_time=31):
+            sw.add_span_annotation('new_key', 'new_value', event_time=30)
+        writer.close()
+
+        reader = TraceLogReader(log_path)
+        assert [(root.name, root.start_time) for root in reader.roots()] == [
+            ('other', 30), ('request', 10), ('request', 20)]
+        other_span, = reader.spans(next(reader.roots('other')))
+        assert other_span.trace_annotations == [LoggedAnnotation('new_key', 'new_value', 30)]
+        assert span_summary(reader, next(reader.roots('request', 20))) == \
+            [('child', 'request#child', 20 + i * 0.1) for i in range(3)] + \
+            [('request', 'request', 20)]
+        reader.close()
+
+    def test_long_strings(self, log_path):
+        writer = TraceLogWriter(log_path)
+        sw = StopWatch(export_tracing_func=writer)
+        with sw.timer('request', start_time=0, end_time=1):
+            sw.add_annotation('body', 'x' * 70000, event_time=0)
+        writer.close()
+
+        reader = TraceLogReader(log_path)
+        span, = reader.spans(next(reader.roots()))
+        assert span.trace_annotations == [LoggedAnnotation('body', 'x' * 70000, 0)]
+        reader.close()
+
+    def test_export_error(self, log_path):
+        writer = TraceLogWriter(log_path)
+        sw = StopWatch(export_tracing_func=writer)
+        with sw.timer('request', start_time=0, end_time=1):
+            # Fails to pack, after interning the new strings of the root scope
+            sw.add_annotation('broken', 'value', event_time='not a time')
+        assert writer.num_export_errors == 1
+
+        add_root(sw, 'request', 10)
+        writer.flush()
+        # Without a footer, strings are only found by scanning the records
+        reader = TraceLogReader(log_path)
+        root, = reader.roots()
+        assert span_summary(reader, root)[-1] == ('request', 'request', 10)
+        reader.close()
+        writer.close()
+        # A second close doesn't write another footer
+        writer.close()
+        reader = TraceLogReader(log_path)
+        assert len(list(reader.roots())) == 1
+        reader.close()
+
+    def test_invalid_file(self, log_path):
+        with open(log_path, 'wb') as f:
+            f.write(b'not a trace log')
+        with pytest.raises(ValueError):
+            TraceLogReader(log_path)
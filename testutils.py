@@ -0,0 +1,42 @@
+"""Helpers shared by the tests of the stopwatch_* modules"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import enum
+
+
+class MyBuckets(enum.Enum):
+    DB = 1
+    RPC = 2
+
+
+def add_root(sw, name, start_time, end_time, child_ms_list=()):
+    """Time a root scope `name` with back to back 'child' spans of the given durations"""
+    with sw.timer(name, start_time=start_time, end_time=end_time):
+        t = start_time
+        for child_ms in child_ms_list:
+            with sw.timer('child', start_time=t, end_time=t + child_ms / 1000.0):
+                pass
+            t += child_ms / 1000.0
+
+
+def add_request(sw, start_time, query_ms=100):
+    """Time a one second 'request' root scope:
+    request (1s)
+      handler (0.5s)
+        query (query_ms, DB)
+          query (50ms, DB)
+      rpc (0.2s, RPC)
+    """
+    with sw.timer('request', start_time=start_time, end_time=start_time + 1):
+        with sw.timer('handler', start_time=start_time, end_time=start_time + 0.5):
+            with sw.timer('query', start_time=start_time,
+                          end_time=start_time + query_ms / 1000.0, bucket=MyBuckets.DB):
+                with sw.timer('query', start_time=start_time, end_time=start_time + 0.05,
+                              bucket=MyBuckets.DB):
+                    pass
+        with sw.timer('rpc', start_time=start_time + 0.5, end_time=start_time + 0.7,
+                      bucket=MyBuckets.RPC):
+            pass